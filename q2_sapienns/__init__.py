@@ -16,5 +16,15 @@ from .plugin_setup import (
     HumannPathAbundanceDirectoryFormat, HumannPathAbundanceFormat,
     MetaphlanMergedAbundanceDirectoryFormat, MetaphlanMergedAbundanceFormat,
     MetaphlanMergedAbundanceTable, HumannPathAbundanceTable,
-    HumannGeneFamilyTable
+    HumannGeneFamilyTable,
+    CompressedHumannGeneFamilyDirectoryFormat,
+    CompressedHumannGeneFamilyFormat,
+    CompressedHumannPathAbundanceDirectoryFormat,
+    CompressedHumannPathAbundanceFormat,
+    CompressedMetaphlanMergedAbundanceDirectoryFormat,
+    CompressedMetaphlanMergedAbundanceFormat,
+    HumannGeneFamilyArrowDirectoryFormat,
+    HumannPathAbundanceArrowDirectoryFormat,
+    MetaphlanMergedAbundanceArrowDirectoryFormat, ArrowTableFormat,
+    TableChunks
 )
@@ -0,0 +1,148 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2022, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import hashlib
+import json
+import os
+import tempfile
+
+from qiime2.plugin import ValidationError
+
+# Environment variable defining the directory where validation results are
+# cached. Caching is disabled unless this is set.
+CACHE_DIR_ENV_VAR = 'Q2_SAPIENNS_VALIDATION_CACHE'
+
+# Environment variable defining the maximum number of validation results
+# retained in the cache. The least recently used results are evicted first.
+CACHE_SIZE_ENV_VAR = 'Q2_SAPIENNS_VALIDATION_CACHE_SIZE'
+DEFAULT_CACHE_SIZE = 1000
+
+# The content digest is computed from this many evenly spaced blocks of
+# DIGEST_BLOCK_BYTES bytes (always including the first and last block), so
+# computing it takes roughly constant time regardless of file size.
+DIGEST_N_BLOCKS = 16
+DIGEST_BLOCK_BYTES = 64 * 1024
+
+
+def _cache_dir():
+    return os.environ.get(CACHE_DIR_ENV_VAR) or None
+
+
+def _cache_size():
+    value = os.environ.get(CACHE_SIZE_ENV_VAR, str(DEFAULT_CACHE_SIZE))
+    try:
+        cache_size = int(value)
+    except ValueError:
+        raise ValueError('%s must be an integer. Found: %s' %
+                         (CACHE_SIZE_ENV_VAR, value))
+    if cache_size < 1:
+        raise ValueError('%s must be at least 1. Found: %d' %
+                         (CACHE_SIZE_ENV_VAR, cache_size))
+    return cache_size
+
+
+def _content_digest(filepath, size):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(filepath, 'rb') as fh:
+        if size <= DIGEST_N_BLOCKS * DIGEST_BLOCK_BYTES:
+            digest.update(fh.read())
+        else:
+            step = (size - DIGEST_BLOCK_BYTES) // (DIGEST_N_BLOCKS - 1)
+            for i in range(DIGEST_N_BLOCKS):
+                fh.seek(i * step)
+                digest.update(fh.read(DIGEST_BLOCK_BYTES))
+    return digest.hexdigest()
+
+
+def _cache_key(filepath, format_name, level):
+    stat = os.stat(filepath)
+    key = '\t'.join([format_name, level, str(stat.st_size),
+                     str(stat.st_mtime_ns),
+                     _content_digest(filepath, stat.st_size)])
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+def _read_entry(entry_path):
+    try:
+        with open(entry_path) as fh:
+            entry = json.load(fh)
+    except (OSError, ValueError):
+        return None
+    try:
+        # Mark the entry as most recently used.
+        os.utime(entry_path)
+    except OSError:
+        pass
+    return entry
+
+
+def _write_entry(cache_dir, entry_path, entry):
+    # The cache is best-effort: failing to write to it never changes the
+    # outcome of validation.
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        # Write to a temporary file first so that concurrent readers never
+        # see a partially written entry.
+        fd, temp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+        with os.fdopen(fd, 'w') as fh:
+            json.dump(entry, fh)
+        os.replace(temp_path, entry_path)
+        _evict(cache_dir, _cache_size())
+    except OSError:
+        pass
+
+
+def _evict(cache_dir, cache_size):
+    entries = []
+    with os.scandir(cache_dir) as it:
+        for dir_entry in it:
+            if dir_entry.name.endswith('.json'):
+                try:
+                    entries.append((dir_entry.stat().st_mtime_ns,
+                                    dir_entry.path))
+                except OSError:
+                    pass
+    if len(entries) <= cache_size:
+        return
+    entries.sort()
+    for _, entry_path in entries[:len(entries) - cache_size]:
+        try:
+            os.remove(entry_path)
+        except OSError:
+            pass
+
+
+def cached_validation(filepath, format_name, level, validate):
+    """Call validate(), or replay its cached outcome for filepath
+
+    Outcomes are cached on disk only if the Q2_SAPIENNS_VALIDATION_CACHE
+    environment variable is set, and only for ``level='max'`` (``'min'``
+    validation is cheaper than computing the cache key). Cached outcomes
+    are keyed by ``format_name``, ``level``, and the size, modification
+    time and a sampled content digest of ``filepath``.
+    """
+    cache_dir = _cache_dir()
+    if cache_dir is None or level != 'max':
+        validate()
+        return
+
+    entry_path = os.path.join(
+        cache_dir, _cache_key(filepath, format_name, level) + '.json')
+    entry = _read_entry(entry_path)
+    if entry is not None:
+        if not entry['valid']:
+            raise ValidationError(entry['message'])
+        return
+
+    try:
+        validate()
+    except ValidationError as e:
+        _write_entry(cache_dir, entry_path,
+                     {'valid': False, 'message': str(e)})
+        raise
+    _write_entry(cache_dir, entry_path, {'valid': True, 'message': None})
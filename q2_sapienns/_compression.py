@@ -0,0 +1,153 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2022, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import bz2
+import gzip
+import io
+import lzma
+import queue
+import threading
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Leading bytes identifying each supported compression format.
+MAGIC_BYTES = {
+    'gzip': b'\x1f\x8b',
+    'bzip2': b'BZh',
+    'xz': b'\xfd7zXZ\x00',
+    'zstd': b'\x28\xb5\x2f\xfd',
+}
+
+# Exceptions raised when reading corrupt or truncated compressed data.
+DECOMPRESSION_ERRORS = (EOFError, OSError, lzma.LZMAError, zlib.error)
+if zstandard is not None:
+    DECOMPRESSION_ERRORS += (zstandard.ZstdError,)
+
+# Size of the blocks of decompressed data passed from the decompressing
+# thread to the reader, and the number of blocks that can be waiting to be
+# read.
+BLOCK_SIZE = 1024 ** 2
+N_BLOCKS = 4
+
+
+def detect_compression(filepath):
+    """Return the compression format of filepath, or None if not known"""
+    with open(filepath, 'rb') as fh:
+        start = fh.read(max(len(magic) for magic in MAGIC_BYTES.values()))
+    for compression, magic in MAGIC_BYTES.items():
+        if start.startswith(magic):
+            return compression
+    return None
+
+
+def can_decompress(compression):
+    """Return True if the packages needed to decompress are installed"""
+    return compression != 'zstd' or zstandard is not None
+
+
+def _open_compressed(filepath, compression):
+    if compression == 'gzip':
+        return gzip.open(filepath, 'rb')
+    elif compression == 'bzip2':
+        return bz2.open(filepath, 'rb')
+    elif compression == 'xz':
+        return lzma.open(filepath, 'rb')
+    elif compression == 'zstd':
+        if zstandard is None:
+            raise ValueError('The zstandard package must be installed to '
+                             'read zstd-compressed files.')
+        return zstandard.ZstdDecompressor().stream_reader(
+            open(filepath, 'rb'), closefd=True)
+    raise ValueError('Unknown compression format: %s' % compression)
+
+
+class _ThreadedReader(io.RawIOBase):
+    # A raw stream of the data read from another stream by a background
+    # thread. This allows decompression (which releases the GIL) to run
+    # while the data that has already been decompressed is parsed.
+
+    def __init__(self, stream, block_size=BLOCK_SIZE, n_blocks=N_BLOCKS):
+        super().__init__()
+        self._stream = stream
+        self._block_size = block_size
+        self._blocks = queue.Queue(maxsize=n_blocks)
+        self._stop = threading.Event()
+        self._block = memoryview(b'')
+        self._eof = False
+        self._thread = threading.Thread(target=self._read_blocks,
+                                        daemon=True)
+        self._thread.start()
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._blocks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _read_blocks(self):
+        try:
+            while True:
+                block = self._stream.read(self._block_size)
+                if not self._put(block) or not block:
+                    return
+        except BaseException as e:
+            self._put(e)
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if len(self._block) == 0:
+            if self._eof:
+                return 0
+            block = self._blocks.get()
+            if isinstance(block, BaseException):
+                self._eof = True
+                raise block
+            if not block:
+                self._eof = True
+                return 0
+            self._block = memoryview(block)
+        n = min(len(b), len(self._block))
+        b[:n] = self._block[:n]
+        self._block = self._block[n:]
+        return n
+
+    def close(self):
+        if not self.closed:
+            self._stop.set()
+            self._thread.join()
+            self._stream.close()
+        super().close()
+
+
+def open_decompressed(filepath, text=True):
+    """Open compressed filepath for reading its decompressed contents
+
+    The compression format is detected from the first bytes of the file.
+    Decompression runs in a background thread. If ``text`` is True, a text
+    stream decoding the contents as UTF-8 is returned, otherwise a binary
+    stream.
+    """
+    compression = detect_compression(filepath)
+    if compression is None:
+        raise ValueError('%s is not compressed in a supported format (%s).'
+                         % (filepath, ', '.join(MAGIC_BYTES)))
+    stream = io.BufferedReader(
+        _ThreadedReader(_open_compressed(filepath, compression)),
+        buffer_size=BLOCK_SIZE)
+    if text:
+        return io.TextIOWrapper(stream, encoding='utf-8')
+    return stream
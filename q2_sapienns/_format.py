@@ -0,0 +1,361 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2022, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import hashlib
+import os
+import warnings
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+except ImportError:
+    pyarrow = None
+
+from qiime2.plugin import (TextFileFormat, BinaryFileFormat, model,
+                           ValidationError)
+
+from ._cache import cached_validation
+from ._compression import (BLOCK_SIZE, DECOMPRESSION_ERRORS, MAGIC_BYTES,
+                           can_decompress, detect_compression,
+                           open_decompressed)
+from ._validation import (abundance_checker, column_count_checker,
+                          validate_abundances, validate_column_counts,
+                          validate_column_counts_bytes,
+                          validate_column_counts_parallel, validate_sample,
+                          use_parallel_validation, validation_mode,
+                          validation_sample_size, validation_workers)
+
+# Name of the Arrow IPC file written next to the table of the *Arrow*
+# directory formats.
+SIDECAR_FILENAME = 'table.arrow'
+ARROW_MAGIC = b'ARROW1'
+
+# Keys of the schema metadata of the Arrow sidecar, recording the size and
+# SHA-256 digest of the table that it was parsed from.
+SIDECAR_SIZE_KEY = b'q2_sapienns.table_size'
+SIDECAR_DIGEST_KEY = b'q2_sapienns.table_sha256'
+
+# SampleSummaries of the files whose sampled rows were valid, keyed by the
+# format, path, size and modification time of each file and the number of
+# rows sampled. Every transformer validates its input at the 'min' level, so
+# this keeps a file from being sampled (and warned about) again in the same
+# process while it's unchanged. At most SAMPLED_CACHE_SIZE summaries are
+# kept, the oldest being evicted first.
+_sampled = {}
+SAMPLED_CACHE_SIZE = 1000
+
+
+def _validate_sample(ff, n_header_lines, check_rows):
+    # Extend 'min' validation to a random sample of rows, if requested. The
+    # resulting SampleSummary is available as ff.sample_summary, and its
+    # confidence is reported with a warning the first time the file is
+    # sampled, as the rest of the table wasn't checked.
+    n_rows = validation_sample_size()
+    if n_rows > 0:
+        filepath = str(ff)
+        stat = os.stat(filepath)
+        key = (type(ff).__name__, filepath, stat.st_size, stat.st_mtime_ns,
+               n_rows)
+        summary = _sampled.get(key)
+        if summary is not None:
+            ff.sample_summary = summary
+            return
+        summary = validate_sample(filepath, n_header_lines, n_rows,
+                                  check_rows)
+        ff.sample_summary = summary
+        _sampled[key] = summary
+        if len(_sampled) > SAMPLED_CACHE_SIZE:
+            del _sampled[next(iter(_sampled))]
+        warnings.warn(
+            'Validated %d randomly sampled rows of %s, in addition to its '
+            'first and last rows. The confidence that fewer than %g%% of '
+            'its rows are invalid is %.1f%%. Validate the table at the '
+            "'max' level to check all of its rows." %
+            (summary.n_rows, os.path.basename(str(ff)),
+             summary.tolerance * 100, summary.confidence * 100),
+            UserWarning)
+
+
+class MetaphlanMergedAbundanceFormat(TextFileFormat):
+    _compressed = False
+
+    def _equal_number_of_columns(self, n_lines):
+        with self.open() as fh:
+            header_line = fh.readline()
+            line_no = 1
+            while header_line.startswith('#'):
+                header_line = fh.readline()
+                line_no += 1
+            n_header_fields = len(header_line.split('\t'))
+            if n_header_fields < 3:
+                raise ValidationError(
+                    'No sample columns appear to be present.')
+            validate_abundances(fh, line_no + 1, n_header_fields, n_lines)
+            if n_lines is not None and not self._compressed:
+                _validate_sample(self, line_no,
+                                 abundance_checker(n_header_fields))
+
+    def _validate_(self, level):
+        level_to_n_lines = {'min': 5, 'max': None}
+        cached_validation(
+            str(self), type(self).__name__, level,
+            lambda: self._equal_number_of_columns(level_to_n_lines[level]))
+
+
+class HumannTableFormat(TextFileFormat):
+    _compressed = False
+
+    def _equal_number_of_columns(self, n_lines):
+        with self.open() as fh:
+            header_line = fh.readline().strip()
+            header_fields = header_line.split('\t')
+            n_header_fields = len(header_fields)
+            if n_header_fields < 2:
+                raise ValidationError(
+                    'No sample columns appear to be present.')
+            for sample_id in header_fields[1:]:
+                if not sample_id.endswith(self._unit_label):
+                    raise ValidationError(
+                        'Expected sample ids (e.g., %s) to end with unit '
+                        'descriptor %s' % (sample_id, self._unit_label)
+                    )
+            if n_lines is not None:
+                validate_column_counts(fh, 2, n_header_fields, n_lines)
+                if not self._compressed:
+                    _validate_sample(self, 1,
+                                     column_count_checker(n_header_fields))
+                return
+            filepath = str(self)
+            n_workers = validation_workers()
+            if (not self._compressed and
+                    use_parallel_validation(filepath, n_lines, n_workers)):
+                validate_column_counts_parallel(
+                    filepath, 1, n_header_fields, n_workers)
+            elif not self._compressed and validation_mode() == 'bytes':
+                validate_column_counts_bytes(filepath, 1, n_header_fields)
+            else:
+                validate_column_counts(fh, 2, n_header_fields, n_lines)
+
+    def _validate_(self, level):
+        level_to_n_lines = {'min': 5, 'max': None}
+        cached_validation(
+            str(self), type(self).__name__, level,
+            lambda: self._equal_number_of_columns(level_to_n_lines[level]))
+
+
+class HumannPathAbundanceFormat(HumannTableFormat):
+    _unit_label = 'Abundance'
+
+
+class HumannGeneFamilyFormat(HumannTableFormat):
+    _unit_label = 'RPKs'
+
+
+class _CompressedTableFormat:
+    # Mixin for formats of tables compressed with gzip, bzip2, xz or zstd.
+    # The compression format is detected from the file's magic bytes, and
+    # the table is decompressed as it is read, so that it never needs to be
+    # decompressed to disk. Checks that need random access to the
+    # decompressed table (parallel, byte-level and sampled validation) are
+    # skipped.
+    _compressed = True
+
+    def open(self):
+        if self._mode != 'r':
+            raise ValueError('Compressed tables can only be opened for '
+                             'reading.')
+        return open_decompressed(str(self))
+
+    def open_binary(self):
+        return open_decompressed(str(self), text=False)
+
+    def _validate_(self, level):
+        compression = detect_compression(str(self))
+        if compression is None:
+            raise ValidationError(
+                'File is not compressed in a supported format (%s).' %
+                ', '.join(MAGIC_BYTES))
+        if not can_decompress(compression):
+            raise ValidationError(
+                'The zstandard package must be installed to read '
+                'zstd-compressed files.')
+        try:
+            super()._validate_(level)
+        except DECOMPRESSION_ERRORS as e:
+            raise ValidationError(
+                'Could not decompress %s data: %s' % (compression, e))
+
+
+class CompressedMetaphlanMergedAbundanceFormat(
+        _CompressedTableFormat, MetaphlanMergedAbundanceFormat):
+    pass
+
+
+class CompressedHumannPathAbundanceFormat(
+        _CompressedTableFormat, HumannPathAbundanceFormat):
+    pass
+
+
+class CompressedHumannGeneFamilyFormat(
+        _CompressedTableFormat, HumannGeneFamilyFormat):
+    pass
+
+
+MetaphlanMergedAbundanceDirectoryFormat = model.SingleFileDirectoryFormat(
+    'MetaphlanMergedAbundanceDirectoryFormat', 'table.tsv',
+    MetaphlanMergedAbundanceFormat)
+
+HumannPathAbundanceDirectoryFormat = model.SingleFileDirectoryFormat(
+    'HumannPathAbundanceDirectoryFormat', 'table.tsv',
+    HumannPathAbundanceFormat)
+
+HumannGeneFamilyDirectoryFormat = model.SingleFileDirectoryFormat(
+    'HumannGeneFamilyDirectoryFormat', 'table.tsv', HumannGeneFamilyFormat)
+
+CompressedMetaphlanMergedAbundanceDirectoryFormat = \
+    model.SingleFileDirectoryFormat(
+        'CompressedMetaphlanMergedAbundanceDirectoryFormat',
+        'table.tsv.compressed', CompressedMetaphlanMergedAbundanceFormat)
+
+CompressedHumannPathAbundanceDirectoryFormat = \
+    model.SingleFileDirectoryFormat(
+        'CompressedHumannPathAbundanceDirectoryFormat',
+        'table.tsv.compressed', CompressedHumannPathAbundanceFormat)
+
+CompressedHumannGeneFamilyDirectoryFormat = model.SingleFileDirectoryFormat(
+    'CompressedHumannGeneFamilyDirectoryFormat', 'table.tsv.compressed',
+    CompressedHumannGeneFamilyFormat)
+
+
+class ArrowTableFormat(BinaryFileFormat):
+    """An Arrow IPC file of a parsed biobakery table
+
+    These are written next to the tables of the *Arrow* directory formats
+    (see _reader.write_sidecar), so that the tables can be loaded without
+    parsing them again.
+    """
+
+    def _validate_(self, level):
+        with self.open() as fh:
+            start = fh.read(len(ARROW_MAGIC))
+            fh.seek(0, os.SEEK_END)
+            if fh.tell() < 2 * len(ARROW_MAGIC):
+                raise ValidationError('File is too short to be an Arrow IPC '
+                                      'file.')
+            fh.seek(-len(ARROW_MAGIC), os.SEEK_END)
+            end = fh.read(len(ARROW_MAGIC))
+        if start != ARROW_MAGIC or end != ARROW_MAGIC:
+            raise ValidationError('File is not an Arrow IPC file.')
+        if level == 'max' and pyarrow is not None:
+            try:
+                _sidecar_metadata(str(self))
+            except pyarrow.ArrowInvalid as e:
+                raise ValidationError('The Arrow IPC file could not be '
+                                      'read: %s' % e)
+
+
+def _sidecar_metadata(filepath):
+    # The schema metadata of an Arrow sidecar. Only its footer and schema
+    # are read.
+    with pyarrow.ipc.open_file(pyarrow.memory_map(filepath, 'r')) as reader:
+        return reader.schema.metadata or {}
+
+
+class _ArrowDirectoryFormat:
+    # Mixin for directory formats holding a table (table.tsv) and,
+    # optionally, an Arrow IPC file of the parsed table (table.arrow). The
+    # Arrow file is written by the transformers to these formats, if pyarrow
+    # is installed, i.e. when a table file is imported, or a directory is
+    # imported with one of the directory formats without an Arrow file as
+    # its input format. A directory imported as one of these formats is
+    # stored as it is, without an Arrow file. The readers in _reader
+    # memory-map the Arrow file instead of parsing the table, if it was
+    # written from the table as it is. These are single file directory
+    # formats (with an extra, optional file) so that tables can still be
+    # imported without specifying an input format. Subclasses must define
+    # the sidecar file themselves, as only the fields of directory format
+    # classes are collected.
+
+    def table_format(self):
+        """Return the format of the table file"""
+        return self.file.view(self.file.format)
+
+    def table_metadata(self, digest=True):
+        """Return the size and digest of the table file
+
+        These are recorded in the schema metadata of the Arrow file, keyed
+        by SIDECAR_SIZE_KEY and SIDECAR_DIGEST_KEY (as bytes). The digest
+        is only computed (reading the whole table) if ``digest`` is true.
+        """
+        filepath = str(self.table_format())
+        metadata = {SIDECAR_SIZE_KEY: b'%d' % os.path.getsize(filepath)}
+        if digest:
+            sha256 = hashlib.sha256()
+            with open(filepath, 'rb') as fh:
+                for block in iter(lambda: fh.read(BLOCK_SIZE), b''):
+                    sha256.update(block)
+            metadata[SIDECAR_DIGEST_KEY] = sha256.hexdigest().encode('ascii')
+        return metadata
+
+    def sidecar_path(self):
+        """Return the path of the Arrow file, or None if there isn't one"""
+        filepath = os.path.join(str(self), SIDECAR_FILENAME)
+        if os.path.exists(filepath):
+            return filepath
+        return None
+
+    def current_sidecar_path(self):
+        """Return the path of the Arrow file, if it matches the table
+
+        None is returned if there is no Arrow file, if pyarrow isn't
+        installed, or if the size of the table recorded in the Arrow file
+        isn't that of the table file (e.g., because the table was replaced
+        after the Arrow file was written). Only the sizes are compared, so
+        that the table isn't read; 'max' validation compares digests.
+        """
+        filepath = self.sidecar_path()
+        if filepath is None or pyarrow is None:
+            return None
+        metadata = _sidecar_metadata(filepath)
+        if metadata.get(SIDECAR_SIZE_KEY) != \
+                self.table_metadata(digest=False)[SIDECAR_SIZE_KEY]:
+            return None
+        return filepath
+
+    def _validate_(self, level):
+        # At the 'max' level, the Arrow file must have been written from the
+        # table as it is. Without pyarrow, the Arrow file is never read.
+        filepath = self.sidecar_path()
+        if level != 'max' or filepath is None or pyarrow is None:
+            return
+        metadata = _sidecar_metadata(filepath)
+        if any(metadata.get(key) != value
+               for key, value in self.table_metadata().items()):
+            raise ValidationError(
+                '%s was not written from %s as it is: the size or digest of '
+                'the table recorded in it differs.' %
+                (SIDECAR_FILENAME,
+                 os.path.basename(str(self.table_format()))))
+
+
+class MetaphlanMergedAbundanceArrowDirectoryFormat(
+        _ArrowDirectoryFormat, MetaphlanMergedAbundanceDirectoryFormat):
+    sidecar = model.File(SIDECAR_FILENAME, format=ArrowTableFormat,
+                         optional=True)
+
+
+class HumannPathAbundanceArrowDirectoryFormat(
+        _ArrowDirectoryFormat, HumannPathAbundanceDirectoryFormat):
+    sidecar = model.File(SIDECAR_FILENAME, format=ArrowTableFormat,
+                         optional=True)
+
+
+class HumannGeneFamilyArrowDirectoryFormat(
+        _ArrowDirectoryFormat, HumannGeneFamilyDirectoryFormat):
+    sidecar = model.File(SIDECAR_FILENAME, format=ArrowTableFormat,
+                         optional=True)
@@ -0,0 +1,180 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2022, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import concurrent.futures
+
+import numpy as np
+import scipy.sparse
+
+# How relative frequencies are converted to whole frequencies: each is
+# rounded on its own ('round'), the target frequency of each sample is
+# apportioned between its features with the largest remainder method
+# ('largest-remainder'), or the target frequency of each sample is drawn
+# from a multinomial distribution of its relative frequencies
+# ('multinomial'). The totals of the samples are exactly the target with
+# the latter two.
+ROUNDINGS = ('round', 'largest-remainder', 'multinomial')
+DEFAULT_ROUNDING = 'round'
+
+# The seed of the random numbers drawn with the multinomial rounding.
+DEFAULT_SEED = 0
+
+# The number of values in the dense blocks of samples that the multinomial
+# rounding draws frequencies for at a time, which bounds the memory needed
+# for them.
+BLOCK_VALUES = 2 ** 18
+
+
+def check_rounding(rounding):
+    """Raise a ValueError if rounding isn't one of ROUNDINGS"""
+    if rounding not in ROUNDINGS:
+        raise ValueError('Rounding must be one of %s. Found: %s' %
+                         (', '.join(ROUNDINGS), rounding))
+
+
+def _block_size(n_features):
+    # The number of samples converted at a time.
+    return max(1, BLOCK_VALUES // max(n_features, 1))
+
+
+def _block_generators(rounding, seed, n_blocks):
+    # A random number generator for each block of samples, spawned from
+    # seed, so that the frequencies drawn don't depend on the order that the
+    # blocks are converted in (or the number of threads converting them).
+    if rounding != 'multinomial':
+        return [None] * n_blocks
+    return [np.random.default_rng(block_seed)
+            for block_seed in np.random.SeedSequence(seed).spawn(n_blocks)]
+
+
+def _map_blocks(function, starts, generators, n_threads):
+    # Call function for each block, in n_threads threads. numpy releases the
+    # GIL while it converts a block.
+    if n_threads == 1:
+        for start, generator in zip(starts, generators):
+            function(start, generator)
+        return
+    with concurrent.futures.ThreadPoolExecutor(n_threads) as executor:
+        list(executor.map(function, starts, generators))
+
+
+def multinomial(values, total, generator):
+    """Draw total counts for each row of values from a multinomial
+
+    The probabilities of each row are its values divided by their sum, and
+    the counts are drawn with ``generator`` (a numpy.random.Generator) for
+    all rows at once. Rows without any non-zero values stay zero.
+    """
+    # The rows are summed from a C-contiguous copy, as sums over strided
+    # rows (e.g., of a selection of columns) can differ in their last bit,
+    # which changes the counts drawn.
+    values = np.ascontiguousarray(values, dtype=np.float64)
+    sums = values.sum(axis=1, keepdims=True)
+    pvals = np.divide(values, sums, out=np.zeros_like(values),
+                      where=sums > 0)
+    return generator.multinomial(np.where(sums[:, 0] > 0, total, 0), pvals)
+
+
+def _sparse_largest_remainder(data, indices, indptr, total):
+    # Apportion total between the stored values of each column of a CSC
+    # matrix, whose values are data[indptr[i]:indptr[i + 1]] for column i,
+    # in the rows indices[indptr[i]:indptr[i + 1]]. Each column is scaled to
+    # sum to total and floored, and the counts that remain are given to the
+    # values with the largest remainders (Hamilton's method), so that each
+    # column sums to exactly total. Columns without any non-zero values stay
+    # zero.
+    # The columns have different numbers of values, so the values are
+    # sorted by their column, then by their remainder and then by their row
+    # (so that equal remainders are given counts from the first row on),
+    # and the first remaining[i] of column i are selected.
+    n_values = np.diff(indptr)
+    columns = np.repeat(np.arange(len(n_values)), n_values)
+    sums = np.bincount(columns, weights=data, minlength=len(n_values))
+    scale = np.divide(total, sums, out=np.zeros(len(sums)), where=sums > 0)
+    scaled = data * scale[columns]
+    counts = np.floor(scaled)
+    remainders = np.subtract(scaled, counts, out=scaled)
+    remaining = np.where(
+        sums > 0,
+        np.rint(total - np.bincount(columns, weights=counts,
+                                    minlength=len(n_values))), 0)
+    remaining = np.clip(remaining, 0, n_values).astype(np.intp)
+
+    order = np.lexsort((indices, -remainders, columns))
+    sorted_columns = columns[order]
+    ranks = np.arange(len(data)) - indptr[sorted_columns]
+    counts[order[ranks < remaining[sorted_columns]]] += 1
+    return counts
+
+
+def _sparse_multinomial(matrix, total, seed, n_threads):
+    # The multinomial rounding of a CSC matrix of samples (columns), whose
+    # blocks of samples are densified over the features with non-zero values
+    # in the block. The frequencies of each block are drawn with a generator
+    # spawned from seed, so they don't depend on n_threads.
+    n_features, n_samples = matrix.shape
+    block_size = _block_size(n_features)
+    starts = range(0, n_samples, block_size)
+    blocks = {}
+
+    def convert(start, generator):
+        block = matrix[:, start:start + block_size]
+        features = np.unique(block.indices[block.data != 0])
+        if len(features) == 0:
+            return
+        frequencies = multinomial(block[features].T.toarray(), total,
+                                  generator)
+        samples, block_features = np.nonzero(frequencies)
+        blocks[start] = (frequencies[samples, block_features],
+                         features[block_features], samples + start)
+
+    _map_blocks(convert, starts,
+                _block_generators('multinomial', seed, len(starts)),
+                n_threads)
+    blocks = [blocks[start] for start in sorted(blocks)]
+    data, rows, columns = ([np.concatenate(arrays) for arrays in zip(*blocks)]
+                           if blocks else
+                           [np.zeros(0, dtype=np.intp)] * 3)
+    return scipy.sparse.coo_matrix(
+        (data.astype(np.float64), (rows, columns)),
+        shape=matrix.shape).tocsr()
+
+
+def sparse_to_frequencies(matrix, target_freq, rounding=DEFAULT_ROUNDING,
+                          seed=DEFAULT_SEED, n_threads=1):
+    """Return a sparse matrix of relative frequencies as whole frequencies
+
+    ``matrix`` is a scipy.sparse matrix of the relative frequencies (in
+    percent) of the features (rows) of each sample (columns), as in a
+    biom.Table, which are scaled to ``target_freq`` and rounded with
+    ``rounding`` (one of ROUNDINGS). Only the stored (non-zero) values are
+    converted, except by the multinomial rounding, which draws the
+    frequencies of blocks of samples with generators spawned from ``seed``
+    (in ``n_threads`` threads), only from the features with non-zero values
+    in each block. Frequencies that are rounded to zero are removed from the
+    returned scipy.sparse.csr_matrix. The frequencies are float64 whole
+    numbers, as biom.Table stores its values as float64.
+    """
+    check_rounding(rounding)
+    matrix = scipy.sparse.csc_matrix(matrix)
+    matrix.sum_duplicates()
+    if rounding == 'multinomial':
+        return _sparse_multinomial(matrix, target_freq, seed, n_threads)
+    if rounding == 'round':
+        frequencies = np.rint(matrix.data * (target_freq / 100))
+    else:
+        frequencies = _sparse_largest_remainder(
+            matrix.data.astype(np.float64, copy=False), matrix.indices,
+            matrix.indptr, target_freq)
+    # The conversion to CSR copies the indices, so removing the zeros
+    # doesn't change those of the input matrix.
+    result = scipy.sparse.csc_matrix(
+        (frequencies, matrix.indices, matrix.indptr),
+        shape=matrix.shape).tocsr()
+    result.eliminate_zeros()
+    return result
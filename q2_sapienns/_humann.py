@@ -6,55 +6,123 @@
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
 
+import biom
 import pandas as pd
+from qiime2 import Metadata
+
+from ._reader import (DEFAULT_PRECISION, TableChunks,
+                      load_sparse_humann_strata, load_sparse_humann_table)
+from ._samples import (requested_samples, resolve_samples,
+                       strip_units_from_ids)
+from ._strata import STRATIFIED, taxonomy
+
+
+def _resolve_samples(table, strip_units_from_sample_ids, sample_ids,
+                     sample_metadata):
+    # The requested samples are resolved to the sample ids in the table
+    # (i.e., before their units are removed), so that only their columns
+    # are loaded. The ids without units are found from the header too, so
+    # that duplicates are reported before the table is read.
+    table_sample_ids = table.sample_ids()
+    samples = resolve_samples(
+        requested_samples(sample_ids, sample_metadata),
+        table_sample_ids, strip_units_from_sample_ids)
+    if not strip_units_from_sample_ids:
+        return samples, None
+    return samples, strip_units_from_ids(
+        table_sample_ids if samples is None else samples)
+
+
+def _outputs(table, stripped_sample_ids):
+    # Generate the taxonomy result
+    taxa = taxonomy(table.ids(axis='observation'), delimiters=('|', '.'))
 
+    # The sample ids of the table are renamed in place, without copying its
+    # data.
+    if stripped_sample_ids is not None:
+        table.update_ids(stripped_sample_ids, axis='sample', inplace=True)
 
-def _humann(table, strip_units_from_sample_ids, destratify):
-
-    table = table.reset_index()
+    return table, taxa
 
-    table['unstratified'] = table.apply(
-        lambda x: '|' not in x['feature-id'], axis=1)
-    if destratify:
-        table = table[table['unstratified']]
-    else:
-        table = table[~table['unstratified']]
-    table = table.drop('unstratified', axis=1)
 
-    # Generate the taxonomy result
-    taxonomy = table[['feature-id']].copy()
-    taxonomy['Taxon'] = taxonomy.apply(
-        lambda x: x['feature-id'].replace('|', '; ').replace('.', '; '),
-        axis=1)
+def _humann(table, strip_units_from_sample_ids, destratify, precision,
+            sample_ids, sample_metadata):
+    samples, stripped_sample_ids = _resolve_samples(
+        table, strip_units_from_sample_ids, sample_ids, sample_metadata)
 
-    taxonomy = taxonomy.set_index('feature-id')
-    taxonomy.index.name = 'Feature ID'
+    # The unstratified or stratified features are loaded as a new (sparse)
+    # biom.Table, which is built from the table's chunks as they are read,
+    # so the table is never held as a dense table. The lines of the other
+    # features are dropped before their values are parsed.
+    table = load_sparse_humann_table(
+        table, precision, 1 if destratify else STRATIFIED, samples)
+    return _outputs(table, stripped_sample_ids)
 
-    # Generate the table
-    table = table.set_index('feature-id')
-    table = table.T
-    table.index.name = 'sample-id'
 
-    if strip_units_from_sample_ids:
-        table = table.reset_index()
+def _humann_strata(table, strip_units_from_sample_ids, precision,
+                   sample_ids, sample_metadata, action):
+    samples, stripped_sample_ids = _resolve_samples(
+        table, strip_units_from_sample_ids, sample_ids, sample_metadata)
 
-        table['sample-id'] = table.apply(
-            lambda x: x['sample-id'].rsplit('_', 1)[0], axis=1)
+    # The table is read once, and each feature is added to the (sparse)
+    # biom.Table of its stratum, rather than reading it once with and once
+    # without destratify.
+    unstratified, stratified = load_sparse_humann_strata(table, precision,
+                                                         samples)
 
-        table = table.set_index('sample-id')
-
-    return table, taxonomy
+    # The taxonomy of a stratum without features couldn't be saved, so that
+    # is reported before any output is.
+    for stratum, stratum_table in [('stratified', stratified),
+                                   ('un-stratified', unstratified)]:
+        if stratum_table.shape[0] == 0:
+            raise ValueError('No %s features were found. Use %s to prepare '
+                             'the features of the other stratum.' %
+                             (stratum, action))
+    return (_outputs(stratified, stripped_sample_ids) +
+            _outputs(unstratified, stripped_sample_ids))
 
 
 def humann_pathway(
-        pathway_table: pd.DataFrame,
+        pathway_table: TableChunks,
         strip_units_from_sample_ids: bool = True,
-        destratify: bool = False) -> (pd.DataFrame, pd.DataFrame):
-    return _humann(pathway_table, strip_units_from_sample_ids, destratify)
+        destratify: bool = False,
+        precision: str = DEFAULT_PRECISION,
+        sample_ids: list = None,
+        sample_metadata: Metadata = None) -> (biom.Table, pd.DataFrame):
+    return _humann(pathway_table, strip_units_from_sample_ids, destratify,
+                   precision, sample_ids, sample_metadata)
 
 
 def humann_genefamily(
-        genefamily_table: pd.DataFrame,
+        genefamily_table: TableChunks,
+        strip_units_from_sample_ids: bool = True,
+        destratify: bool = False,
+        precision: str = DEFAULT_PRECISION,
+        sample_ids: list = None,
+        sample_metadata: Metadata = None) -> (biom.Table, pd.DataFrame):
+    return _humann(genefamily_table, strip_units_from_sample_ids, destratify,
+                   precision, sample_ids, sample_metadata)
+
+
+def humann_pathway_strata(
+        pathway_table: TableChunks,
+        strip_units_from_sample_ids: bool = True,
+        precision: str = DEFAULT_PRECISION,
+        sample_ids: list = None,
+        sample_metadata: Metadata = None) \
+        -> (biom.Table, pd.DataFrame, biom.Table, pd.DataFrame):
+    return _humann_strata(pathway_table, strip_units_from_sample_ids,
+                          precision, sample_ids, sample_metadata,
+                          'humann-pathway')
+
+
+def humann_genefamily_strata(
+        genefamily_table: TableChunks,
         strip_units_from_sample_ids: bool = True,
-        destratify: bool = False) -> (pd.DataFrame, pd.DataFrame):
-    return _humann(genefamily_table, strip_units_from_sample_ids, destratify)
+        precision: str = DEFAULT_PRECISION,
+        sample_ids: list = None,
+        sample_metadata: Metadata = None) \
+        -> (biom.Table, pd.DataFrame, biom.Table, pd.DataFrame):
+    return _humann_strata(genefamily_table, strip_units_from_sample_ids,
+                          precision, sample_ids, sample_metadata,
+                          'humann-genefamily')
@@ -6,45 +6,95 @@
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
 
+import biom
 import pandas as pd
+from qiime2 import Metadata
 
+from ._frequency import (DEFAULT_ROUNDING, DEFAULT_SEED,
+                         sparse_to_frequencies)
+from ._reader import (DEFAULT_PRECISION, TableChunks,
+                      load_sparse_metaphlan_levels,
+                      load_sparse_metaphlan_table)
+from ._samples import requested_samples, resolve_samples
+from ._strata import taxonomy
 
-def metaphlan_taxon(
-        stratified_table: pd.DataFrame, level: int)\
-        -> (pd.DataFrame, pd.DataFrame):
-
-    stratified_table = stratified_table.reset_index()
 
-    # Add a column indicating the number of levels contained in each
-    # feature id.
-    stratified_table['n levels'] = stratified_table.apply(
-        lambda x: len(x['feature-id'].split('|')), axis=1)
+def metaphlan_taxon(
+        stratified_table: TableChunks,
+        level: int,
+        precision: str = DEFAULT_PRECISION,
+        sample_ids: list = None,
+        sample_metadata: Metadata = None) -> (biom.Table, pd.DataFrame):
 
-    # Drop features where number of levels is not equal to what was requested
-    # by the user to "de-stratify" the table.
-    table = stratified_table[stratified_table['n levels'] == level]
+    # Select features where number of levels is equal to what was requested
+    # by the user to "de-stratify" the table. The selected features are
+    # loaded as a new (sparse) biom.Table, which is built from the table's
+    # chunks as they are read, so the table is never held as a dense table.
+    # The lines of other features are dropped before their values are
+    # parsed, as are the columns of samples that weren't requested.
+    samples = resolve_samples(
+        requested_samples(sample_ids, sample_metadata),
+        stratified_table.sample_ids())
+    table = load_sparse_metaphlan_table(stratified_table, precision, level,
+                                        samples)
     if table.shape[0] == 0:
         raise ValueError('No features contained exactly %d taxonomic '
                          'levels.' % level)
 
     # Generate the taxonomy result
-    taxonomy = table['feature-id'].to_frame()
-    taxonomy['Taxon'] = taxonomy.apply(
-        lambda x: x['feature-id'].replace('|', '; '), axis=1)
-    taxonomy = taxonomy.set_index('feature-id')
-    taxonomy.index.name = 'Feature ID'
-
-    table = table.drop(['NCBI_tax_id', 'n levels'], errors='ignore', axis=1)
-    table = table.set_index('feature-id')
-    table = table.T
-    table.index.name = 'sample-id'
-
-    return table, taxonomy
-
-
-def frequency(table: pd.DataFrame, target_freq: int = 100000) -> pd.DataFrame:
-    target_freq /= 100
-    result = table * target_freq
-    result = result.round(0)
-    result = result.astype(int)
-    return result
+    return table, taxonomy(table.ids(axis='observation'))
+
+
+# The taxonomic ranks of the levels of MetaPhlAn tables.
+LEVELS = ('kingdom', 'phylum', 'class', 'order', 'family', 'genus',
+          'species', 'strain')
+
+# The levels that metaphlan_levels splits tables into, which name its
+# outputs. MetaPhlAn 3 doesn't report strains by default, and an empty
+# taxonomy can't be saved as FeatureData[Taxonomy], so strains are only
+# selected with metaphlan_taxon.
+SPLIT_LEVELS = LEVELS[:-1]
+
+
+def metaphlan_levels(
+        stratified_table: TableChunks,
+        precision: str = DEFAULT_PRECISION,
+        sample_ids: list = None,
+        sample_metadata: Metadata = None) \
+        -> (biom.Table, pd.DataFrame) * len(SPLIT_LEVELS):
+
+    # The table is read once, and each feature is added to the table of its
+    # level, rather than reading it once per level as metaphlan_taxon would.
+    samples = resolve_samples(
+        requested_samples(sample_ids, sample_metadata),
+        stratified_table.sample_ids())
+    tables = load_sparse_metaphlan_levels(stratified_table, precision,
+                                          samples)
+
+    # A table and taxonomy for each level. The taxonomy of a level without
+    # features couldn't be saved, so that is reported before any output is.
+    empty_levels = [LEVELS[level - 1]
+                    for level in range(1, len(SPLIT_LEVELS) + 1)
+                    if level not in tables or tables[level].shape[0] == 0]
+    if empty_levels:
+        raise ValueError('No features were found at the %s level(s). '
+                         'Use metaphlan-taxon to select the levels that '
+                         'are in the table.' % ', '.join(empty_levels))
+    results = []
+    for level in range(1, len(SPLIT_LEVELS) + 1):
+        table = tables[level]
+        results.extend([table, taxonomy(table.ids(axis='observation'))])
+    return tuple(results)
+
+
+def frequency(table: biom.Table, target_freq: int = 100000,
+              rounding: str = DEFAULT_ROUNDING,
+              seed: int = DEFAULT_SEED,
+              n_threads: int = 1) -> biom.Table:
+    # Only the stored (non-zero) relative frequencies are converted, and the
+    # frequencies that are rounded to zero are dropped, so the table is
+    # never held as a dense table.
+    return biom.Table(
+        sparse_to_frequencies(table.matrix_data, target_freq, rounding,
+                              seed, n_threads),
+        table.ids(axis='observation'), table.ids(axis='sample'))
@@ -0,0 +1,745 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2022, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import functools
+import os
+
+import biom
+import numpy as np
+import pandas as pd
+import scipy.sparse
+
+try:
+    import pyarrow
+    import pyarrow.csv
+    import pyarrow.ipc
+except ImportError:
+    pyarrow = None
+
+from ._format import (SIDECAR_FILENAME, MetaphlanMergedAbundanceFormat,
+                      _ArrowDirectoryFormat)
+from ._sparse import CSRBuilder
+from ._strata import STRATIFIED, level_counts, level_mask, open_level
+from ._validation import CHUNK_SIZE
+
+# Floating point precisions that abundance values can be loaded with.
+# float32 halves the memory needed to hold a table, and rounds each value
+# to the nearest float32, i.e. to about 7 significant digits (a relative
+# error of at most FLOAT32_RELATIVE_ERROR).
+PRECISIONS = {'float64': np.float64, 'float32': np.float32}
+DEFAULT_PRECISION = 'float64'
+FLOAT32_RELATIVE_ERROR = float(np.finfo(np.float32).eps) / 2
+
+# Environment variable defining the precision used by the transformers to
+# pd.DataFrame, which (unlike the actions) can't be passed parameters.
+PRECISION_ENV_VAR = 'Q2_SAPIENNS_PRECISION'
+
+# Non-abundance columns of MetaPhlAn merged abundance tables.
+METAPHLAN_ID_COLUMNS = ('NCBI_tax_id',)
+
+# Environment variable selecting how tables are parsed: with pyarrow's
+# multithreaded CSV reader (the default, if pyarrow is installed) or with
+# pd.read_csv.
+READER_ENV_VAR = 'Q2_SAPIENNS_READER'
+READERS = ('pyarrow', 'pandas')
+
+# Environment variable defining the number of rows in the chunks that the
+# TableChunks transformers read tables in.
+CHUNK_SIZE_ENV_VAR = 'Q2_SAPIENNS_CHUNK_SIZE'
+
+# Bounds of the size (in bytes) of the blocks that pyarrow reads tables in.
+# Every row must fit in a block, so the size of blocks is estimated from the
+# lengths of the header and first rows, and increased if a longer row is
+# found. pyarrow's block size is a 32-bit integer.
+MIN_ARROW_BLOCK_SIZE = 1024 ** 2
+MAX_ARROW_BLOCK_SIZE = 2 ** 30
+
+
+def precision_dtype(precision):
+    """Return the numpy dtype for precision ('float64' or 'float32')"""
+    try:
+        return PRECISIONS[precision]
+    except KeyError:
+        raise ValueError('Precision must be one of %s. Found: %s' %
+                         (', '.join(PRECISIONS), precision))
+
+
+def default_precision():
+    """Return the precision configured with Q2_SAPIENNS_PRECISION"""
+    precision = os.environ.get(PRECISION_ENV_VAR) or DEFAULT_PRECISION
+    if precision not in PRECISIONS:
+        raise ValueError('%s must be one of %s. Found: %s' %
+                         (PRECISION_ENV_VAR, ', '.join(PRECISIONS),
+                          precision))
+    return precision
+
+
+def default_chunk_size():
+    """Return the chunk size configured with Q2_SAPIENNS_CHUNK_SIZE"""
+    value = os.environ.get(CHUNK_SIZE_ENV_VAR) or str(CHUNK_SIZE)
+    try:
+        chunk_size = int(value)
+    except ValueError:
+        raise ValueError('%s must be an integer. Found: %s' %
+                         (CHUNK_SIZE_ENV_VAR, value))
+    if chunk_size < 1:
+        raise ValueError('%s must be at least 1. Found: %d' %
+                         (CHUNK_SIZE_ENV_VAR, chunk_size))
+    return chunk_size
+
+
+def table_reader():
+    """Return the reader configured with Q2_SAPIENNS_READER"""
+    reader = os.environ.get(READER_ENV_VAR)
+    if not reader:
+        return 'pandas' if pyarrow is None else 'pyarrow'
+    if reader not in READERS:
+        raise ValueError('%s must be one of %s. Found: %s' %
+                         (READER_ENV_VAR, ', '.join(READERS), reader))
+    if reader == 'pyarrow' and pyarrow is None:
+        raise ValueError('The pyarrow package must be installed to use the '
+                         'pyarrow reader.')
+    return reader
+
+
+def _cast_values(table, dtype, id_columns):
+    dtypes = {column: dtype for column in table.columns
+              if column not in id_columns and table[column].dtype != dtype}
+    if dtypes:
+        table = table.astype(dtypes, copy=False)
+    return table
+
+
+def _read_csv(ff, level=None, **kwargs):
+    if ff._compressed or level is not None:
+        with _open_binary(ff, level, kwargs.get('comment')) as fh:
+            return pd.read_csv(fh, sep='\t', header=0, index_col=0, **kwargs)
+    return pd.read_csv(str(ff), sep='\t', header=0, index_col=0, **kwargs)
+
+
+def _open_binary(ff, level=None, comment=None):
+    # If level is provided, only the rows of features with level levels are
+    # read, so that the others are never parsed. comment is the prefix of
+    # the comment lines preceding the header, as for pd.read_csv.
+    if ff._compressed:
+        fh = ff.open_binary()
+    else:
+        fh = open(str(ff), 'rb')
+    if level is not None:
+        fh = open_level(fh, level, comment)
+    return fh
+
+
+def _sample_columns(columns, id_columns, samples):
+    # Return the columns (other than the index) that are loaded if samples
+    # are selected, in the order of the table.
+    samples = set(samples)
+    return [column for column in columns
+            if column in id_columns or column in samples]
+
+
+def _usecols(ff, id_columns, samples, **kwargs):
+    # Return the usecols argument of pd.read_csv for loading samples.
+    if samples is None:
+        return None
+    header = _read_csv(ff, nrows=0, **kwargs)
+    return [header.index.name] + _sample_columns(header.columns,
+                                                 id_columns, samples)
+
+
+def _select_level(table, level):
+    # Select the rows of a table that was parsed before level was known.
+    if level is None:
+        return table
+    return table[level_mask(table.index, level)]
+
+
+def _arrow_block_size(fh, header_line, chunk_size):
+    # The size of blocks holding about chunk_size rows of the length of the
+    # longest of the header and the complete rows buffered in fh (the
+    # values of wide tables can be longer than their sample ids), and at
+    # least a few of them.
+    rows = fh.peek().split(b'\n')[:-1]
+    row_size = max([len(header_line)] + [len(row) + 1 for row in rows])
+    block_size = max(chunk_size * row_size, 4 * row_size,
+                     MIN_ARROW_BLOCK_SIZE)
+    return min(block_size, MAX_ARROW_BLOCK_SIZE)
+
+
+def _arrow_options(fh, dtype, id_columns, comment, id_type=None,
+                   samples=None, chunk_size=None, block_size=None):
+    # Read the header from fh, and return the options for reading the rest
+    # of the table from fh with pyarrow. pyarrow has no equivalent of
+    # pd.read_csv's comment parameter, so comment lines are only skipped
+    # before the header. The types of id_columns are inferred unless id_type
+    # is provided, which it must be when reading in blocks, as each block's
+    # types would otherwise be inferred from the first block. If samples are
+    # provided, only their columns are converted. If chunk_size is provided,
+    # the table is read in blocks of about chunk_size rows, or of block_size
+    # bytes if that's larger.
+    header_line = fh.readline()
+    while comment is not None and \
+            header_line.startswith(comment.encode('utf-8')):
+        header_line = fh.readline()
+    read_options = {}
+    if chunk_size is not None:
+        read_options['block_size'] = max(
+            _arrow_block_size(fh, header_line, chunk_size), block_size or 0)
+    columns = header_line.rstrip(b'\r\n').decode('utf-8').split('\t')
+    column_types = {column: pyarrow.from_numpy_dtype(dtype)
+                    for column in columns[1:]
+                    if column not in id_columns}
+    if id_type is not None:
+        column_types.update((column, id_type) for column in id_columns
+                            if column in columns)
+    column_types[columns[0]] = pyarrow.string()
+    include_columns = []
+    if samples is not None:
+        include_columns = [columns[0]] + _sample_columns(
+            columns[1:], id_columns, samples)
+    return {
+        'read_options': pyarrow.csv.ReadOptions(
+            use_threads=True, column_names=columns, **read_options),
+        'parse_options': pyarrow.csv.ParseOptions(delimiter='\t'),
+        'convert_options': pyarrow.csv.ConvertOptions(
+            column_types=column_types, strings_can_be_null=True,
+            include_columns=include_columns)}
+
+
+def _arrow_to_dataframe(table):
+    index = pd.Index(table.column(0).to_numpy(zero_copy_only=False),
+                     name='feature-id')
+    table = table.remove_column(0)
+    result = table.to_pandas(split_blocks=True, self_destruct=True)
+    result.index = index
+    return result
+
+
+def _empty_arrow_table(options):
+    # pyarrow can't read a table without rows, so build it from the
+    # options instead.
+    column_types = options['convert_options'].column_types
+    columns = (options['convert_options'].include_columns or
+               options['read_options'].column_names)
+    return pyarrow.table({
+        column: pyarrow.array([], column_types.get(column, pyarrow.string()))
+        for column in columns})
+
+
+def _read_arrow(ff, dtype, id_columns, comment=None, level=None,
+                samples=None):
+    # Read the table with pyarrow, producing the same DataFrame as
+    # _read_csv. pyarrow parses floats with correct rounding, i.e. like
+    # pd.read_csv(float_precision='round_trip') and float(), where the
+    # default pd.read_csv parser can differ in the least significant bit.
+    # The table is parsed by several threads, in blocks of a few rows (and
+    # at least MIN_ARROW_BLOCK_SIZE bytes). If a row doesn't fit in a block,
+    # the table is read again with larger blocks, as in _arrow_batches.
+    block_size = None
+    while True:
+        try:
+            with _open_binary(ff, level, comment) as fh:
+                options = _arrow_options(fh, dtype, id_columns, comment,
+                                         samples=samples, chunk_size=1,
+                                         block_size=block_size)
+                block_size = options['read_options'].block_size
+                if fh.peek(1):
+                    table = pyarrow.csv.read_csv(fh, **options)
+                else:
+                    table = _empty_arrow_table(options)
+            return _arrow_to_dataframe(table)
+        except pyarrow.ArrowInvalid as e:
+            if not _straddles_blocks(e) or \
+                    block_size >= MAX_ARROW_BLOCK_SIZE:
+                raise
+            block_size = min(4 * block_size, MAX_ARROW_BLOCK_SIZE)
+
+
+def _iter_arrow(ff, dtype, id_columns, chunk_size, comment=None,
+                level=None, samples=None):
+    # pyarrow reads blocks of bytes rather than of rows, so the batches
+    # parsed from them are sliced into chunks of at most chunk_size rows.
+    for batch in _arrow_batches(ff, dtype, id_columns, chunk_size, comment,
+                                level, samples):
+        for offset in range(0, batch.num_rows, chunk_size):
+            yield _arrow_to_dataframe(pyarrow.Table.from_batches(
+                [batch.slice(offset, chunk_size)]))
+
+
+def _straddles_blocks(error):
+    # Whether error was raised by pyarrow because a row is longer than a
+    # block.
+    return 'straddl' in str(error)
+
+
+def _arrow_batches(ff, dtype, id_columns, chunk_size, comment=None,
+                   level=None, samples=None):
+    # Yield the record batches of the table read with pyarrow in blocks of
+    # about chunk_size rows (see _arrow_options). If a row doesn't fit in a
+    # block, the table is read again with larger blocks, skipping the rows
+    # that were already yielded. An empty batch is yielded for a table
+    # without rows, so that the schema of the table is known.
+    n_rows = 0
+    block_size = None
+    while True:
+        try:
+            with _open_binary(ff, level, comment) as fh:
+                options = _arrow_options(
+                    fh, dtype, id_columns, comment, id_type=pyarrow.string(),
+                    samples=samples, chunk_size=chunk_size,
+                    block_size=block_size)
+                block_size = options['read_options'].block_size
+                if not fh.peek(1):
+                    schema = _empty_arrow_table(options).schema
+                    yield pyarrow.RecordBatch.from_pylist([], schema=schema)
+                    return
+                skip = n_rows
+                for batch in pyarrow.csv.open_csv(fh, **options):
+                    if skip >= batch.num_rows:
+                        skip -= batch.num_rows
+                        continue
+                    batch, skip = batch.slice(skip), 0
+                    n_rows += batch.num_rows
+                    yield batch
+            return
+        except pyarrow.ArrowInvalid as e:
+            if not _straddles_blocks(e) or \
+                    block_size >= MAX_ARROW_BLOCK_SIZE:
+                raise
+            block_size = min(4 * block_size, MAX_ARROW_BLOCK_SIZE)
+
+
+def _columnar(ff):
+    # Return the path of the Arrow sidecar that ff can be loaded from (or
+    # None, if there is none or it doesn't match the table), and the format
+    # of its table.
+    if isinstance(ff, _ArrowDirectoryFormat):
+        return ff.current_sidecar_path(), ff.table_format()
+    return None, ff
+
+
+def _open_sidecar(filepath):
+    # The file is memory-mapped, so that its float64 columns are converted
+    # to DataFrame columns without copying them.
+    return pyarrow.ipc.open_file(pyarrow.memory_map(filepath, 'r'))
+
+
+def _infer_id_types(table, id_columns):
+    # id_columns are stored as strings in the sidecar (see write_sidecar),
+    # so convert them as pd.read_csv would have.
+    for column in id_columns:
+        if column in table.columns:
+            try:
+                table[column] = pd.to_numeric(table[column])
+            except ValueError:
+                pass
+    return table
+
+
+def _select_arrow_samples(table, id_columns, samples):
+    # The columns of other samples are never converted to DataFrame columns.
+    if samples is None:
+        return table
+    columns = table.schema.names
+    return table.select([columns[0]] + _sample_columns(
+        columns[1:], id_columns, samples))
+
+
+def _read_sidecar(filepath, dtype, id_columns, level=None, samples=None):
+    table = _select_arrow_samples(_open_sidecar(filepath).read_all(),
+                                  id_columns, samples)
+    table = _arrow_to_dataframe(table)
+    table = _select_level(_infer_id_types(table, id_columns), level)
+    return _cast_values(table, dtype, id_columns)
+
+
+def _iter_sidecar(filepath, dtype, id_columns, chunk_size, level=None,
+                  samples=None):
+    # The record batches are sliced (without copying them) into chunks of
+    # chunk_size rows.
+    reader = _open_sidecar(filepath)
+    for i in range(reader.num_record_batches):
+        batch = reader.get_batch(i)
+        for offset in range(0, batch.num_rows, chunk_size):
+            chunk = _select_arrow_samples(
+                pyarrow.Table.from_batches(
+                    [batch.slice(offset, chunk_size)]),
+                id_columns, samples)
+            chunk = _arrow_to_dataframe(chunk)
+            yield _cast_values(_select_level(chunk, level), dtype,
+                               id_columns)
+
+
+def _write_sidecar(ff, filepath, id_columns, metadata, comment=None):
+    batches = _arrow_batches(ff, np.float64, id_columns, CHUNK_SIZE,
+                             comment)
+    # The first batch is empty if the table has no rows.
+    first_batch = next(batches)
+    schema = first_batch.schema.with_metadata(metadata)
+    with pyarrow.ipc.new_file(filepath, schema) as writer:
+        if first_batch.num_rows:
+            writer.write_batch(first_batch)
+        for batch in batches:
+            writer.write_batch(batch)
+
+
+def write_sidecar(df):
+    """Write the Arrow sidecar of an *Arrow* directory format
+
+    The table is parsed (as float64 values) in blocks, which are written to
+    the sidecar as they are parsed. The size and digest of the table are
+    recorded in the sidecar's schema metadata (see
+    _ArrowDirectoryFormat.table_metadata), so that a sidecar that doesn't
+    match the table is ignored. Nothing is written if pyarrow isn't
+    installed, in which case the table is parsed whenever it is loaded.
+    """
+    if pyarrow is None:
+        return
+    ff = df.table_format()
+    filepath = os.path.join(str(df), SIDECAR_FILENAME)
+    metadata = df.table_metadata()
+    if isinstance(ff, MetaphlanMergedAbundanceFormat):
+        _write_sidecar(ff, filepath, METAPHLAN_ID_COLUMNS, metadata,
+                       comment='#')
+    else:
+        _write_sidecar(ff, filepath, (), metadata)
+
+
+def _iter_csv(ff, dtype, id_columns, chunk_size, level=None, samples=None,
+              **kwargs):
+    columns = _read_csv(ff, nrows=0, **kwargs).columns
+    dtypes = {column: dtype for column in columns
+              if column not in id_columns}
+    usecols = _usecols(ff, id_columns, samples, **kwargs)
+    with _open_binary(ff, level, kwargs.get('comment')) as fh, \
+            pd.read_csv(fh, sep='\t', header=0, index_col=0, dtype=dtypes,
+                        usecols=usecols, chunksize=chunk_size,
+                        **kwargs) as reader:
+        for chunk in reader:
+            chunk.index.name = 'feature-id'
+            yield chunk
+
+
+def iter_table_chunks(ff, dtype=np.float64, id_columns=(),
+                      chunk_size=CHUNK_SIZE, level=None, samples=None,
+                      **kwargs):
+    """Yield a table format as DataFrames of consecutive rows
+
+    Each DataFrame is like a slice of the DataFrame loaded by
+    read_humann_table or read_metaphlan_table (to which ``id_columns`` and
+    ``kwargs`` are passed), of about ``chunk_size`` rows. The whole table is
+    never held in memory. If ``level`` is provided, only the features with
+    ``level`` levels are included (see read_metaphlan_table), and if
+    ``samples`` are, only their columns (see read_humann_table).
+    """
+    sidecar, ff = _columnar(ff)
+    if sidecar is not None:
+        yield from _iter_sidecar(sidecar, dtype, id_columns, chunk_size,
+                                 level, samples)
+        return
+    if table_reader() == 'pyarrow':
+        yield from _iter_arrow(ff, dtype, id_columns, chunk_size,
+                               level=level, samples=samples, **kwargs)
+    else:
+        yield from _iter_csv(ff, dtype, id_columns, chunk_size,
+                             level=level, samples=samples, **kwargs)
+
+
+def _read_table(ff, dtype, id_columns, level=None, samples=None, **kwargs):
+    sidecar, ff = _columnar(ff)
+    if sidecar is not None:
+        return _read_sidecar(sidecar, dtype, id_columns, level, samples)
+    if table_reader() == 'pyarrow':
+        return _read_arrow(ff, dtype, id_columns, level=level,
+                           samples=samples, **kwargs)
+    # The header is read first so that the abundance values can be parsed
+    # directly into dtype, rather than as float64 and then cast.
+    columns = _read_csv(ff, nrows=0, **kwargs).columns
+    dtypes = {column: dtype for column in columns
+              if column not in id_columns}
+    result = _read_csv(ff, level=level, dtype=dtypes,
+                       usecols=_usecols(ff, id_columns, samples, **kwargs),
+                       **kwargs)
+    result.index.name = 'feature-id'
+    return result
+
+
+def read_humann_table(ff, dtype=np.float64, samples=None):
+    """Load a HUMAnN table format as a DataFrame of dtype values
+
+    If ``samples`` (sample ids, as they are in the table's header) are
+    provided, only their columns are loaded. The values of other samples
+    are never parsed.
+    """
+    return _read_table(ff, dtype, (), samples=samples)
+
+
+def read_metaphlan_table(ff, dtype=np.float64, level=None, samples=None):
+    """Load a MetaPhlAn merged abundance format as a DataFrame
+
+    Abundances are loaded as ``dtype`` values, and other columns (i.e.,
+    NCBI_tax_id) as they would be by pd.read_csv. If ``level`` is provided,
+    only the features with exactly ``level`` taxonomic levels are loaded.
+    The lines of other features are dropped as the table is read, before
+    their values are parsed. ``samples`` are as for read_humann_table.
+    """
+    return _read_table(ff, dtype, METAPHLAN_ID_COLUMNS, level=level,
+                       samples=samples, comment='#')
+
+
+def empty_table(sample_ids):
+    """Return a biom.Table of sample_ids without any features"""
+    # biom.Table drops the sample ids of a dense (0, 1) array.
+    return biom.Table(scipy.sparse.csr_matrix((0, len(sample_ids))), [],
+                      sample_ids)
+
+
+def _empty_sparse_table(ff, id_columns, samples, **kwargs):
+    sample_ids = _table_sample_ids(ff, id_columns, **kwargs)
+    if samples is not None:
+        sample_ids = _sample_columns(sample_ids, (), samples)
+    return empty_table(sample_ids)
+
+
+def _group_rows(groups):
+    # Yield each group, and the (ascending) indices of its rows.
+    order = np.argsort(groups, kind='stable')
+    unique, starts = np.unique(groups[order], return_index=True)
+    ends = np.append(starts[1:], len(groups))
+    for group, start, end in zip(unique.tolist(), starts, ends):
+        yield group, order[start:end]
+
+
+def _build_sparse_table(chunks, dtype, id_columns, select):
+    # Build a biom.Table of the selected rows of DataFrame chunks, or return
+    # None if there were no chunks. Only the values of the sample columns
+    # of the selected rows are copied from each chunk.
+    feature_ids = []
+    builder = None
+    for chunk in chunks:
+        if builder is None:
+            sample_ids = chunk.columns.drop(
+                [column for column in id_columns
+                 if column in chunk.columns])
+            columns = chunk.columns.get_indexer(sample_ids)
+            builder = CSRBuilder(len(sample_ids), dtype)
+        rows = slice(None) if select is None else \
+            np.flatnonzero(select(chunk.index))
+        feature_ids.append(chunk.index.to_numpy()[rows])
+        builder.add_rows(
+            chunk.iloc[rows, columns].to_numpy(dtype=dtype, copy=False))
+    if builder is None:
+        return None
+    return biom.Table(builder.to_csr(), np.concatenate(feature_ids),
+                      sample_ids)
+
+
+def _read_sparse_table(ff, dtype, id_columns, chunk_size, select,
+                       level=None, samples=None, **kwargs):
+    table = _build_sparse_table(
+        iter_table_chunks(ff, dtype, id_columns, chunk_size, level=level,
+                          samples=samples, **kwargs),
+        dtype, id_columns, select)
+    if table is None:
+        return _empty_sparse_table(ff, id_columns, samples, **kwargs)
+    return table
+
+
+def _read_sparse_groups(ff, dtype, id_columns, chunk_size, group,
+                        samples=None, **kwargs):
+    # As _read_sparse_table, but the features are split into a biom.Table
+    # per group (as returned by group for the feature ids of each chunk)
+    # while the table is read once.
+    feature_ids = {}
+    builders = {}
+    for chunk in iter_table_chunks(ff, dtype, id_columns, chunk_size,
+                                   samples=samples, **kwargs):
+        chunk = chunk.drop(columns=[column for column in id_columns
+                                    if column in chunk.columns])
+        sample_ids = chunk.columns
+        ids = chunk.index.to_numpy()
+        values = chunk.to_numpy(dtype=dtype)
+        for key, rows in _group_rows(group(chunk.index)):
+            if key not in builders:
+                builders[key] = CSRBuilder(len(sample_ids), dtype)
+                feature_ids[key] = []
+            builders[key].add_rows(values[rows])
+            feature_ids[key].append(ids[rows])
+    return {key: biom.Table(builders[key].to_csr(),
+                            np.concatenate(feature_ids[key]), sample_ids)
+            for key in sorted(builders)}
+
+
+def read_sparse_humann_table(ff, dtype=np.float64, chunk_size=CHUNK_SIZE,
+                             select=None, samples=None, level=None):
+    """Load a HUMAnN table format as a biom.Table
+
+    The table is read in chunks, and only the non-zero values of each chunk
+    are kept, so the dense table is never held in memory. If provided,
+    ``select`` is passed the feature ids of each chunk (a pd.Index), and
+    returns a boolean array indicating the features to keep. ``samples`` are
+    as for read_humann_table. If ``level`` is provided (1 for unstratified
+    features, or STRATIFIED), the lines of other features are dropped
+    before they are parsed. Values are rounded to ``dtype``, but biom.Table
+    always stores them as float64.
+    """
+    return _read_sparse_table(ff, dtype, (), chunk_size, select,
+                              level=level, samples=samples)
+
+
+def read_sparse_metaphlan_table(ff, dtype=np.float64, chunk_size=CHUNK_SIZE,
+                                select=None, level=None, samples=None):
+    """Load a MetaPhlAn merged abundance format as a biom.Table
+
+    This is like read_sparse_humann_table. The NCBI_tax_id column isn't
+    included in the table. If ``level`` is provided, only the features with
+    exactly ``level`` taxonomic levels are loaded (see
+    read_metaphlan_table).
+    """
+    return _read_sparse_table(ff, dtype, METAPHLAN_ID_COLUMNS, chunk_size,
+                              select, level=level, samples=samples,
+                              comment='#')
+
+
+def _strata_tables(tables, sample_ids):
+    # Return the unstratified and stratified tables of the groups of
+    # _read_sparse_groups, which are keyed by whether their features are
+    # stratified.
+    return tuple(tables[stratified] if stratified in tables
+                 else empty_table(sample_ids)
+                 for stratified in [False, True])
+
+
+def read_sparse_humann_strata(ff, dtype=np.float64, chunk_size=CHUNK_SIZE,
+                              samples=None):
+    """Load a HUMAnN table format as biom.Tables of its two strata
+
+    The table is read once, as by read_sparse_humann_table, and each feature
+    is added to the biom.Table of unstratified or stratified features. These
+    are returned, in this order.
+    """
+    tables = _read_sparse_groups(
+        ff, dtype, (), chunk_size,
+        functools.partial(level_mask, level=STRATIFIED), samples=samples)
+    if len(tables) == 2:
+        return _strata_tables(tables, None)
+    sample_ids = _table_sample_ids(ff, ())
+    if samples is not None:
+        sample_ids = _sample_columns(sample_ids, (), samples)
+    return _strata_tables(tables, sample_ids)
+
+
+def read_sparse_metaphlan_levels(ff, dtype=np.float64, chunk_size=CHUNK_SIZE,
+                                 samples=None):
+    """Load a MetaPhlAn merged abundance format as a biom.Table per level
+
+    The table is read once, as by read_sparse_metaphlan_table, and each
+    feature is added to the biom.Table of its number of taxonomic levels.
+    A dict of these tables, keyed by the number of levels, is returned. It
+    only includes the levels that the table has features at.
+    """
+    return _read_sparse_groups(ff, dtype, METAPHLAN_ID_COLUMNS, chunk_size,
+                               level_counts, samples=samples, comment='#')
+
+
+class TableChunks:
+    """A table format, viewed as DataFrames of consecutive rows
+
+    This is the view of the biobakery tables for processing tables that
+    don't fit in memory. Iterating over it yields the DataFrames of
+    iter_table_chunks, of about ``chunk_size`` rows, which are read from the
+    table format as they are needed. It can be iterated over more than
+    once. Use humann_table_chunks and metaphlan_table_chunks to create one.
+    """
+
+    def __init__(self, ff, dtype=np.float64, chunk_size=CHUNK_SIZE,
+                 id_columns=(), **kwargs):
+        self.format = ff
+        self.dtype = dtype
+        self.chunk_size = chunk_size
+        self._id_columns = id_columns
+        self._kwargs = kwargs
+
+    def __iter__(self):
+        return iter_table_chunks(self.format, self.dtype, self._id_columns,
+                                 self.chunk_size, **self._kwargs)
+
+    def sample_ids(self):
+        """Return the sample ids of the table, reading only its header"""
+        return _table_sample_ids(self.format, self._id_columns,
+                                 **self._kwargs)
+
+
+def humann_table_chunks(ff, dtype=np.float64, chunk_size=CHUNK_SIZE):
+    """View a HUMAnN table format as TableChunks"""
+    return TableChunks(ff, dtype, chunk_size)
+
+
+def metaphlan_table_chunks(ff, dtype=np.float64, chunk_size=CHUNK_SIZE):
+    """View a MetaPhlAn merged abundance format as TableChunks"""
+    return TableChunks(ff, dtype, chunk_size, METAPHLAN_ID_COLUMNS,
+                       comment='#')
+
+
+def _table_sample_ids(ff, id_columns, **kwargs):
+    sidecar, ff = _columnar(ff)
+    if sidecar is not None:
+        columns = _open_sidecar(sidecar).schema.names[1:]
+    else:
+        columns = _read_csv(ff, nrows=0, **kwargs).columns
+    return [column for column in columns if column not in id_columns]
+
+
+def load_sparse_humann_table(table, precision, level, samples=None):
+    """Load the features of an action's HUMAnN TableChunks input at a level
+
+    The unstratified (if ``level`` is 1) or stratified (if it is STRATIFIED)
+    features are returned as a new biom.Table. The lines of other features
+    of the table format are dropped before they are parsed. If ``samples``
+    (sample ids, as they are in the table) are provided, only those samples
+    are loaded.
+    """
+    return read_sparse_humann_table(
+        table.format, precision_dtype(precision), table.chunk_size,
+        level=level, samples=samples)
+
+
+def load_sparse_metaphlan_table(table, precision, level, samples=None):
+    """Load the features of an action's MetaPhlAn input at a level
+
+    This is like load_sparse_humann_table, but the features with exactly
+    ``level`` taxonomic levels are selected. The table format is filtered as
+    it is read, so the values of other features are never parsed.
+    """
+    return read_sparse_metaphlan_table(
+        table.format, precision_dtype(precision), table.chunk_size,
+        level=level, samples=samples)
+
+
+def load_sparse_metaphlan_levels(table, precision, samples=None):
+    """Load the features of an action's MetaPhlAn input at each level
+
+    This is like load_sparse_metaphlan_table, but a dict of a biom.Table per
+    level is returned (see read_sparse_metaphlan_levels). The table format is
+    only read once.
+    """
+    return read_sparse_metaphlan_levels(
+        table.format, precision_dtype(precision), table.chunk_size,
+        samples=samples)
+
+
+def load_sparse_humann_strata(table, precision, samples=None):
+    """Load the unstratified and stratified features of a HUMAnN input
+
+    This is like load_sparse_humann_table, but both the biom.Table of
+    unstratified features and that of stratified features are returned (see
+    read_sparse_humann_strata). The table format is only read once.
+    """
+    return read_sparse_humann_strata(
+        table.format, precision_dtype(precision), table.chunk_size,
+        samples=samples)
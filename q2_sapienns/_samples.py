@@ -0,0 +1,88 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2022, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import pandas as pd
+
+
+def strip_units(sample_id):
+    """Remove the units from a HUMAnN sample id
+
+    e.g., sample1_Abundance-RPKs becomes sample1.
+    """
+    return sample_id.rsplit('_', 1)[0]
+
+
+def strip_units_from_ids(sample_ids):
+    """Return a dict mapping HUMAnN sample ids to the ids without units
+
+    A ValueError is raised if removing the units makes any sample ids the
+    same (e.g., sample1_Abundance and sample1_Abundance-RPKs), which are
+    found with a single hash of the stripped ids.
+    """
+    # pandas' string methods loop over the ids in Python too, and are
+    # slower than this.
+    stripped = pd.Index([strip_units(sample_id) for sample_id in sample_ids],
+                        dtype=object)
+    duplicated = stripped.duplicated(keep=False)
+    if duplicated.any():
+        collisions = pd.Series(sample_ids, dtype=object)[duplicated]
+        collisions = collisions.groupby(stripped[duplicated], sort=True)
+        raise ValueError(
+            'Removing the units from the sample ids results in duplicate '
+            'sample ids: %s' % '; '.join(
+                '%s (from %s)' % (sample_id, ', '.join(ids))
+                for sample_id, ids in collisions))
+    return dict(zip(sample_ids, stripped.tolist()))
+
+
+def requested_samples(sample_ids=None, sample_metadata=None):
+    """Return the sample ids requested with an action's parameters
+
+    These are either the ``sample_ids`` (a list) or the ids of
+    ``sample_metadata`` (a qiime2.Metadata). None is returned if neither was
+    provided, i.e., all samples are requested.
+    """
+    if sample_ids is not None and sample_metadata is not None:
+        raise ValueError('Only one of sample_ids and sample_metadata can be '
+                         'provided.')
+    if sample_metadata is not None:
+        return list(sample_metadata.ids)
+    if sample_ids is not None:
+        if len(sample_ids) == 0:
+            raise ValueError('No sample ids were provided.')
+        return list(sample_ids)
+    return None
+
+
+def resolve_samples(requested, sample_ids, strip_units_from_sample_ids=False):
+    """Return the sample ids of a table that were requested
+
+    ``sample_ids`` are the sample ids of the table, as they are in the
+    table's header. A requested id can be one of these or, if
+    ``strip_units_from_sample_ids``, one with its units removed, so the ids
+    are resolved before the units are removed. The ids are returned in the
+    order of ``sample_ids``, or None if all samples are requested.
+    """
+    if requested is None:
+        return None
+    requested = set(requested)
+    resolved = []
+    found = set()
+    for sample_id in sample_ids:
+        if sample_id in requested:
+            resolved.append(sample_id)
+            found.add(sample_id)
+        elif strip_units_from_sample_ids and \
+                strip_units(sample_id) in requested:
+            resolved.append(sample_id)
+            found.add(strip_units(sample_id))
+    missing = requested - found
+    if missing:
+        raise ValueError('The following sample ids were not found in the '
+                         'table: %s' % ', '.join(sorted(missing)))
+    return resolved
@@ -0,0 +1,68 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2022, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import numpy as np
+import scipy.sparse
+
+# Initial number of non-zero values that a CSRBuilder has room for. Its
+# buffers double in size whenever they are full.
+INITIAL_CAPACITY = 1024
+
+
+class CSRBuilder:
+    """Incrementally build a CSR matrix from dense blocks of rows
+
+    Only the non-zero values of each block are copied into the builder's
+    buffers, so the dense matrix is never held in memory.
+    """
+
+    def __init__(self, n_columns, dtype=np.float64,
+                 capacity=INITIAL_CAPACITY):
+        self.n_columns = n_columns
+        self.n_rows = 0
+        self._nnz = 0
+        self._data = np.empty(capacity, dtype=dtype)
+        self._indices = np.empty(capacity, dtype=np.int32)
+        self._indptr = [np.zeros(1, dtype=np.int64)]
+
+    def _reserve(self, nnz):
+        capacity = len(self._data)
+        if nnz <= capacity:
+            return
+        while capacity < nnz:
+            capacity *= 2
+        for name in '_data', '_indices':
+            buffer = getattr(self, name)
+            resized = np.empty(capacity, dtype=buffer.dtype)
+            resized[:self._nnz] = buffer[:self._nnz]
+            setattr(self, name, resized)
+
+    def add_rows(self, values):
+        """Append the rows of the 2D array values"""
+        if values.shape[1] != self.n_columns:
+            raise ValueError('Expected %d columns. Found: %d' %
+                             (self.n_columns, values.shape[1]))
+        rows, columns = np.nonzero(values)
+        n = len(rows)
+        self._reserve(self._nnz + n)
+        self._data[self._nnz:self._nnz + n] = values[rows, columns]
+        self._indices[self._nnz:self._nnz + n] = columns
+        row_counts = np.bincount(rows, minlength=values.shape[0])
+        self._indptr.append(self._nnz + np.cumsum(row_counts))
+        self._nnz += n
+        self.n_rows += values.shape[0]
+
+    def to_csr(self):
+        """Return the rows added so far as a scipy.sparse.csr_matrix"""
+        # scipy requires indptr and indices to have the same type.
+        indptr = np.concatenate(self._indptr)
+        if self._nnz <= np.iinfo(np.int32).max:
+            indptr = indptr.astype(np.int32)
+        return scipy.sparse.csr_matrix(
+            (self._data[:self._nnz], self._indices[:self._nnz], indptr),
+            shape=(self.n_rows, self.n_columns))
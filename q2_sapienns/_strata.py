@@ -0,0 +1,182 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2022, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import io
+
+import numpy as np
+import pandas as pd
+
+from ._compression import BLOCK_SIZE
+
+# The delimiter between the levels (or strata) of biobakery feature ids,
+# e.g. k__Bacteria|p__Firmicutes.
+DELIMITER = '|'
+
+# A level selecting the features with more than one level, i.e. the
+# stratified features of HUMAnN tables, rather than an exact number of
+# levels.
+STRATIFIED = 'stratified'
+
+_NEWLINE = ord('\n')
+_TAB = ord('\t')
+_DELIMITER = ord(DELIMITER)
+
+
+def _join(feature_ids):
+    # The feature ids as one string, separated by newlines (which they can't
+    # contain), so that they are processed at once rather than one by one.
+    # Arrays and Indexes are converted to lists first, which is much faster
+    # than iterating over them.
+    if isinstance(feature_ids, (np.ndarray, pd.Index)):
+        feature_ids = feature_ids.tolist()
+    return '\n'.join(feature_ids)
+
+
+def level_counts(feature_ids):
+    """Return an array of the number of levels of each feature id
+
+    The delimiters of all feature ids are counted at once with numpy, in
+    their UTF-8 encoding.
+    """
+    if len(feature_ids) == 0:
+        return np.zeros(0, dtype=np.intp)
+    # Each id is followed by a newline, so none of the segments summed by
+    # reduceat are empty.
+    data = np.frombuffer((_join(feature_ids) + '\n').encode('utf-8'),
+                         dtype=np.uint8)
+    starts = np.flatnonzero(data == _NEWLINE)[:-1] + 1
+    starts = np.concatenate(([0], starts))
+    delimiters = (data == _DELIMITER).view(np.uint8)
+    counts = np.add.reduceat(delimiters, starts, dtype=np.uint16)
+    return counts.astype(np.intp) + 1
+
+
+def select_levels(n_levels, level):
+    """Return a boolean array indicating the numbers of levels of level
+
+    ``level`` is a number of levels, or STRATIFIED for any number of levels
+    greater than one.
+    """
+    if level == STRATIFIED:
+        return n_levels > 1
+    return n_levels == level
+
+
+def level_mask(feature_ids, level):
+    """Return a boolean array indicating the feature ids with level levels
+
+    ``level`` is as for select_levels.
+    """
+    return select_levels(level_counts(feature_ids), level)
+
+
+def taxonomy(feature_ids, delimiters=(DELIMITER,)):
+    """Return the taxonomy of feature ids, as a Taxon DataFrame
+
+    The levels of each taxon are the parts of its feature id separated by
+    any of ``delimiters``, and are separated by '; ' instead.
+    """
+    taxa = _join(feature_ids)
+    for delimiter in delimiters:
+        taxa = taxa.replace(delimiter, '; ')
+    return pd.DataFrame(
+        {'Taxon': taxa.split('\n') if len(feature_ids) else []},
+        index=pd.Index(feature_ids, name='Feature ID', dtype=object))
+
+
+def filter_lines(block, level):
+    """Return the lines of block whose first field has level levels
+
+    ``block`` is bytes of complete lines (i.e., ending with a newline), and
+    ``level`` is as for select_levels. The lines are selected without
+    splitting them: the delimiters before the first tab of each line are
+    counted with numpy.
+    """
+    data = np.frombuffer(block, dtype=np.uint8)
+    ends = np.flatnonzero(data == _NEWLINE) + 1
+    starts = np.concatenate(([0], ends[:-1]))
+    # The first tab of each line, or its newline if it doesn't have one.
+    tabs = np.append(np.flatnonzero(data == _TAB), len(data))
+    first_tabs = np.minimum(tabs[np.searchsorted(tabs, starts)], ends - 1)
+    delimiters = np.flatnonzero(data == _DELIMITER)
+    n_delimiters = (np.searchsorted(delimiters, first_tabs) -
+                    np.searchsorted(delimiters, starts))
+    keep = select_levels(n_delimiters + 1, level)
+    if keep.all():
+        return block
+    # Copy the runs of consecutive lines that are kept.
+    changes = np.flatnonzero(np.diff(keep.view(np.int8), prepend=0,
+                                     append=0))
+    run_starts = starts[changes[0::2]]
+    run_ends = ends[changes[1::2] - 1]
+    return b''.join([block[start:end]
+                     for start, end in zip(run_starts.tolist(),
+                                           run_ends.tolist())])
+
+
+class LevelFilter(io.RawIOBase):
+    """A raw stream of the lines of a table with exactly level levels
+
+    The comment lines (starting with ``comment``, if it is provided) and
+    header line at the start of ``stream``, a binary stream of a biobakery
+    table, are passed through. Other lines are only included if their
+    feature id has ``level`` levels (see select_levels), so that the rows of
+    other levels are dropped before they are parsed. HUMAnN tables have no
+    comment lines, but their header starts with '#'.
+    """
+
+    def __init__(self, stream, level, comment='#', block_size=BLOCK_SIZE):
+        super().__init__()
+        self._stream = stream
+        self._level = level
+        self._block_size = block_size
+        header = [stream.readline()]
+        while comment is not None and \
+                header[-1].startswith(comment.encode('utf-8')):
+            header.append(stream.readline())
+        self._block = memoryview(b''.join(header))
+        self._remainder = b''
+        self._eof = False
+
+    def _read_block(self):
+        data = self._stream.read(self._block_size)
+        if not data:
+            self._eof = True
+            block, self._remainder = self._remainder, b''
+            if block and not block.endswith(b'\n'):
+                block += b'\n'
+        else:
+            data = self._remainder + data
+            end = data.rfind(b'\n') + 1
+            block, self._remainder = data[:end], data[end:]
+        if block:
+            self._block = memoryview(filter_lines(block, self._level))
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while len(self._block) == 0:
+            if self._eof:
+                return 0
+            self._read_block()
+        n = min(len(b), len(self._block))
+        b[:n] = self._block[:n]
+        self._block = self._block[n:]
+        return n
+
+    def close(self):
+        if not self.closed:
+            self._stream.close()
+        super().close()
+
+
+def open_level(stream, level, comment='#'):
+    """Wrap a binary stream of a table in a LevelFilter for level"""
+    return io.BufferedReader(LevelFilter(stream, level, comment),
+                             buffer_size=BLOCK_SIZE)
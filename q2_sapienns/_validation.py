@@ -0,0 +1,441 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2022, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import collections
+import concurrent.futures
+import itertools
+import mmap
+import operator
+import os
+
+import numpy as np
+from qiime2.plugin import ValidationError
+
+# Number of lines that are parsed into a single NumPy block during
+# validation. This bounds the memory used by validation, independent of the
+# size of the file being validated.
+CHUNK_SIZE = 10000
+
+# Files smaller than this are always validated serially, since starting a
+# process pool costs more than it saves on them.
+PARALLEL_MIN_BYTES = 64 * 1024 ** 2
+
+# Approximate number of bytes checked by one task of a parallel validation.
+PARALLEL_RANGE_BYTES = 32 * 1024 ** 2
+
+# Environment variable defining the number of processes used to validate
+# large files. Validation is serial unless this is set to a value greater
+# than 1, or to 0 to use one process per CPU.
+WORKERS_ENV_VAR = 'Q2_SAPIENNS_VALIDATION_WORKERS'
+
+# Number of bytes of a memory-mapped file that are scanned at a time during
+# byte-level validation.
+WINDOW_BYTES = 16 * 1024 ** 2
+
+# Environment variable selecting how the structure of HUMAnN tables is
+# checked by full validation: 'parse' (the default) counts the fields of
+# each row, and 'bytes' only counts tab and newline bytes in the
+# memory-mapped file, which is much faster.
+MODE_ENV_VAR = 'Q2_SAPIENNS_VALIDATION_MODE'
+
+# Environment variable defining the number of randomly selected rows that
+# are checked by 'min' validation, in addition to the first and last rows of
+# the table. No rows are sampled unless this is set.
+SAMPLE_SIZE_ENV_VAR = 'Q2_SAPIENNS_VALIDATION_SAMPLE_SIZE'
+
+# Number of rows at the end of a table that are checked when rows are
+# sampled.
+SAMPLE_TAIL_ROWS = 5
+
+# Seed used to select sampled rows, so that the same rows of a file are
+# checked every time it's validated.
+SAMPLE_SEED = 0
+
+# Fraction of invalid rows that sampled validation reports its confidence
+# of ruling out.
+SAMPLE_TOLERANCE = 0.01
+
+SampleSummary = collections.namedtuple(
+    'SampleSummary', ['n_rows', 'tolerance', 'confidence'])
+
+_count_tabs = operator.methodcaller('count', '\t')
+_TAB = ord('\t')
+_NEWLINE = ord('\n')
+
+
+def validation_workers():
+    value = os.environ.get(WORKERS_ENV_VAR, '1')
+    try:
+        n_workers = int(value)
+    except ValueError:
+        raise ValueError('%s must be an integer. Found: %s' %
+                         (WORKERS_ENV_VAR, value))
+    if n_workers < 0:
+        raise ValueError('%s must not be negative. Found: %d' %
+                         (WORKERS_ENV_VAR, n_workers))
+    if n_workers == 0:
+        n_workers = os.cpu_count() or 1
+    return n_workers
+
+
+def _read_chunks(fh, first_line_no, n_lines, chunk_size=CHUNK_SIZE):
+    """Yield (line number, lines) blocks of at most chunk_size lines
+
+    ``first_line_no`` is the line number of the next line in ``fh``, and is
+    used to report the line number of the first line in each block. Reading
+    stops after ``n_lines`` lines, or at the end of the file if ``n_lines``
+    is None.
+    """
+    line_no = first_line_no
+    remaining = n_lines
+    while remaining is None or remaining > 0:
+        if remaining is None:
+            size = chunk_size
+        else:
+            size = min(chunk_size, remaining)
+            remaining -= size
+        lines = list(itertools.islice(fh, size))
+        if not lines:
+            return
+        yield line_no, lines
+        line_no += len(lines)
+
+
+def _field_counts(lines, count_tabs=_count_tabs):
+    return np.fromiter(map(count_tabs, lines), dtype=np.intp,
+                       count=len(lines)) + 1
+
+
+def _line_locations(first_line_no):
+    return ('line %d' % line_no for line_no in itertools.count(first_line_no))
+
+
+def _inconsistent_columns_error(location):
+    return ValidationError(
+        'Number of columns on %s is inconsistent with the header '
+        'line.' % location)
+
+
+def _check_abundance_rows(rows, locations, n_header_fields,
+                          first_value_field):
+    # This is the reference (i.e., one value at a time) implementation of
+    # the abundance checks. It's only applied to blocks that failed the
+    # vectorized checks, so that the first error in the block is reported
+    # exactly as it would be if the whole file were checked this way.
+    for location, row in zip(locations, rows):
+        fields = row.split('\t')
+        if len(fields) != n_header_fields:
+            raise _inconsistent_columns_error(location)
+        for value in fields[first_value_field:]:
+            try:
+                value = float(value)
+            except ValueError:
+                raise ValidationError(
+                    'Values in table must be float-able. Found: %s (%s)' %
+                    (value, location)
+                )
+            if value > 100.0 or value < 0.0:
+                raise ValidationError(
+                    'Values must be in range [0, 100]. Found: %f (%s)' %
+                    (value, location)
+                )
+
+
+def _abundance_block_is_valid(rows, n_header_fields, first_value_field):
+    if (_field_counts(rows) != n_header_fields).any():
+        return False
+    fields = np.array('\t'.join(rows).split('\t'), dtype=object)
+    fields = fields.reshape(len(rows), n_header_fields)
+    try:
+        # Casting from object calls float() on each value, so what is
+        # accepted here is exactly what the reference implementation
+        # accepts.
+        values = fields[:, first_value_field:].astype(np.float64)
+    except ValueError:
+        return False
+    # NaN compares False in both directions, consistent with the reference
+    # implementation.
+    return not ((values > 100.0) | (values < 0.0)).any()
+
+
+def validate_abundances(fh, first_line_no, n_header_fields, n_lines,
+                        first_value_field=2, chunk_size=CHUNK_SIZE):
+    """Validate tab-separated rows of percent abundances
+
+    Each row must have ``n_header_fields`` fields, and the fields starting
+    at ``first_value_field`` must be float-able values in the range
+    [0, 100]. Rows are read from ``fh`` and checked ``chunk_size`` at a
+    time. A ValidationError identifying the first offending line (numbered
+    from ``first_line_no``) and value is raised if any row is invalid.
+    """
+    for line_no, lines in _read_chunks(fh, first_line_no, n_lines,
+                                       chunk_size):
+        rows = [line.strip() for line in lines]
+        if not _abundance_block_is_valid(rows, n_header_fields,
+                                         first_value_field):
+            _check_abundance_rows(rows, _line_locations(line_no),
+                                  n_header_fields, first_value_field)
+
+
+def validate_column_counts(fh, first_line_no, n_header_fields, n_lines,
+                           chunk_size=CHUNK_SIZE):
+    """Validate that rows have the same number of fields as the header
+
+    Rows are read from ``fh`` ``chunk_size`` at a time, stopping after
+    ``n_lines`` rows or at the end of the file if ``n_lines`` is None. A
+    ValidationError identifying the first offending line (numbered from
+    ``first_line_no``) is raised if any row is invalid.
+    """
+    for line_no, lines in _read_chunks(fh, first_line_no, n_lines,
+                                       chunk_size):
+        bad = np.flatnonzero(_field_counts(lines) != n_header_fields)
+        if bad.size > 0:
+            raise _inconsistent_columns_error('line %d' % (line_no + bad[0]))
+
+
+def _byte_ranges(fh, start, end, range_size):
+    # Split [start, end) into ranges of roughly range_size bytes, with each
+    # boundary moved forward to the byte following a newline.
+    boundaries = [start]
+    while boundaries[-1] + range_size < end:
+        fh.seek(boundaries[-1] + range_size)
+        fh.readline()
+        boundary = fh.tell()
+        if boundary >= end:
+            break
+        boundaries.append(boundary)
+    boundaries.append(end)
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def _byte_field_counts(buf):
+    # Return the number of tab-separated fields on each line of buf, a uint8
+    # array containing whole lines, without decoding any of them.
+    ends = np.flatnonzero(buf == _NEWLINE)
+    if buf.size > 0 and (ends.size == 0 or ends[-1] != buf.size - 1):
+        # the last line of the file isn't terminated by a newline
+        ends = np.append(ends, buf.size - 1)
+    if ends.size == 0:
+        return ends
+    starts = np.empty_like(ends)
+    starts[0] = 0
+    starts[1:] = ends[:-1] + 1
+    # Summing uint8 rather than bool avoids a cast of the whole buffer.
+    tabs = (buf == _TAB).view(np.uint8)
+    return np.add.reduceat(tabs, starts, dtype=np.uint32) + 1
+
+
+def _check_mapped_range(mm, start, end, n_header_fields,
+                        window_bytes=WINDOW_BYTES):
+    # Returns the number of lines in the range [start, end) of the mapped
+    # file mm, and the index of the first invalid line in the range (or
+    # None if all lines are valid). start and end must be line boundaries.
+    n_lines = 0
+    for window_start, window_end in _byte_ranges(mm, start, end,
+                                                 window_bytes):
+        buf = np.frombuffer(mm, dtype=np.uint8, offset=window_start,
+                            count=window_end - window_start)
+        counts = _byte_field_counts(buf)
+        # release the buffer so that mm can be closed
+        del buf
+        bad = np.flatnonzero(counts != n_header_fields)
+        if bad.size > 0:
+            return n_lines + counts.size, n_lines + int(bad[0])
+        n_lines += counts.size
+    return n_lines, None
+
+
+def _check_byte_range(filepath, start, end, n_header_fields):
+    # Returns the number of lines in the range, and the index of the first
+    # invalid line in the range (or None if all lines are valid).
+    with open(filepath, 'rb') as fh, \
+            mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        return _check_mapped_range(mm, start, end, n_header_fields)
+
+
+def _skip_lines(mm, n_lines):
+    for _ in range(n_lines):
+        mm.readline()
+    return mm.tell()
+
+
+def validate_column_counts_bytes(filepath, n_header_lines, n_header_fields,
+                                 window_bytes=WINDOW_BYTES):
+    """Validate column counts of all rows in filepath from its raw bytes
+
+    The file is memory-mapped and the tab and newline bytes following the
+    first ``n_header_lines`` lines are counted with NumPy, ``window_bytes``
+    at a time, so no line is decoded or split. A ValidationError
+    identifying the first offending line is raised if any row has a
+    different number of fields than ``n_header_fields``.
+    """
+    if os.path.getsize(filepath) == 0:
+        return
+    with open(filepath, 'rb') as fh, \
+            mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        start = _skip_lines(mm, n_header_lines)
+        _, bad_idx = _check_mapped_range(mm, start, mm.size(),
+                                         n_header_fields, window_bytes)
+    if bad_idx is not None:
+        raise _inconsistent_columns_error(
+            'line %d' % (n_header_lines + 1 + bad_idx))
+
+
+def validate_column_counts_parallel(filepath, n_header_lines,
+                                    n_header_fields, n_workers,
+                                    range_size=PARALLEL_RANGE_BYTES):
+    """Validate column counts of all rows in filepath using a process pool
+
+    The rows following the first ``n_header_lines`` lines are split into
+    byte ranges aligned to line boundaries, and each range is checked by
+    one of ``n_workers`` processes as in ``validate_column_counts_bytes``.
+    The results are merged so that the error raised identifies the first
+    offending line in the file.
+    """
+    with open(filepath, 'rb') as fh:
+        for _ in range(n_header_lines):
+            fh.readline()
+        start = fh.tell()
+        end = fh.seek(0, os.SEEK_END)
+        ranges = _byte_ranges(fh, start, end, range_size)
+
+    with concurrent.futures.ProcessPoolExecutor(n_workers) as executor:
+        futures = [executor.submit(_check_byte_range, filepath, range_start,
+                                   range_end, n_header_fields)
+                   for range_start, range_end in ranges]
+        line_no = n_header_lines + 1
+        # Results are consumed in file order, so the first invalid range
+        # found contains the first invalid line.
+        for future in futures:
+            n_range_lines, bad_idx = future.result()
+            if bad_idx is not None:
+                for remaining in futures:
+                    remaining.cancel()
+                raise _inconsistent_columns_error(
+                    'line %d' % (line_no + bad_idx))
+            line_no += n_range_lines
+
+
+def use_parallel_validation(filepath, n_lines, n_workers):
+    return (n_lines is None and n_workers > 1 and
+            os.path.getsize(filepath) >= PARALLEL_MIN_BYTES)
+
+
+def validation_mode():
+    value = os.environ.get(MODE_ENV_VAR, 'parse')
+    if value not in ('parse', 'bytes'):
+        raise ValueError("%s must be 'parse' or 'bytes'. Found: %s" %
+                         (MODE_ENV_VAR, value))
+    return value
+
+
+def validation_sample_size():
+    value = os.environ.get(SAMPLE_SIZE_ENV_VAR, '0')
+    try:
+        sample_size = int(value)
+    except ValueError:
+        raise ValueError('%s must be an integer. Found: %s' %
+                         (SAMPLE_SIZE_ENV_VAR, value))
+    if sample_size < 0:
+        raise ValueError('%s must not be negative. Found: %d' %
+                         (SAMPLE_SIZE_ENV_VAR, sample_size))
+    return sample_size
+
+
+def _tail_offsets(fh, start, end, n_rows):
+    # Return the offsets of the last n_rows lines in [start, end), reading
+    # backwards from end in increasingly large steps until enough lines
+    # have been found.
+    step = 64 * 1024
+    while True:
+        position = max(start, end - step)
+        fh.seek(position)
+        if position > start:
+            # discard the partial line
+            fh.readline()
+        offsets = []
+        while fh.tell() < end:
+            offsets.append(fh.tell())
+            fh.readline()
+        if len(offsets) >= n_rows or position == start:
+            return offsets[-n_rows:]
+        step *= 2
+
+
+def _sample_offsets(fh, start, end, n_rows, seed):
+    # Return the offsets of the first lines starting at or after n_rows
+    # random positions in [start, end).
+    rng = np.random.default_rng(seed)
+    offsets = set()
+    for position in np.sort(rng.integers(start, end, size=n_rows)):
+        if position == start:
+            offsets.add(start)
+            continue
+        # Seeking to the byte before position means that a line starting
+        # exactly at position is the one selected.
+        fh.seek(position - 1)
+        fh.readline()
+        if fh.tell() < end:
+            offsets.add(fh.tell())
+    return offsets
+
+
+def validate_sample(filepath, n_header_lines, n_rows, check_rows,
+                    seed=SAMPLE_SEED):
+    """Validate a reproducible random sample of the rows in filepath
+
+    The last SAMPLE_TAIL_ROWS rows, and the rows starting at or after
+    ``n_rows`` random byte offsets following the first ``n_header_lines``
+    lines, are read and passed to ``check_rows`` along with a description
+    of the location of each row (which is included in any ValidationError
+    raised). Because rows are selected by byte offset, rows following long
+    rows are more likely to be sampled than others.
+
+    Returns a SampleSummary with the number of distinct randomly sampled
+    rows checked, and the confidence that fewer than SAMPLE_TOLERANCE of
+    the rows of the table are invalid (assuming that invalid rows are
+    randomly distributed).
+    """
+    with open(filepath, 'rb') as fh:
+        for _ in range(n_header_lines):
+            fh.readline()
+        start = fh.tell()
+        end = fh.seek(0, os.SEEK_END)
+        if start == end:
+            return SampleSummary(0, SAMPLE_TOLERANCE, 0.0)
+
+        sampled = _sample_offsets(fh, start, end, n_rows, seed)
+        tail = _tail_offsets(fh, start, end, SAMPLE_TAIL_ROWS)
+        offsets = sorted(sampled.union(tail))
+        rows = []
+        for offset in offsets:
+            fh.seek(offset)
+            rows.append(fh.readline().decode('utf-8'))
+
+    locations = ['the line starting at byte %d' % offset
+                 for offset in offsets]
+    check_rows(rows, locations)
+    confidence = 1.0 - (1.0 - SAMPLE_TOLERANCE) ** len(sampled)
+    return SampleSummary(len(sampled), SAMPLE_TOLERANCE, confidence)
+
+
+def column_count_checker(n_header_fields):
+    """Return a row checker for validate_sample checking column counts"""
+    def check_rows(rows, locations):
+        bad = np.flatnonzero(_field_counts(rows) != n_header_fields)
+        if bad.size > 0:
+            raise _inconsistent_columns_error(locations[bad[0]])
+    return check_rows
+
+
+def abundance_checker(n_header_fields, first_value_field=2):
+    """Return a row checker for validate_sample checking abundances"""
+    def check_rows(rows, locations):
+        _check_abundance_rows([row.strip() for row in rows], locations,
+                              n_header_fields, first_value_field)
+    return check_rows
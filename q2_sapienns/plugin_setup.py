@@ -6,15 +6,40 @@
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
 
-from qiime2.plugin import (Plugin, SemanticType, TextFileFormat, model,
-                           ValidationError, Citations, Int, Range, Bool)
+from qiime2.plugin import (Plugin, SemanticType, Citations, Int, Range,
+                           Bool, Str, Choices, List, Metadata)
 from q2_types.feature_table import FeatureTable, Frequency, RelativeFrequency
 from q2_types.feature_data import FeatureData, Taxonomy
 
 import q2_sapienns
-from ._humann import humann_pathway, humann_genefamily
-from ._metaphlan import metaphlan_taxon, frequency
-
+from ._humann import (humann_pathway, humann_genefamily,
+                      humann_pathway_strata, humann_genefamily_strata)
+from ._metaphlan import (SPLIT_LEVELS, metaphlan_taxon, metaphlan_levels,
+                         frequency)
+from ._compression import BLOCK_SIZE
+from ._format import (
+    MetaphlanMergedAbundanceFormat, HumannPathAbundanceFormat,
+    HumannGeneFamilyFormat, CompressedMetaphlanMergedAbundanceFormat,
+    CompressedHumannPathAbundanceFormat, CompressedHumannGeneFamilyFormat,
+    MetaphlanMergedAbundanceDirectoryFormat,
+    HumannPathAbundanceDirectoryFormat, HumannGeneFamilyDirectoryFormat,
+    CompressedMetaphlanMergedAbundanceDirectoryFormat,
+    CompressedHumannPathAbundanceDirectoryFormat,
+    CompressedHumannGeneFamilyDirectoryFormat, ArrowTableFormat,
+    MetaphlanMergedAbundanceArrowDirectoryFormat,
+    HumannPathAbundanceArrowDirectoryFormat,
+    HumannGeneFamilyArrowDirectoryFormat)
+from ._frequency import ROUNDINGS
+from ._reader import (PRECISIONS, default_precision, precision_dtype,
+                      default_chunk_size, TableChunks, humann_table_chunks,
+                      metaphlan_table_chunks, read_humann_table,
+                      read_metaphlan_table, read_sparse_humann_table,
+                      read_sparse_metaphlan_table, write_sidecar)
+
+import os
+import shutil
+
+import biom
 import pandas as pd
 
 plugin = Plugin(
@@ -40,127 +65,89 @@ plugin.register_semantic_types(HumannPathAbundanceTable)
 plugin.register_semantic_types(HumannGeneFamilyTable)
 
 
-class MetaphlanMergedAbundanceFormat(TextFileFormat):
-
-    def _equal_number_of_columns(self, n_lines):
-        with self.open() as fh:
-            header_line = fh.readline()
-            while header_line.startswith('#'):
-                header_line = fh.readline()
-            n_header_fields = len(header_line.split('\t'))
-            if n_header_fields < 3:
-                raise ValidationError(
-                    'No sample columns appear to be present.')
-            for idx, line in enumerate(fh, 2):
-                if n_lines is not None and idx > n_lines + 1:
-                    break
-                fields = line.strip().split('\t')
-                n_fields = len(fields)
-                if n_fields != n_header_fields:
-                    raise ValidationError(
-                        'Number of columns on line %d is inconsistent with '
-                        'the header line.' % line)
-                for value in fields[2:]:
-                    try:
-                        value = float(value)
-                    except ValueError:
-                        raise ValidationError(
-                            'Values in table must be float-able. Found: %s' %
-                            value
-                        )
-                    if value > 100.0 or value < 0.0:
-                        raise ValidationError(
-                            'Values must be in range [0, 100]. Found: %f' %
-                            value
-                        )
-
-    def _validate_(self, level):
-        level_to_n_lines = {'min': 5, 'max': None}
-        self._equal_number_of_columns(level_to_n_lines[level])
-
-
-class HumannTableFormat(TextFileFormat):
-
-    def _equal_number_of_columns(self, n_lines):
-        with self.open() as fh:
-            header_line = fh.readline().strip()
-            header_fields = header_line.split('\t')
-            n_header_fields = len(header_fields)
-            if n_header_fields < 2:
-                raise ValidationError(
-                    'No sample columns appear to be present.')
-            for sample_id in header_fields[1:]:
-                if not sample_id.endswith(self._unit_label):
-                    raise ValidationError(
-                        'Expected sample ids (e.g., %s) to end with unit '
-                        'descriptor %s' % (sample_id, self._unit_label)
-                    )
-            for idx, line in enumerate(fh, 2):
-                if n_lines is not None and idx > n_lines + 1:
-                    break
-                n_fields = len(line.split('\t'))
-                if n_fields != n_header_fields:
-                    raise ValidationError(
-                        'Number of columns on line %d is inconsistent with '
-                        'the header line.' % line)
-
-    def _validate_(self, level):
-        level_to_n_lines = {'min': 5, 'max': None}
-        self._equal_number_of_columns(level_to_n_lines[level])
-
-
-class HumannPathAbundanceFormat(HumannTableFormat):
-    _unit_label = 'Abundance'
-
-
-class HumannGeneFamilyFormat(HumannTableFormat):
-    _unit_label = 'RPKs'
-
-
-MetaphlanMergedAbundanceDirectoryFormat = model.SingleFileDirectoryFormat(
-    'MetaphlanMergedAbundanceDirectoryFormat', 'table.tsv',
-    MetaphlanMergedAbundanceFormat)
-
-HumannPathAbundanceDirectoryFormat = model.SingleFileDirectoryFormat(
-    'HumannPathAbundanceDirectoryFormat', 'table.tsv',
-    HumannPathAbundanceFormat)
-
-HumannGeneFamilyDirectoryFormat = model.SingleFileDirectoryFormat(
-    'HumannGeneFamilyDirectoryFormat', 'table.tsv', HumannGeneFamilyFormat)
-
+# Artifacts are stored in the *Arrow* directory formats, which hold an
+# Arrow IPC file of the parsed table next to it. The directory formats
+# without one remain registered, so that artifacts created before they were
+# added can still be loaded.
 plugin.register_formats(MetaphlanMergedAbundanceFormat,
-                        MetaphlanMergedAbundanceDirectoryFormat)
+                        MetaphlanMergedAbundanceDirectoryFormat,
+                        MetaphlanMergedAbundanceArrowDirectoryFormat)
 
 plugin.register_semantic_type_to_format(
-    MetaphlanMergedAbundanceTable, MetaphlanMergedAbundanceDirectoryFormat)
+    MetaphlanMergedAbundanceTable,
+    MetaphlanMergedAbundanceArrowDirectoryFormat)
 
 
 plugin.register_formats(HumannPathAbundanceFormat,
-                        HumannPathAbundanceDirectoryFormat)
+                        HumannPathAbundanceDirectoryFormat,
+                        HumannPathAbundanceArrowDirectoryFormat)
 
-plugin.register_semantic_type_to_format(HumannPathAbundanceTable,
-                                        HumannPathAbundanceDirectoryFormat)
+plugin.register_semantic_type_to_format(
+    HumannPathAbundanceTable, HumannPathAbundanceArrowDirectoryFormat)
 
 
 plugin.register_formats(HumannGeneFamilyFormat,
-                        HumannGeneFamilyDirectoryFormat)
+                        HumannGeneFamilyDirectoryFormat,
+                        HumannGeneFamilyArrowDirectoryFormat)
+
+plugin.register_semantic_type_to_format(
+    HumannGeneFamilyTable, HumannGeneFamilyArrowDirectoryFormat)
+
+plugin.register_formats(ArrowTableFormat)
+
+plugin.register_views(TableChunks)
 
-plugin.register_semantic_type_to_format(HumannGeneFamilyTable,
-                                        HumannGeneFamilyDirectoryFormat)
+
+plugin.register_formats(CompressedMetaphlanMergedAbundanceFormat,
+                        CompressedMetaphlanMergedAbundanceDirectoryFormat,
+                        CompressedHumannPathAbundanceFormat,
+                        CompressedHumannPathAbundanceDirectoryFormat,
+                        CompressedHumannGeneFamilyFormat,
+                        CompressedHumannGeneFamilyDirectoryFormat)
 
 
 def _humann_to_df(ff):
-    result = pd.read_csv(str(ff), sep='\t', header=0, index_col=0)
-    result.index.name = 'feature-id'
+    return read_humann_table(ff, precision_dtype(default_precision()))
+
+
+def _metaphlan_to_df(ff):
+    return read_metaphlan_table(ff, precision_dtype(default_precision()))
+
+
+def _humann_to_chunks(ff):
+    return humann_table_chunks(ff, precision_dtype(default_precision()),
+                               default_chunk_size())
+
+
+def _metaphlan_to_chunks(ff):
+    return metaphlan_table_chunks(ff, precision_dtype(default_precision()),
+                                  default_chunk_size())
+
+
+def _decompress_to_dir_fmt(ff, dir_fmt):
+    # Stream the decompressed table into the uncompressed directory format.
+    result = dir_fmt()
+    with ff.open_binary() as src, \
+            open(os.path.join(str(result), 'table.tsv'), 'wb') as dst:
+        shutil.copyfileobj(src, dst, BLOCK_SIZE)
+    return result
+
+
+def _to_arrow_dir_fmt(ff, dir_fmt):
+    # Copy (or decompress) the table into the Arrow directory format, and
+    # write its Arrow sidecar.
+    if ff._compressed:
+        result = _decompress_to_dir_fmt(ff, dir_fmt)
+    else:
+        result = dir_fmt()
+        shutil.copyfile(str(ff), os.path.join(str(result), 'table.tsv'))
+    write_sidecar(result)
     return result
 
 
 @plugin.register_transformer
 def _1(ff: MetaphlanMergedAbundanceFormat) -> pd.DataFrame:
-    result = pd.read_csv(str(ff), sep='\t', header=0, index_col=0,
-                         comment='#')
-    result.index.name = 'feature-id'
-    return result
+    return _metaphlan_to_df(ff)
 
 
 @plugin.register_transformer
@@ -173,13 +160,281 @@ def _3(ff: HumannGeneFamilyFormat) -> pd.DataFrame:
     return _humann_to_df(ff)
 
 
+@plugin.register_transformer
+def _4(ff: CompressedMetaphlanMergedAbundanceFormat) -> pd.DataFrame:
+    return _metaphlan_to_df(ff)
+
+
+@plugin.register_transformer
+def _5(ff: CompressedHumannPathAbundanceFormat) -> pd.DataFrame:
+    return _humann_to_df(ff)
+
+
+@plugin.register_transformer
+def _6(ff: CompressedHumannGeneFamilyFormat) -> pd.DataFrame:
+    return _humann_to_df(ff)
+
+
+@plugin.register_transformer
+def _7(ff: CompressedMetaphlanMergedAbundanceFormat) \
+        -> MetaphlanMergedAbundanceDirectoryFormat:
+    return _decompress_to_dir_fmt(ff, MetaphlanMergedAbundanceDirectoryFormat)
+
+
+@plugin.register_transformer
+def _8(ff: CompressedHumannPathAbundanceFormat) \
+        -> HumannPathAbundanceDirectoryFormat:
+    return _decompress_to_dir_fmt(ff, HumannPathAbundanceDirectoryFormat)
+
+
+@plugin.register_transformer
+def _9(ff: CompressedHumannGeneFamilyFormat) \
+        -> HumannGeneFamilyDirectoryFormat:
+    return _decompress_to_dir_fmt(ff, HumannGeneFamilyDirectoryFormat)
+
+
+@plugin.register_transformer
+def _10(df: CompressedMetaphlanMergedAbundanceDirectoryFormat) \
+        -> MetaphlanMergedAbundanceDirectoryFormat:
+    return _decompress_to_dir_fmt(
+        df.file.view(CompressedMetaphlanMergedAbundanceFormat),
+        MetaphlanMergedAbundanceDirectoryFormat)
+
+
+@plugin.register_transformer
+def _11(df: CompressedHumannPathAbundanceDirectoryFormat) \
+        -> HumannPathAbundanceDirectoryFormat:
+    return _decompress_to_dir_fmt(
+        df.file.view(CompressedHumannPathAbundanceFormat),
+        HumannPathAbundanceDirectoryFormat)
+
+
+@plugin.register_transformer
+def _12(df: CompressedHumannGeneFamilyDirectoryFormat) \
+        -> HumannGeneFamilyDirectoryFormat:
+    return _decompress_to_dir_fmt(
+        df.file.view(CompressedHumannGeneFamilyFormat),
+        HumannGeneFamilyDirectoryFormat)
+
+
+@plugin.register_transformer
+def _13(ff: HumannGeneFamilyFormat) -> biom.Table:
+    return read_sparse_humann_table(ff, precision_dtype(default_precision()))
+
+
+@plugin.register_transformer
+def _14(ff: CompressedHumannGeneFamilyFormat) -> biom.Table:
+    return read_sparse_humann_table(ff, precision_dtype(default_precision()))
+
+
+@plugin.register_transformer
+def _15(ff: HumannPathAbundanceFormat) -> biom.Table:
+    return read_sparse_humann_table(ff, precision_dtype(default_precision()))
+
+
+@plugin.register_transformer
+def _16(ff: CompressedHumannPathAbundanceFormat) -> biom.Table:
+    return read_sparse_humann_table(ff, precision_dtype(default_precision()))
+
+
+@plugin.register_transformer
+def _17(ff: MetaphlanMergedAbundanceFormat) -> biom.Table:
+    return read_sparse_metaphlan_table(
+        ff, precision_dtype(default_precision()))
+
+
+@plugin.register_transformer
+def _18(ff: CompressedMetaphlanMergedAbundanceFormat) -> biom.Table:
+    return read_sparse_metaphlan_table(
+        ff, precision_dtype(default_precision()))
+
+
+@plugin.register_transformer
+def _19(ff: MetaphlanMergedAbundanceFormat) \
+        -> MetaphlanMergedAbundanceArrowDirectoryFormat:
+    return _to_arrow_dir_fmt(ff, MetaphlanMergedAbundanceArrowDirectoryFormat)
+
+
+@plugin.register_transformer
+def _20(ff: CompressedMetaphlanMergedAbundanceFormat) \
+        -> MetaphlanMergedAbundanceArrowDirectoryFormat:
+    return _to_arrow_dir_fmt(ff, MetaphlanMergedAbundanceArrowDirectoryFormat)
+
+
+@plugin.register_transformer
+def _21(df: MetaphlanMergedAbundanceDirectoryFormat) \
+        -> MetaphlanMergedAbundanceArrowDirectoryFormat:
+    return _to_arrow_dir_fmt(
+        df.file.view(MetaphlanMergedAbundanceFormat),
+        MetaphlanMergedAbundanceArrowDirectoryFormat)
+
+
+@plugin.register_transformer
+def _22(df: CompressedMetaphlanMergedAbundanceDirectoryFormat) \
+        -> MetaphlanMergedAbundanceArrowDirectoryFormat:
+    return _to_arrow_dir_fmt(
+        df.file.view(CompressedMetaphlanMergedAbundanceFormat),
+        MetaphlanMergedAbundanceArrowDirectoryFormat)
+
+
+@plugin.register_transformer
+def _23(df: MetaphlanMergedAbundanceArrowDirectoryFormat) -> pd.DataFrame:
+    return _metaphlan_to_df(df)
+
+
+@plugin.register_transformer
+def _24(df: MetaphlanMergedAbundanceArrowDirectoryFormat) -> biom.Table:
+    return read_sparse_metaphlan_table(
+        df, precision_dtype(default_precision()))
+
+
+@plugin.register_transformer
+def _25(ff: HumannPathAbundanceFormat) \
+        -> HumannPathAbundanceArrowDirectoryFormat:
+    return _to_arrow_dir_fmt(ff, HumannPathAbundanceArrowDirectoryFormat)
+
+
+@plugin.register_transformer
+def _26(ff: CompressedHumannPathAbundanceFormat) \
+        -> HumannPathAbundanceArrowDirectoryFormat:
+    return _to_arrow_dir_fmt(ff, HumannPathAbundanceArrowDirectoryFormat)
+
+
+@plugin.register_transformer
+def _27(df: HumannPathAbundanceDirectoryFormat) \
+        -> HumannPathAbundanceArrowDirectoryFormat:
+    return _to_arrow_dir_fmt(
+        df.file.view(HumannPathAbundanceFormat),
+        HumannPathAbundanceArrowDirectoryFormat)
+
+
+@plugin.register_transformer
+def _28(df: CompressedHumannPathAbundanceDirectoryFormat) \
+        -> HumannPathAbundanceArrowDirectoryFormat:
+    return _to_arrow_dir_fmt(
+        df.file.view(CompressedHumannPathAbundanceFormat),
+        HumannPathAbundanceArrowDirectoryFormat)
+
+
+@plugin.register_transformer
+def _29(df: HumannPathAbundanceArrowDirectoryFormat) -> pd.DataFrame:
+    return _humann_to_df(df)
+
+
+@plugin.register_transformer
+def _30(df: HumannPathAbundanceArrowDirectoryFormat) -> biom.Table:
+    return read_sparse_humann_table(df, precision_dtype(default_precision()))
+
+
+@plugin.register_transformer
+def _31(ff: HumannGeneFamilyFormat) -> HumannGeneFamilyArrowDirectoryFormat:
+    return _to_arrow_dir_fmt(ff, HumannGeneFamilyArrowDirectoryFormat)
+
+
+@plugin.register_transformer
+def _32(ff: CompressedHumannGeneFamilyFormat) \
+        -> HumannGeneFamilyArrowDirectoryFormat:
+    return _to_arrow_dir_fmt(ff, HumannGeneFamilyArrowDirectoryFormat)
+
+
+@plugin.register_transformer
+def _33(df: HumannGeneFamilyDirectoryFormat) \
+        -> HumannGeneFamilyArrowDirectoryFormat:
+    return _to_arrow_dir_fmt(
+        df.file.view(HumannGeneFamilyFormat),
+        HumannGeneFamilyArrowDirectoryFormat)
+
+
+@plugin.register_transformer
+def _34(df: CompressedHumannGeneFamilyDirectoryFormat) \
+        -> HumannGeneFamilyArrowDirectoryFormat:
+    return _to_arrow_dir_fmt(
+        df.file.view(CompressedHumannGeneFamilyFormat),
+        HumannGeneFamilyArrowDirectoryFormat)
+
+
+@plugin.register_transformer
+def _35(df: HumannGeneFamilyArrowDirectoryFormat) -> pd.DataFrame:
+    return _humann_to_df(df)
+
+
+@plugin.register_transformer
+def _36(df: HumannGeneFamilyArrowDirectoryFormat) -> biom.Table:
+    return read_sparse_humann_table(df, precision_dtype(default_precision()))
+
+
+@plugin.register_transformer
+def _37(ff: MetaphlanMergedAbundanceFormat) -> TableChunks:
+    return _metaphlan_to_chunks(ff)
+
+
+@plugin.register_transformer
+def _38(ff: CompressedMetaphlanMergedAbundanceFormat) -> TableChunks:
+    return _metaphlan_to_chunks(ff)
+
+
+@plugin.register_transformer
+def _39(df: MetaphlanMergedAbundanceArrowDirectoryFormat) -> TableChunks:
+    return _metaphlan_to_chunks(df)
+
+
+@plugin.register_transformer
+def _40(ff: HumannPathAbundanceFormat) -> TableChunks:
+    return _humann_to_chunks(ff)
+
+
+@plugin.register_transformer
+def _41(ff: CompressedHumannPathAbundanceFormat) -> TableChunks:
+    return _humann_to_chunks(ff)
+
+
+@plugin.register_transformer
+def _42(df: HumannPathAbundanceArrowDirectoryFormat) -> TableChunks:
+    return _humann_to_chunks(df)
+
+
+@plugin.register_transformer
+def _43(ff: HumannGeneFamilyFormat) -> TableChunks:
+    return _humann_to_chunks(ff)
+
+
+@plugin.register_transformer
+def _44(ff: CompressedHumannGeneFamilyFormat) -> TableChunks:
+    return _humann_to_chunks(ff)
+
+
+@plugin.register_transformer
+def _45(df: HumannGeneFamilyArrowDirectoryFormat) -> TableChunks:
+    return _humann_to_chunks(df)
+
+
 citations = Citations.load('citations.bib', package='q2_sapienns')
 
+PRECISION_DESCRIPTION = (
+    'The floating point precision that abundances are loaded with. '
+    'float32 halves the memory needed to load the input table, but rounds '
+    'each abundance to about 7 significant digits.')
+
+SAMPLE_IDS_DESCRIPTION = (
+    'The ids of the samples to load from the input table. The columns of '
+    'other samples are never parsed. By default, all samples are loaded.')
+
+SAMPLE_METADATA_DESCRIPTION = (
+    'Metadata whose ids are the samples to load from the input table. This '
+    'is an alternative to sample_ids.')
+
+HUMANN_SAMPLE_IDS_DESCRIPTION = (
+    SAMPLE_IDS_DESCRIPTION + ' If units are removed from the sample ids, '
+    'they can be provided with or without their units.')
+
 
 plugin.methods.register_function(
     function=metaphlan_taxon,
     inputs={'stratified_table': MetaphlanMergedAbundanceTable},
-    parameters={'level': Int % Range(1, None)},
+    parameters={'level': Int % Range(1, None),
+                'precision': Str % Choices(list(PRECISIONS)),
+                'sample_ids': List[Str],
+                'sample_metadata': Metadata},
     outputs=[('table', FeatureTable[RelativeFrequency]),
              ('taxonomy', FeatureData[Taxonomy])],
     input_descriptions={
@@ -187,7 +442,10 @@ plugin.methods.register_function(
     },
     parameter_descriptions={
         'level': ('The level (or stratum) of the feature metadata heirarchy '
-                  'to select from the input table.')
+                  'to select from the input table.'),
+        'precision': PRECISION_DESCRIPTION,
+        'sample_ids': SAMPLE_IDS_DESCRIPTION,
+        'sample_metadata': SAMPLE_METADATA_DESCRIPTION
     },
     output_descriptions={
         'table': ('Filtered table containing only features at specified '
@@ -200,24 +458,90 @@ plugin.methods.register_function(
         citations['bioBakery3']]
 )
 
+plugin.methods.register_function(
+    function=metaphlan_levels,
+    inputs={'stratified_table': MetaphlanMergedAbundanceTable},
+    parameters={'precision': Str % Choices(list(PRECISIONS)),
+                'sample_ids': List[Str],
+                'sample_metadata': Metadata},
+    outputs=[output
+             for rank in SPLIT_LEVELS
+             for output in [('%s_table' % rank,
+                             FeatureTable[RelativeFrequency]),
+                            ('%s_taxonomy' % rank, FeatureData[Taxonomy])]],
+    input_descriptions={
+        'stratified_table': ('A stratified MetaPhlAn3 feature table.'),
+    },
+    parameter_descriptions={
+        'precision': PRECISION_DESCRIPTION,
+        'sample_ids': SAMPLE_IDS_DESCRIPTION,
+        'sample_metadata': SAMPLE_METADATA_DESCRIPTION
+    },
+    output_descriptions={
+        output: description
+        for rank in SPLIT_LEVELS
+        for output, description in [
+            ('%s_table' % rank,
+             'Table containing only the features at the %s level.' % rank),
+            ('%s_taxonomy' % rank,
+             'Taxonomic feature metadata of the %s table.' % rank)]},
+    name='Split MetaPhlAn3 feature table into all levels (or strata).',
+    description=('Split a MetaPhlAn3 feature table into a table per '
+                 'taxonomic level (or stratum), from kingdom to species. '
+                 'This is equivalent to running metaphlan-taxon for each '
+                 'level, but the input table is only read once. Every '
+                 'level must have features, as an empty taxonomy can\'t be '
+                 'saved. Strains, which MetaPhlAn3 doesn\'t report by '
+                 'default, can be selected with metaphlan-taxon.'),
+    citations=[
+        citations['bioBakery3']]
+)
+
 plugin.methods.register_function(
     function=frequency,
     inputs={'table': FeatureTable[RelativeFrequency]},
-    parameters={'target_freq': Int % Range(1, None)},
+    parameters={'target_freq': Int % Range(1, None),
+                'rounding': Str % Choices(list(ROUNDINGS)),
+                'seed': Int % Range(0, None),
+                'n_threads': Int % Range(1, None)},
     outputs=[('output_table', FeatureTable[Frequency])],
     input_descriptions={
         'table': ('A relative frequency feature table.'),
     },
     parameter_descriptions={
-        'target_freq': ('The target per sample total frequency.')
+        'target_freq': ('The target per sample total frequency.'),
+        'rounding': ('How frequencies are rounded to whole numbers. With '
+                     '"round", each frequency is rounded on its own, so '
+                     'the total frequency per sample may not be exactly '
+                     '`target_freq`. With "largest-remainder", each '
+                     'sample\'s relative frequencies are scaled to sum to '
+                     '`target_freq` and rounded down, and the remaining '
+                     'counts go to the features with the largest '
+                     'remainders, so the total frequency per sample is '
+                     'exactly `target_freq` (or zero, for samples without '
+                     'any features). With "multinomial", each sample\'s '
+                     'frequencies are drawn at random from a multinomial '
+                     'distribution with its relative frequencies as '
+                     'probabilities, so that rare features aren\'t always '
+                     'rounded to zero, and the total frequency per sample '
+                     'is exactly `target_freq`.'),
+        'seed': ('The seed of the random numbers drawn with the '
+                 'multinomial rounding. The same frequencies are drawn for '
+                 'a table with the same seed.'),
+        'n_threads': ('The number of threads that convert blocks of samples '
+                      'at once. The frequencies don\'t depend on the number '
+                      'of threads.')
     },
     output_descriptions={
         'output_table': 'A frequency feature table.'},
     name='Convert relative frequencies to frequencies.',
     description=('Convert relative frequencies to frequencies by multipling '
                  'each value by `target_freq` and then rounding to whole '
-                 'numbers. Because rounding is taking place, the total '
-                 'frequency per sample may not be exactly `target_freq`.'),
+                 'numbers. Unless the largest-remainder rounding is used, '
+                 'the total frequency per sample may not be exactly '
+                 '`target_freq`. Only the non-zero values of the table are '
+                 'converted, and frequencies that are rounded to zero are '
+                 'removed from the (sparse) output table.'),
     citations=[]
 )
 
@@ -225,7 +549,10 @@ plugin.methods.register_function(
     function=humann_pathway,
     inputs={'pathway_table': HumannPathAbundanceTable},
     parameters={'strip_units_from_sample_ids': Bool,
-                'destratify': Bool},
+                'destratify': Bool,
+                'precision': Str % Choices(list(PRECISIONS)),
+                'sample_ids': List[Str],
+                'sample_metadata': Metadata},
     outputs=[('table', FeatureTable[Frequency]),
              ('taxonomy', FeatureData[Taxonomy])],
     input_descriptions={
@@ -236,7 +563,10 @@ plugin.methods.register_function(
         'destratify': ('Only include un-stratified pathways (i.e., those not '
                        'including taxa) in the output table. By default, only '
                        'stratified pathways will be included in the output '
-                       'table.')
+                       'table.'),
+        'precision': PRECISION_DESCRIPTION,
+        'sample_ids': HUMANN_SAMPLE_IDS_DESCRIPTION,
+        'sample_metadata': SAMPLE_METADATA_DESCRIPTION
     },
     output_descriptions={
         'table': ('Output feature table.'),
@@ -254,7 +584,10 @@ plugin.methods.register_function(
     function=humann_genefamily,
     inputs={'genefamily_table': HumannGeneFamilyTable},
     parameters={'strip_units_from_sample_ids': Bool,
-                'destratify': Bool},
+                'destratify': Bool,
+                'precision': Str % Choices(list(PRECISIONS)),
+                'sample_ids': List[Str],
+                'sample_metadata': Metadata},
     outputs=[('table', FeatureTable[Frequency]),
              ('taxonomy', FeatureData[Taxonomy])],
     input_descriptions={
@@ -265,7 +598,10 @@ plugin.methods.register_function(
         'destratify': ('Only include un-stratified gene families (i.e., those '
                        'not including taxa) in the output table. By default, '
                        'only stratified pathways will be included in the '
-                       'output table.')
+                       'output table.'),
+        'precision': PRECISION_DESCRIPTION,
+        'sample_ids': HUMANN_SAMPLE_IDS_DESCRIPTION,
+        'sample_metadata': SAMPLE_METADATA_DESCRIPTION
     },
     output_descriptions={
         'table': ('Output feature table.'),
@@ -278,3 +614,82 @@ plugin.methods.register_function(
     citations=[
         citations['bioBakery3']]
 )
+
+STRATA_OUTPUTS = [('stratified_table', FeatureTable[Frequency]),
+                  ('stratified_taxonomy', FeatureData[Taxonomy]),
+                  ('unstratified_table', FeatureTable[Frequency]),
+                  ('unstratified_taxonomy', FeatureData[Taxonomy])]
+
+plugin.methods.register_function(
+    function=humann_pathway_strata,
+    inputs={'pathway_table': HumannPathAbundanceTable},
+    parameters={'strip_units_from_sample_ids': Bool,
+                'precision': Str % Choices(list(PRECISIONS)),
+                'sample_ids': List[Str],
+                'sample_metadata': Metadata},
+    outputs=STRATA_OUTPUTS,
+    input_descriptions={
+        'pathway_table': ('A stratified HUMAnN3 pathway table.'),
+    },
+    parameter_descriptions={
+        'strip_units_from_sample_ids': 'Remove units from input sample ids.',
+        'precision': PRECISION_DESCRIPTION,
+        'sample_ids': HUMANN_SAMPLE_IDS_DESCRIPTION,
+        'sample_metadata': SAMPLE_METADATA_DESCRIPTION
+    },
+    output_descriptions={
+        'stratified_table': ('Feature table of the stratified pathways '
+                             '(i.e., those including taxa).'),
+        'stratified_taxonomy': 'Feature metadata of the stratified table.',
+        'unstratified_table': ('Feature table of the un-stratified pathways '
+                               '(i.e., those not including taxa).'),
+        'unstratified_taxonomy': ('Feature metadata of the un-stratified '
+                                  'table.')},
+    name='Prepare stratified and un-stratified HUMAnN3 pathway data.',
+    description=('Prepare HUMAnN3 pathway tables and pathway metadata for '
+                 'QIIME 2, for both the stratified (i.e., including taxa) '
+                 'and unstratified (i.e., not including taxa) data. This is '
+                 'equivalent to running humann-pathway with and without '
+                 'destratify, but the input table is only read once. Both '
+                 'strata must have features, as an empty taxonomy can\'t '
+                 'be saved.'),
+    citations=[
+        citations['bioBakery3']]
+)
+
+plugin.methods.register_function(
+    function=humann_genefamily_strata,
+    inputs={'genefamily_table': HumannGeneFamilyTable},
+    parameters={'strip_units_from_sample_ids': Bool,
+                'precision': Str % Choices(list(PRECISIONS)),
+                'sample_ids': List[Str],
+                'sample_metadata': Metadata},
+    outputs=STRATA_OUTPUTS,
+    input_descriptions={
+        'genefamily_table': ('A stratified HUMAnN3 gene family table.'),
+    },
+    parameter_descriptions={
+        'strip_units_from_sample_ids': 'Remove units from input sample ids.',
+        'precision': PRECISION_DESCRIPTION,
+        'sample_ids': HUMANN_SAMPLE_IDS_DESCRIPTION,
+        'sample_metadata': SAMPLE_METADATA_DESCRIPTION
+    },
+    output_descriptions={
+        'stratified_table': ('Feature table of the stratified gene families '
+                             '(i.e., those including taxa).'),
+        'stratified_taxonomy': 'Feature metadata of the stratified table.',
+        'unstratified_table': ('Feature table of the un-stratified gene '
+                               'families (i.e., those not including taxa).'),
+        'unstratified_taxonomy': ('Feature metadata of the un-stratified '
+                                  'table.')},
+    name='Prepare stratified and un-stratified HUMAnN3 gene family data.',
+    description=('Prepare HUMAnN3 gene family tables and gene family '
+                 'metadata for QIIME 2, for both the stratified (i.e., '
+                 'including taxa) and unstratified (i.e., not including '
+                 'taxa) data. This is equivalent to running '
+                 'humann-genefamily with and without destratify, but the '
+                 'input table is only read once. Both strata must have '
+                 'features, as an empty taxonomy can\'t be saved.'),
+    citations=[
+        citations['bioBakery3']]
+)
@@ -5,3 +5,11 @@
 #
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
+
+
+def table_to_dataframe(table):
+    # Return a biom.Table output by an action as a DataFrame of samples
+    # (rows) by features, as these actions used to output.
+    result = table.to_dataframe(dense=True).T
+    result.index.name = 'sample-id'
+    return result
@@ -0,0 +1,358 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2022, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+"""Benchmarks of loading and processing large biobakery tables
+
+These aren't run by the test suite. Run them with:
+
+    python -m q2_sapienns.tests.benchmarks [benchmark ...]
+"""
+
+import argparse
+import os
+import tempfile
+import time
+import tracemalloc
+from unittest import mock
+
+import biom
+import numpy as np
+import pandas as pd
+import scipy.sparse
+
+from q2_sapienns._format import (HumannGeneFamilyFormat,
+                                 HumannGeneFamilyArrowDirectoryFormat,
+                                 MetaphlanMergedAbundanceFormat)
+from q2_sapienns._reader import (READER_ENV_VAR, read_humann_table, pyarrow,
+                                 metaphlan_table_chunks, read_metaphlan_table,
+                                 read_sparse_humann_table,
+                                 read_sparse_metaphlan_table, write_sidecar)
+from q2_sapienns._strata import (STRATIFIED, level_counts, level_mask,
+                                 taxonomy)
+from q2_sapienns._metaphlan import (SPLIT_LEVELS, frequency, metaphlan_levels,
+                                    metaphlan_taxon)
+
+
+def best_time(function, repeat=3):
+    """Return the fastest of repeat calls of function, in seconds"""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def peak_memory(function):
+    """Return the peak memory (in bytes) allocated while calling function"""
+    tracemalloc.start()
+    try:
+        function()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak
+
+
+def write_genefamily_table(filepath, n_features, n_samples,
+                           zero_fraction=0.8, seed=0):
+    """Write a random stratified HUMAnN gene family table to filepath"""
+    rng = np.random.default_rng(seed)
+    with open(filepath, 'w') as fh:
+        fh.write('# Gene Family\t%s\n' % '\t'.join(
+            'sample%d_Abundance-RPKs' % i for i in range(n_samples)))
+        for i in range(n_features):
+            values = rng.lognormal(3, 3, size=n_samples)
+            values[rng.random(n_samples) < zero_fraction] = 0
+            fh.write('UniRef90_%d|g__Genus.s__Species_%d\t%s\n' % (
+                i, i % 100, '\t'.join('%.17g' % v for v in values)))
+
+
+def scale_humann_table(filepath, scaled_filepath, n_copies):
+    """Write a HUMAnN table with the rows of filepath repeated n_copies times
+
+    The gene family (or pathway) of each copy of a row is suffixed with the
+    copy's number, so that the feature ids are unique and are stratified
+    like those of the original rows.
+    """
+    with open(filepath) as fh:
+        header = fh.readline()
+        rows = [line.rstrip('\n').partition('\t') for line in fh]
+    with open(scaled_filepath, 'w') as fh:
+        fh.write(header)
+        for i in range(n_copies):
+            for feature_id, tab, values in rows:
+                feature, delimiter, stratum = feature_id.partition('|')
+                fh.write('%s_%d%s%s%s%s\n' % (
+                    feature, i, delimiter, stratum, tab, values))
+
+
+def write_metaphlan_table(filepath, n_clades, n_samples, seed=0):
+    """Write a random MetaPhlAn merged abundance table to filepath
+
+    Each of the n_clades strains (t__) is written with its lineage, so the
+    table has rows at all eight levels, most of them at the strain level.
+    """
+    rng = np.random.default_rng(seed)
+    ranks = ['k', 'p', 'c', 'o', 'f', 'g', 's', 't']
+    fanout = [2, 4, 4, 4, 4, 4, 4, 8]
+    with open(filepath, 'w') as fh:
+        fh.write('#mpa_v30_CHOCOPhlAn_201901\n')
+        fh.write('clade_name\tNCBI_tax_id\t%s\n' % '\t'.join(
+            'sample%d' % i for i in range(n_samples)))
+        written = set()
+        for i in range(n_clades):
+            lineage = []
+            for rank, n in zip(ranks, fanout):
+                lineage.append('%s__%s%d' % (rank, rank, i % n))
+                i //= n
+                clade = '|'.join(lineage)
+                if clade in written:
+                    continue
+                written.add(clade)
+                values = rng.random(n_samples) * 100
+                fh.write('%s\t%s\t%s\n' % (
+                    clade, '|'.join(str(len(c)) for c in lineage),
+                    '\t'.join('%.5f' % v for v in values)))
+
+
+def benchmark_readers(temp_dir, n_features=100000, n_samples=100):
+    """Compare loading a gene family table with pandas and pyarrow"""
+    filepath = os.path.join(temp_dir, 'genefamilies.tsv')
+    write_genefamily_table(filepath, n_features, n_samples)
+    ff = HumannGeneFamilyFormat(filepath, mode='r')
+
+    readers = ['pandas'] if pyarrow is None else ['pandas', 'pyarrow']
+    times = {}
+    for reader in readers:
+        with mock.patch.dict(os.environ, {READER_ENV_VAR: reader}):
+            times[reader] = best_time(lambda: read_humann_table(ff))
+        print('%s reader: %.3fs' % (reader, times[reader]))
+    if pyarrow is None:
+        print('pyarrow is not installed.')
+    else:
+        print('pyarrow speedup: %.2fx (%d CPUs)' % (
+            times['pandas'] / times['pyarrow'], os.cpu_count()))
+
+
+def benchmark_sidecar(temp_dir, n_features=100000, n_samples=100):
+    """Compare loading a gene family table with and without its sidecar"""
+    if pyarrow is None:
+        print('pyarrow is not installed.')
+        return
+    dir_fmt = HumannGeneFamilyArrowDirectoryFormat(temp_dir, mode='r')
+    filepath = os.path.join(temp_dir, 'table.tsv')
+    write_genefamily_table(filepath, n_features, n_samples)
+    start = time.perf_counter()
+    write_sidecar(dir_fmt)
+    print('writing sidecar: %.3fs (%.1f MB table, %.1f MB sidecar)' % (
+        time.perf_counter() - start, os.path.getsize(filepath) / 1e6,
+        os.path.getsize(dir_fmt.sidecar_path()) / 1e6))
+
+    table_time = best_time(lambda: read_humann_table(
+        HumannGeneFamilyFormat(filepath, mode='r')))
+    sidecar_time = best_time(lambda: read_humann_table(dir_fmt))
+    print('table: %.3fs' % table_time)
+    print('sidecar: %.3fs' % sidecar_time)
+    print('sidecar speedup: %.2fx' % (table_time / sidecar_time))
+
+
+def benchmark_levels(temp_dir, n_clades=200000, n_samples=100, level=7):
+    """Compare loading one level of a MetaPhlAn table before and after
+    parsing it"""
+    filepath = os.path.join(temp_dir, 'metaphlan.tsv')
+    write_metaphlan_table(filepath, n_clades, n_samples)
+    ff = MetaphlanMergedAbundanceFormat(filepath, mode='r')
+
+    def select(feature_ids):
+        return level_mask(feature_ids, level)
+
+    after_time = best_time(lambda: read_sparse_metaphlan_table(
+        ff, select=select))
+    before_time = best_time(lambda: read_sparse_metaphlan_table(
+        ff, level=level))
+    print('filtering parsed rows: %.3fs' % after_time)
+    print('filtering lines: %.3fs' % before_time)
+    print('speedup: %.2fx' % (after_time / before_time))
+
+
+def benchmark_strata(temp_dir, n_clades=100000, n_samples=10, level=7):
+    """Compare counting the levels of MetaPhlAn feature ids, and rewriting
+    them as taxonomies, row by row and vectorized"""
+    filepath = os.path.join(temp_dir, 'metaphlan.tsv')
+    write_metaphlan_table(filepath, n_clades, n_samples)
+    table = read_metaphlan_table(
+        MetaphlanMergedAbundanceFormat(filepath, mode='r'))
+    feature_ids = table.index
+    print('%d feature ids' % len(feature_ids))
+
+    def by_row():
+        # as metaphlan_taxon originally did, with DataFrame.apply
+        stratified_table = table.reset_index()
+        n_levels = stratified_table.apply(
+            lambda x: len(x['feature-id'].split('|')), axis=1)
+        selected = stratified_table[n_levels == level]
+        taxa = selected['feature-id'].to_frame()
+        taxa['Taxon'] = taxa.apply(
+            lambda x: x['feature-id'].replace('|', '; '), axis=1)
+        return taxa.set_index('feature-id')
+
+    def by_id():
+        # with a str method per feature id
+        selected = [feature_id for feature_id in feature_ids
+                    if feature_id.count('|') == level - 1]
+        return pd.DataFrame(
+            {'Taxon': [feature_id.replace('|', '; ')
+                       for feature_id in selected]},
+            index=pd.Index(selected, name='Feature ID', dtype=object))
+
+    def vectorized():
+        mask = level_counts(feature_ids) == level
+        return taxonomy(feature_ids[mask])
+
+    times = {'DataFrame.apply': best_time(by_row),
+             'str methods': best_time(by_id),
+             'vectorized': best_time(vectorized)}
+    for name, seconds in times.items():
+        print('%s: %.4fs' % (name, seconds))
+    print('speedup over DataFrame.apply: %.1fx' %
+          (times['DataFrame.apply'] / times['vectorized']))
+    print('speedup over str methods: %.2fx' %
+          (times['str methods'] / times['vectorized']))
+
+
+def benchmark_split(temp_dir, n_clades=200000, n_samples=100):
+    """Compare splitting a MetaPhlAn table into all of its levels with
+    metaphlan_taxon (once per level) and with metaphlan_levels"""
+    filepath = os.path.join(temp_dir, 'metaphlan.tsv')
+    write_metaphlan_table(filepath, n_clades, n_samples)
+    table = metaphlan_table_chunks(
+        MetaphlanMergedAbundanceFormat(filepath, mode='r'))
+
+    def per_level():
+        return [metaphlan_taxon(table, level=level)
+                for level in range(1, len(SPLIT_LEVELS) + 1)]
+
+    per_level_time = best_time(per_level)
+    one_pass_time = best_time(lambda: metaphlan_levels(table))
+    print('metaphlan_taxon per level: %.3fs' % per_level_time)
+    print('metaphlan_levels: %.3fs' % one_pass_time)
+    print('speedup: %.2fx' % (per_level_time / one_pass_time))
+
+
+def benchmark_humann_split(temp_dir, n_copies=20000):
+    """Compare splitting a HUMAnN table into its stratified and unstratified
+    features row by row, after parsing it, and before parsing it"""
+    filepath = os.path.join(temp_dir, 'genefamilies.tsv')
+    scale_humann_table(os.path.join(os.path.dirname(__file__), 'data',
+                                    'humann-genefamilies-2.tsv'),
+                       filepath, n_copies)
+    ff = HumannGeneFamilyFormat(filepath, mode='r')
+
+    def by_row():
+        # as _humann originally did, with DataFrame.apply
+        table = read_humann_table(ff).reset_index()
+        unstratified = table.apply(
+            lambda x: '|' not in x['feature-id'], axis=1)
+        return table[unstratified], table[~unstratified]
+
+    def after_parsing():
+        return [read_sparse_humann_table(
+                    ff, select=lambda ids: level_mask(ids, level))
+                for level in [1, STRATIFIED]]
+
+    def before_parsing():
+        return [read_sparse_humann_table(ff, level=level)
+                for level in [1, STRATIFIED]]
+
+    times = {'DataFrame.apply': best_time(by_row),
+             'after parsing': best_time(after_parsing),
+             'before parsing': best_time(before_parsing)}
+    for name, seconds in times.items():
+        print('%s: %.3fs' % (name, seconds))
+    print('speedup over DataFrame.apply: %.1fx' %
+          (times['DataFrame.apply'] / times['before parsing']))
+    print('speedup over filtering after parsing: %.2fx' %
+          (times['after parsing'] / times['before parsing']))
+
+
+def relative_frequencies(n_samples, n_features, density=0.1, seed=0):
+    """Return a biom.Table of random relative frequencies (in percent)"""
+    rng = np.random.default_rng(seed)
+    values = rng.lognormal(0, 2, size=(n_samples, n_features))
+    values[rng.random(values.shape) > density] = 0
+    values *= 100 / values.sum(axis=1, keepdims=True)
+    return biom.Table(scipy.sparse.csr_matrix(values.T),
+                      ['f%d' % i for i in range(n_features)],
+                      ['s%d' % i for i in range(n_samples)])
+
+
+def benchmark_frequency(temp_dir, n_samples=2000, n_features=20000,
+                        target_freq=100000):
+    """Compare the rounding methods of frequency"""
+    table = relative_frequencies(n_samples, n_features)
+    dense_size = n_samples * n_features * 8
+    for rounding in 'round', 'largest-remainder':
+        result = frequency(table, target_freq, rounding)
+        totals = result.sum(axis='sample')
+        print('%s: %.3fs, samples not totalling target_freq: %d, peak '
+              'memory %.2fx the dense table' %
+              (rounding, best_time(lambda: frequency(table, target_freq,
+                                                     rounding)),
+               (totals != target_freq).sum(),
+               peak_memory(lambda: frequency(table, target_freq,
+                                             rounding)) / dense_size))
+
+
+def benchmark_multinomial(temp_dir, n_samples=20000, n_features=1000,
+                          target_freq=100000, n_threads=4):
+    """Time drawing frequencies from multinomials, and report the features
+    that are rounded to zero but drawn"""
+    table = relative_frequencies(n_samples, n_features)
+    for n in 1, n_threads:
+        print('multinomial, %d thread(s): %.3fs' %
+              (n, best_time(lambda: frequency(table, target_freq,
+                                              'multinomial', n_threads=n))))
+    stored = table.matrix_data.toarray() > 0
+    rounded = frequency(table, target_freq).matrix_data.toarray()
+    drawn = frequency(table, target_freq,
+                      'multinomial').matrix_data.toarray()
+    print('non-zero relative frequencies rounded to zero: %d, of which '
+          'drawn: %d' % ((stored & (rounded == 0)).sum(),
+                         ((rounded == 0) & (drawn > 0)).sum()))
+
+
+BENCHMARKS = {
+    'frequency': benchmark_frequency,
+    'humann-split': benchmark_humann_split,
+    'readers': benchmark_readers,
+    'levels': benchmark_levels,
+    'multinomial': benchmark_multinomial,
+    'sidecar': benchmark_sidecar,
+    'split': benchmark_split,
+    'strata': benchmark_strata,
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('benchmarks', nargs='*', metavar='benchmark',
+                        help='The benchmarks to run: %s (default: all).' %
+                        ', '.join(BENCHMARKS))
+    args = parser.parse_args(argv)
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error('Unknown benchmark: %s' % name)
+    for name in args.benchmarks or BENCHMARKS:
+        print('== %s ==' % name)
+        with tempfile.TemporaryDirectory() as temp_dir:
+            BENCHMARKS[name](temp_dir)
+
+
+if __name__ == '__main__':
+    main()
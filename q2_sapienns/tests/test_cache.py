@@ -0,0 +1,104 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2022, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from qiime2.plugin import ValidationError
+
+from q2_sapienns._cache import (
+    cached_validation, CACHE_DIR_ENV_VAR, CACHE_SIZE_ENV_VAR)
+
+
+class CachedValidationTests(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory(
+            prefix='q2-sapienns-test-temp-')
+        self.cache_dir = os.path.join(self.temp_dir.name, 'cache')
+        self.filepath = os.path.join(self.temp_dir.name, 'table.tsv')
+        with open(self.filepath, 'w') as fh:
+            fh.write('# Pathway\tsample1_Abundance\nUNMAPPED\t140.0\n')
+        self.n_calls = 0
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def _valid(self):
+        self.n_calls += 1
+
+    def _invalid(self):
+        self.n_calls += 1
+        raise ValidationError('Bad table.')
+
+    def _entries(self):
+        return [e for e in os.listdir(self.cache_dir) if e.endswith('.json')]
+
+    def test_disabled_by_default(self):
+        with mock.patch.dict(os.environ, clear=True):
+            cached_validation(self.filepath, 'Fmt', 'max', self._valid)
+            cached_validation(self.filepath, 'Fmt', 'max', self._valid)
+        self.assertEqual(self.n_calls, 2)
+        self.assertFalse(os.path.exists(self.cache_dir))
+
+    def test_valid_result_cached(self):
+        with mock.patch.dict(os.environ, {CACHE_DIR_ENV_VAR: self.cache_dir}):
+            cached_validation(self.filepath, 'Fmt', 'max', self._valid)
+            cached_validation(self.filepath, 'Fmt', 'max', self._valid)
+            self.assertEqual(self.n_calls, 1)
+
+            # different formats and levels are cached independently
+            cached_validation(self.filepath, 'OtherFmt', 'max', self._valid)
+            self.assertEqual(self.n_calls, 2)
+            cached_validation(self.filepath, 'Fmt', 'min', self._valid)
+            cached_validation(self.filepath, 'Fmt', 'min', self._valid)
+            self.assertEqual(self.n_calls, 4)
+
+    def test_invalid_result_cached(self):
+        with mock.patch.dict(os.environ, {CACHE_DIR_ENV_VAR: self.cache_dir}):
+            for _ in range(2):
+                with self.assertRaisesRegex(ValidationError, 'Bad table'):
+                    cached_validation(self.filepath, 'Fmt', 'max',
+                                      self._invalid)
+        self.assertEqual(self.n_calls, 1)
+
+    def test_modified_file_revalidated(self):
+        with mock.patch.dict(os.environ, {CACHE_DIR_ENV_VAR: self.cache_dir}):
+            cached_validation(self.filepath, 'Fmt', 'max', self._valid)
+            stat = os.stat(self.filepath)
+            with open(self.filepath, 'w') as fh:
+                fh.write('# Pathway\tsample1_Abundance\nUNMAPPED\t999.0\n')
+            # same size and modification time, different content
+            os.utime(self.filepath, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+            cached_validation(self.filepath, 'Fmt', 'max', self._valid)
+        self.assertEqual(self.n_calls, 2)
+
+    def test_least_recently_used_evicted(self):
+        env = {CACHE_DIR_ENV_VAR: self.cache_dir, CACHE_SIZE_ENV_VAR: '2'}
+        with mock.patch.dict(os.environ, env):
+            cached_validation(self.filepath, 'Fmt1', 'max', self._valid)
+            cached_validation(self.filepath, 'Fmt2', 'max', self._valid)
+            for entry in self._entries():
+                os.utime(os.path.join(self.cache_dir, entry), ns=(0, 0))
+            # make Fmt1 the most recently used entry
+            cached_validation(self.filepath, 'Fmt1', 'max', self._valid)
+            cached_validation(self.filepath, 'Fmt3', 'max', self._valid)
+            self.assertEqual(len(self._entries()), 2)
+            self.assertEqual(self.n_calls, 3)
+
+            cached_validation(self.filepath, 'Fmt1', 'max', self._valid)
+            cached_validation(self.filepath, 'Fmt3', 'max', self._valid)
+            self.assertEqual(self.n_calls, 3)
+            cached_validation(self.filepath, 'Fmt2', 'max', self._valid)
+            self.assertEqual(self.n_calls, 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2022, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import gzip
+import os
+import unittest
+
+from qiime2.plugin.testing import TestPluginBase
+
+from q2_sapienns._compression import (
+    detect_compression, open_decompressed, zstandard, DECOMPRESSION_ERRORS)
+
+
+class CompressionTests(TestPluginBase):
+    package = 'q2_sapienns.tests'
+
+    def test_detect_compression(self):
+        for filename, exp in [
+                ('humann-genefamilies-2.tsv.gz', 'gzip'),
+                ('humann-pathabundance-2.tsv.bz2', 'bzip2'),
+                ('metaphlan-merged-abundance-1.tsv.xz', 'xz'),
+                ('humann-genefamilies-2.tsv.zst', 'zstd'),
+                ('humann-genefamilies-2.tsv', None)]:
+            obs = detect_compression(self.get_data_path(filename))
+            self.assertEqual(obs, exp)
+
+    def test_open_decompressed(self):
+        filenames = ['humann-genefamilies-2.tsv.gz',
+                     'humann-pathabundance-2.tsv.bz2',
+                     'metaphlan-merged-abundance-1.tsv.xz']
+        if zstandard is not None:
+            filenames.append('humann-genefamilies-2.tsv.zst')
+        for filename in filenames:
+            with open(self.get_data_path(filename.rsplit('.', 1)[0])) as fh:
+                exp = fh.read()
+            with open_decompressed(self.get_data_path(filename)) as fh:
+                self.assertEqual(fh.read(), exp)
+            with open_decompressed(self.get_data_path(filename),
+                                   text=False) as fh:
+                self.assertEqual(fh.read(), exp.encode('utf-8'))
+
+    def test_open_decompressed_line_by_line(self):
+        with open(self.get_data_path('humann-genefamilies-2.tsv')) as fh:
+            exp = list(fh)
+        with open_decompressed(
+                self.get_data_path('humann-genefamilies-2.tsv.gz')) as fh:
+            self.assertEqual(list(fh), exp)
+
+    def test_open_decompressed_truncated(self):
+        filepath = self.get_data_path('humann-genefamilies-truncated.tsv.gz')
+        with open_decompressed(filepath) as fh:
+            with self.assertRaises(DECOMPRESSION_ERRORS):
+                fh.read()
+
+    def test_close_before_end(self):
+        filepath = os.path.join(self.temp_dir.name, 'table.tsv.gz')
+        with gzip.open(filepath, 'wb') as fh:
+            fh.write(b'x' * (20 * 1024 ** 2))
+        with open_decompressed(filepath, text=False) as fh:
+            self.assertEqual(fh.read(10), b'x' * 10)
+
+    def test_open_uncompressed(self):
+        with self.assertRaisesRegex(ValueError, 'not compressed'):
+            open_decompressed(self.get_data_path('humann-genefamilies-2.tsv'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -7,10 +7,23 @@
 # ----------------------------------------------------------------------------
 
 from q2_sapienns import (
+    ArrowTableFormat,
+    CompressedHumannGeneFamilyFormat,
+    CompressedHumannPathAbundanceFormat,
+    CompressedMetaphlanMergedAbundanceFormat,
+    HumannGeneFamilyArrowDirectoryFormat,
     HumannGeneFamilyFormat,
     HumannPathAbundanceFormat,
     MetaphlanMergedAbundanceFormat,
 )
+from q2_sapienns._reader import pyarrow, write_sidecar
+import os
+import shutil
+import tracemalloc
+import unittest
+import warnings
+from unittest import mock
+
 from qiime2.plugin import ValidationError
 from qiime2.plugin.testing import TestPluginBase
 
@@ -48,6 +61,69 @@ class TestHumannGeneFamilyFormat(TestPluginBase):
                 format = HumannGeneFamilyFormat(filepath, mode='r')
                 format.validate()
 
+    def test_genefamily_format_min_validation_sampled(self):
+        filepath = os.path.join(self.temp_dir.name, 'table.tsv')
+        with open(filepath, 'w') as fh:
+            fh.write('# Gene Family\tsample1_Abundance-RPKs\n')
+            for i in range(100):
+                fh.write('UniRef50_%d\t1.0\n' % i)
+            fh.write('UniRef50_x\t1.0\t1.0\n')
+
+        format = HumannGeneFamilyFormat(filepath, mode='r')
+        format.validate(level='min')
+
+        with mock.patch.dict(os.environ,
+                             {'Q2_SAPIENNS_VALIDATION_SAMPLE_SIZE': '10'}):
+            with self.assertRaisesRegex(ValidationError,
+                                        'line starting at byte'):
+                format.validate(level='min')
+
+    def test_genefamily_format_min_validation_sampled_confidence(self):
+        filepath = os.path.join(self.temp_dir.name, 'table.tsv')
+        with open(filepath, 'w') as fh:
+            fh.write('# Gene Family\tsample1_Abundance-RPKs\n')
+            for i in range(1000):
+                fh.write('UniRef50_%d\t1.0\n' % i)
+
+        format = HumannGeneFamilyFormat(filepath, mode='r')
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            format.validate(level='min')
+        self.assertEqual(caught, [])
+
+        with mock.patch.dict(os.environ,
+                             {'Q2_SAPIENNS_VALIDATION_SAMPLE_SIZE': '100'}):
+            with self.assertWarnsRegex(
+                    UserWarning,
+                    r'Validated \d+ randomly sampled rows of table.tsv.*'
+                    r'fewer than 1% of its rows are invalid is \d+\.\d%'):
+                format.validate(level='min')
+        summary = format.sample_summary
+        self.assertGreater(summary.n_rows, 50)
+        self.assertAlmostEqual(summary.confidence,
+                               1 - 0.99 ** summary.n_rows)
+
+        # an unchanged file isn't sampled again, as it's validated by every
+        # transformer
+        format = HumannGeneFamilyFormat(filepath, mode='r')
+        with mock.patch.dict(os.environ,
+                             {'Q2_SAPIENNS_VALIDATION_SAMPLE_SIZE': '100'}):
+            with mock.patch('q2_sapienns._format.validate_sample',
+                            side_effect=AssertionError):
+                with warnings.catch_warnings(record=True) as caught:
+                    warnings.simplefilter('always')
+                    format.validate(level='min')
+        self.assertEqual(caught, [])
+        self.assertEqual(format.sample_summary, summary)
+
+        # ... unless it has changed
+        with open(filepath, 'a') as fh:
+            fh.write('UniRef50_x\t1.0\n')
+        with mock.patch.dict(os.environ,
+                             {'Q2_SAPIENNS_VALIDATION_SAMPLE_SIZE': '100'}):
+            with self.assertWarnsRegex(UserWarning, 'randomly sampled'):
+                format.validate(level='min')
+
 
 class TestHumannPathAbundanceFormat(TestPluginBase):
     package = 'q2_sapienns.tests'
@@ -82,6 +158,33 @@ class TestHumannPathAbundanceFormat(TestPluginBase):
                 format = HumannPathAbundanceFormat(filepath, mode='r')
                 format.validate()
 
+    def test_pathabundance_format_inconsistent_columns(self):
+        filenames = ['humann-pathabundance-5.tsv']
+        filepaths = [self.get_data_path(filename)
+                     for filename in filenames]
+
+        for filepath in filepaths:
+            with self.assertRaisesRegex(ValidationError,
+                                        'columns on line 6 is inconsistent'):
+                format = HumannPathAbundanceFormat(filepath, mode='r')
+                format.validate()
+
+    def test_pathabundance_format_byte_level_validation(self):
+        with mock.patch.dict(os.environ,
+                             {'Q2_SAPIENNS_VALIDATION_MODE': 'bytes'}):
+            for filename in ['humann-pathabundance-1.tsv',
+                             'humann-pathabundance-2.tsv']:
+                format = HumannPathAbundanceFormat(
+                    self.get_data_path(filename), mode='r')
+                format.validate()
+
+            with self.assertRaisesRegex(ValidationError,
+                                        'columns on line 6 is inconsistent'):
+                format = HumannPathAbundanceFormat(
+                    self.get_data_path('humann-pathabundance-5.tsv'),
+                    mode='r')
+                format.validate()
+
 
 class TestMetaphlanMergedAbundanceFormat(TestPluginBase):
     package = 'q2_sapienns.tests'
@@ -134,3 +237,205 @@ class TestMetaphlanMergedAbundanceFormat(TestPluginBase):
             with self.assertRaisesRegex(ValidationError, 'float.*abc'):
                 format = MetaphlanMergedAbundanceFormat(filepath, mode='r')
                 format.validate()
+
+    def test_metaphlan_merged_abundance_format_inconsistent_columns(self):
+        filenames = ['metaphlan-merged-abundance-7.tsv']
+        filepaths = [self.get_data_path(filename)
+                     for filename in filenames]
+
+        for filepath in filepaths:
+            with self.assertRaisesRegex(ValidationError,
+                                        'columns on line 7 is inconsistent'):
+                format = MetaphlanMergedAbundanceFormat(filepath, mode='r')
+                format.validate()
+
+    def test_metaphlan_merged_abundance_format_reports_line(self):
+        filenames = ['metaphlan-merged-abundance-3.tsv']
+        filepaths = [self.get_data_path(filename)
+                     for filename in filenames]
+
+        for filepath in filepaths:
+            with self.assertRaisesRegex(ValidationError, r'100\.001.*line 4'):
+                format = MetaphlanMergedAbundanceFormat(filepath, mode='r')
+                format.validate()
+
+
+class TestCompressedFormats(TestPluginBase):
+    package = 'q2_sapienns.tests'
+
+    def test_compressed_formats_valid(self):
+        for format_cls, filename in [
+                (CompressedHumannGeneFamilyFormat,
+                 'humann-genefamilies-2.tsv.gz'),
+                (CompressedHumannPathAbundanceFormat,
+                 'humann-pathabundance-2.tsv.bz2'),
+                (CompressedMetaphlanMergedAbundanceFormat,
+                 'metaphlan-merged-abundance-1.tsv.xz')]:
+            for level in ['min', 'max']:
+                format = format_cls(self.get_data_path(filename), mode='r')
+                format.validate(level=level)
+
+    def test_compressed_format_inconsistent_columns(self):
+        filepath = self.get_data_path('humann-pathabundance-5.tsv.gz')
+        with self.assertRaisesRegex(ValidationError,
+                                    'columns on line 6 is inconsistent'):
+            format = CompressedHumannPathAbundanceFormat(filepath, mode='r')
+            format.validate()
+
+    def test_compressed_format_truncated(self):
+        filepath = self.get_data_path('humann-genefamilies-truncated.tsv.gz')
+        with self.assertRaisesRegex(ValidationError, 'Could not decompress'):
+            format = CompressedHumannGeneFamilyFormat(filepath, mode='r')
+            format.validate()
+
+    def test_compressed_format_uncompressed_input(self):
+        filepath = self.get_data_path('humann-genefamilies-2.tsv')
+        with self.assertRaisesRegex(ValidationError, 'not compressed'):
+            format = CompressedHumannGeneFamilyFormat(filepath, mode='r')
+            format.validate()
+
+
+class TestArrowFormats(TestPluginBase):
+    package = 'q2_sapienns.tests'
+
+    def _dir_fmt(self, filename):
+        dir_fmt = HumannGeneFamilyArrowDirectoryFormat(
+            self.temp_dir.name, mode='r')
+        shutil.copyfile(self.get_data_path(filename),
+                        os.path.join(self.temp_dir.name, 'table.tsv'))
+        return dir_fmt
+
+    @unittest.skipIf(pyarrow is None, 'pyarrow is not installed')
+    def test_arrow_directory_format_valid(self):
+        dir_fmt = self._dir_fmt('humann-genefamilies-2.tsv')
+        write_sidecar(dir_fmt)
+        dir_fmt.validate()
+        ArrowTableFormat(dir_fmt.sidecar_path(), mode='r').validate()
+
+    @unittest.skipIf(pyarrow is None, 'pyarrow is not installed')
+    def test_arrow_directory_format_long_rows(self):
+        # a row longer than the blocks estimated from the first rows is
+        # read in a larger block
+        long_id = 'UniRef90_' + 'A' * 5000
+        with open(os.path.join(self.temp_dir.name, 'table.tsv'), 'w') as fh:
+            fh.write('# Gene Family\tS1\tS2\n')
+            for i in range(2000):
+                fh.write('F%d\t1.0\t2.0\n' % i)
+            fh.write('%s\t3.0\t4.0\n' % long_id)
+        dir_fmt = HumannGeneFamilyArrowDirectoryFormat(
+            self.temp_dir.name, mode='r')
+
+        with mock.patch('q2_sapienns._reader.CHUNK_SIZE', 10), \
+                mock.patch('q2_sapienns._reader.MIN_ARROW_BLOCK_SIZE', 64):
+            write_sidecar(dir_fmt)
+
+        with pyarrow.ipc.open_file(dir_fmt.sidecar_path()) as reader:
+            table = reader.read_all()
+        self.assertEqual(table.num_rows, 2001)
+        self.assertEqual(table.column(0)[2000].as_py(), long_id)
+        self.assertEqual(table.column('S2').to_pylist(),
+                         [2.0] * 2000 + [4.0])
+
+    @unittest.skipIf(pyarrow is None, 'pyarrow is not installed')
+    def test_arrow_directory_format_stale_sidecar(self):
+        # at the 'max' level, the sidecar must have been written from the
+        # table as it is
+        dir_fmt = self._dir_fmt('humann-genefamilies-2.tsv')
+        write_sidecar(dir_fmt)
+        filepath = os.path.join(self.temp_dir.name, 'table.tsv')
+        with open(filepath) as fh:
+            contents = fh.read()
+        with open(filepath, 'w') as fh:
+            fh.write(contents.replace('150.0', '151.0'))
+
+        dir_fmt.validate(level='min')
+        self.assertEqual(dir_fmt.current_sidecar_path(),
+                         dir_fmt.sidecar_path())
+        with self.assertRaisesRegex(ValidationError,
+                                    'table.arrow was not written from '
+                                    'table.tsv'):
+            dir_fmt.validate()
+
+        # nor is a sidecar without the table's size and digest valid
+        with open(filepath, 'w') as fh:
+            fh.write(contents)
+        dir_fmt.validate()
+        with pyarrow.ipc.open_file(dir_fmt.sidecar_path()) as reader:
+            table = reader.read_all()
+        with pyarrow.ipc.new_file(dir_fmt.sidecar_path(),
+                                  table.schema.remove_metadata()) as writer:
+            writer.write_table(table)
+        self.assertIsNone(dir_fmt.current_sidecar_path())
+        with self.assertRaisesRegex(ValidationError, 'table.arrow'):
+            dir_fmt.validate()
+
+    def test_arrow_directory_format_without_sidecar(self):
+        dir_fmt = self._dir_fmt('humann-genefamilies-2.tsv')
+        dir_fmt.validate()
+        self.assertIsNone(dir_fmt.sidecar_path())
+
+    def test_arrow_directory_format_invalid_table(self):
+        dir_fmt = self._dir_fmt('humann-genefamilies-3.tsv')
+        with self.assertRaisesRegex(ValidationError, 'unit descriptor'):
+            dir_fmt.validate()
+
+    def test_arrow_table_format_invalid(self):
+        filepath = self.get_data_path('humann-genefamilies-2.tsv')
+        with self.assertRaisesRegex(ValidationError, 'not an Arrow IPC'):
+            ArrowTableFormat(filepath, mode='r').validate()
+
+        filepath = os.path.join(self.temp_dir.name, 'empty.arrow')
+        open(filepath, 'w').close()
+        with self.assertRaisesRegex(ValidationError, 'too short'):
+            ArrowTableFormat(filepath, mode='r').validate()
+
+    @unittest.skipIf(pyarrow is None, 'pyarrow is not installed')
+    def test_arrow_table_format_unreadable(self):
+        # the magic bytes are only checked at the 'min' level
+        filepath = os.path.join(self.temp_dir.name, 'table.arrow')
+        with open(filepath, 'wb') as fh:
+            fh.write(b'ARROW1' + b'\0' * 100 + b'ARROW1')
+        ArrowTableFormat(filepath, mode='r').validate(level='min')
+        with self.assertRaisesRegex(ValidationError, 'could not be read'):
+            ArrowTableFormat(filepath, mode='r').validate()
+
+
+class TestValidationMemory(TestPluginBase):
+    package = 'q2_sapienns.tests'
+
+    def _write(self, filename, header, n_rows, row):
+        filepath = os.path.join(self.temp_dir.name, filename)
+        with open(filepath, 'w') as fh:
+            fh.write(header)
+            for i in range(n_rows):
+                fh.write(row % i)
+        return filepath
+
+    def _peak(self, fmt, filepath):
+        ff = fmt(filepath, mode='r')
+        tracemalloc.start()
+        try:
+            ff.validate(level='max')
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        return peak
+
+    def test_max_validation_memory_is_bounded(self):
+        samples = ['s%d' % i for i in range(20)]
+        for fmt, header, row in [
+                (HumannGeneFamilyFormat,
+                 '# Gene Family\t%s\n' % '\t'.join(
+                     s + '_Abundance-RPKs' for s in samples),
+                 'UniRef90_%d' + '\t1.5' * len(samples) + '\n'),
+                (MetaphlanMergedAbundanceFormat,
+                 '#mpa_v30_CHOCOPhlAn_201901\nclade_name\tNCBI_tax_id\t%s\n'
+                 % '\t'.join(samples),
+                 'k__A|s__%d\t2|3' + '\t1.5' * len(samples) + '\n')]:
+            small = self._write('small.tsv', header, 20000, row)
+            large = self._write('large.tsv', header, 80000, row)
+            small_peak = self._peak(fmt, small)
+            large_peak = self._peak(fmt, large)
+            # the table is validated a block of rows at a time, so the
+            # memory used doesn't grow with its size
+            self.assertLess(large_peak, 1.5 * small_peak)
@@ -0,0 +1,245 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2022, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import unittest
+from unittest import mock
+
+import numpy as np
+import scipy.sparse
+
+from q2_sapienns._frequency import (check_rounding, multinomial,
+                                    sparse_to_frequencies)
+
+
+def _to_frequencies(values, target_freq, rounding='round', **kwargs):
+    # Convert a dense array of the relative frequencies of the features
+    # (columns) of each sample (rows).
+    matrix = scipy.sparse.csr_matrix(np.asarray(values, dtype=float).T)
+    return sparse_to_frequencies(matrix, target_freq, rounding,
+                                 **kwargs).toarray().T
+
+
+def _largest_remainder(row, total):
+    # Hamilton's method for one sample, giving equal remainders counts from
+    # the first feature on. The values are summed in order, as they are by
+    # sparse_to_frequencies.
+    row_sum = 0.0
+    for value in row[row != 0]:
+        row_sum += value
+    if row_sum == 0:
+        return np.zeros(len(row))
+    scaled = row * (total / row_sum)
+    floored = np.floor(scaled)
+    remaining = int(round(total - floored.sum()))
+    largest = np.argsort(floored - scaled, kind='stable')[:remaining]
+    floored[largest] += 1
+    return floored
+
+
+class FrequencyTests(unittest.TestCase):
+
+    def test_check_rounding(self):
+        check_rounding('round')
+        check_rounding('largest-remainder')
+        check_rounding('multinomial')
+        with self.assertRaisesRegex(ValueError, 'Found: floor'):
+            check_rounding('floor')
+
+    def test_largest_remainder(self):
+        obs = _to_frequencies([[1.0, 1.0, 1.0],
+                               [0.0, 0.0, 0.0],
+                               [2.0, 1.0, 0.0],
+                               [0.5, 0.0, 99.5]], 10, 'largest-remainder')
+        np.testing.assert_array_equal(obs, [[4, 3, 3],
+                                            [0, 0, 0],
+                                            [7, 3, 0],
+                                            [0, 0, 10]])
+
+        # no counts remain once the values are floored
+        np.testing.assert_array_equal(
+            _to_frequencies([[25.0, 75.0]], 100, 'largest-remainder'),
+            [[25, 75]])
+        self.assertEqual(
+            _to_frequencies(np.zeros((0, 3)), 10, 'largest-remainder').shape,
+            (0, 3))
+
+    def test_largest_remainder_matches_per_sample(self):
+        rng = np.random.default_rng(0)
+        values = rng.dirichlet(np.ones(40), size=200) * 100
+        values[rng.random(values.shape) < 0.5] = 0
+        for total in [1, 13, 100000]:
+            obs = _to_frequencies(values, total, 'largest-remainder')
+            for row, counts in zip(values, obs):
+                np.testing.assert_array_equal(counts,
+                                              _largest_remainder(row, total))
+            np.testing.assert_array_equal(obs.sum(axis=1), total)
+
+    def test_largest_remainder_ties(self):
+        # equal remainders are given counts from the first feature on
+        np.testing.assert_array_equal(
+            _to_frequencies([[1.0, 1.0, 1.0, 1.0, 1.0, 1.0]], 4,
+                            'largest-remainder'),
+            [[1, 1, 1, 1, 0, 0]])
+        np.testing.assert_array_equal(
+            _to_frequencies([[2.0, 1.0, 1.0, 1.0, 0.0, 1.0]], 4,
+                            'largest-remainder'),
+            [[1, 1, 1, 1, 0, 0]])
+
+        # relative frequencies rounded to 0.1 have many equal remainders
+        rng = np.random.default_rng(0)
+        values = np.round(rng.dirichlet(np.ones(50), size=300) * 100, 1)
+        values[rng.random(values.shape) < 0.6] = 0
+        for total in [1, 7, 13, 1000, 100000]:
+            obs = _to_frequencies(values, total, 'largest-remainder')
+            for row, counts in zip(values, obs):
+                np.testing.assert_array_equal(counts,
+                                              _largest_remainder(row, total))
+
+    def test_sparse_to_frequencies(self):
+        rng = np.random.default_rng(0)
+        values = rng.dirichlet(np.ones(60), size=40) * 100
+        values[rng.random(values.shape) < 0.8] = 0
+        values[3] = 0
+        for rounding in ['round', 'largest-remainder']:
+            for target_freq in [1, 50, 100000]:
+                if rounding == 'round':
+                    exp = np.rint(values * (target_freq / 100))
+                else:
+                    exp = np.array([_largest_remainder(row, target_freq)
+                                    for row in values])
+                # samples are the columns of the sparse matrix
+                matrix = scipy.sparse.csr_matrix(values.T)
+                obs = sparse_to_frequencies(matrix, target_freq, rounding)
+                self.assertIsInstance(obs, scipy.sparse.csr_matrix)
+                self.assertEqual(obs.dtype, np.float64)
+                np.testing.assert_array_equal(obs.toarray(), exp.T)
+                # the frequencies that are rounded to zero aren't stored
+                self.assertEqual(obs.nnz, np.count_nonzero(exp))
+                self.assertTrue((obs.data != 0).all())
+                # the input isn't changed
+                np.testing.assert_array_equal(matrix.toarray(), values.T)
+
+        # float32 values are scaled in float64
+        obs = _to_frequencies(values.astype(np.float32), 100000)
+        np.testing.assert_array_equal(
+            obs, np.rint(values.astype(np.float32).astype(np.float64) *
+                         1000))
+
+    def test_sparse_to_frequencies_csc(self):
+        matrix = scipy.sparse.csc_matrix(np.array([[1.0, 0.0, 0.0],
+                                                   [1.0, 0.0, 99.5],
+                                                   [1.0, 0.0, 0.5]]))
+        obs = sparse_to_frequencies(matrix, 10, 'largest-remainder')
+        self.assertEqual(obs.dtype, np.float64)
+        np.testing.assert_array_equal(obs.toarray(), [[4, 0, 0],
+                                                      [3, 0, 10],
+                                                      [3, 0, 0]])
+        self.assertEqual(obs.nnz, 4)
+        self.assertEqual(matrix.nnz, 5)
+
+        obs = sparse_to_frequencies(scipy.sparse.csr_matrix((0, 2)), 10,
+                                    'largest-remainder')
+        self.assertEqual(obs.shape, (0, 2))
+
+    def test_multinomial(self):
+        values = np.array([[0.0, 0.0, 0.0],
+                           [1.0, 0.0, 3.0],
+                           [0.0, 5.0, 0.0]])
+        obs = multinomial(values, 1000, np.random.default_rng(0))
+        np.testing.assert_array_equal(obs.sum(axis=1), [0, 1000, 1000])
+        np.testing.assert_array_equal(obs[values == 0], 0)
+        self.assertEqual(obs[2, 1], 1000)
+        # the counts are proportional to the values, on average
+        self.assertLess(abs(obs[1, 0] - 250), 50)
+
+    def test_multinomial_probabilities(self):
+        # the probabilities of a selection of columns (which isn't
+        # C-contiguous) are those of a contiguous copy, to the last bit
+        class Generator:
+            def multinomial(self, n, pvals):
+                self.pvals = pvals
+                return np.zeros(pvals.shape, dtype=np.int64)
+
+        rng = np.random.default_rng(0)
+        values = rng.random((50, 400))
+        columns = np.flatnonzero(rng.random(400) < 0.7)
+        obs, exp = Generator(), Generator()
+        multinomial(values[:, columns], 1000, obs)
+        multinomial(np.ascontiguousarray(values[:, columns]), 1000, exp)
+        np.testing.assert_array_equal(obs.pvals, exp.pvals)
+
+    def _multinomial_values(self):
+        rng = np.random.default_rng(0)
+        values = rng.dirichlet(np.ones(50), size=300) * 100
+        values[rng.random(values.shape) < 0.7] = 0
+        values[5] = 0
+        values[:, 7] = 0
+        return values
+
+    def test_sparse_to_frequencies_multinomial(self):
+        values = self._multinomial_values()
+        obs = sparse_to_frequencies(scipy.sparse.csr_matrix(values.T),
+                                    100000, 'multinomial', seed=1)
+        self.assertIsInstance(obs, scipy.sparse.csr_matrix)
+        self.assertEqual(obs.dtype, np.float64)
+        obs = obs.toarray().T
+        exp_totals = np.full(300, 100000)
+        exp_totals[5] = 0
+        np.testing.assert_array_equal(obs.sum(axis=1), exp_totals)
+        np.testing.assert_array_equal(obs[values == 0], 0)
+
+        # the same frequencies are drawn with the same seed, for any number
+        # of threads, and different frequencies with another seed
+        np.testing.assert_array_equal(
+            _to_frequencies(values, 100000, 'multinomial', seed=1), obs)
+        with mock.patch('q2_sapienns._frequency.BLOCK_VALUES', 500):
+            exp = _to_frequencies(values, 100000, 'multinomial', seed=1)
+            obs = _to_frequencies(values, 100000, 'multinomial', seed=1,
+                                  n_threads=3)
+            np.testing.assert_array_equal(obs, exp)
+        self.assertFalse(np.array_equal(
+            _to_frequencies(values, 100000, 'multinomial', seed=2), obs))
+
+        obs = sparse_to_frequencies(scipy.sparse.csr_matrix((3, 2)), 10,
+                                    'multinomial')
+        self.assertEqual(obs.shape, (3, 2))
+        self.assertEqual(obs.nnz, 0)
+        self.assertEqual(obs.dtype, np.float64)
+
+    def test_sparse_to_frequencies_multinomial_rare_features(self):
+        # rounding drops features below 0.5 / target_freq of a sample, but
+        # they are drawn in proportion to their relative frequencies
+        values = np.tile([99.0, 1.0], (2000, 1))
+        self.assertEqual(_to_frequencies(values, 10)[:, 1].sum(), 0)
+        obs = _to_frequencies(values, 10, 'multinomial', seed=0)
+        self.assertLess(abs(obs[:, 1].sum() - 200), 50)
+
+    def test_sparse_to_frequencies_multinomial_random_tables(self):
+        # the frequencies drawn for blocks of samples, whose features are a
+        # selection of the features of the table, don't depend on the
+        # number of threads, and are only drawn for non-zero values
+        for seed in range(20):
+            rng = np.random.default_rng(seed)
+            n_samples, n_features = rng.integers(1, 300, size=2)
+            values = rng.dirichlet(np.ones(n_features), size=n_samples)
+            values[rng.random(values.shape) < rng.random()] = 0
+            values = values * 100
+            with mock.patch('q2_sapienns._frequency.BLOCK_VALUES',
+                            int(rng.integers(1, 5000))):
+                exp = _to_frequencies(values, 1000, 'multinomial',
+                                      seed=seed)
+                obs = _to_frequencies(values, 1000, 'multinomial',
+                                      seed=seed, n_threads=2)
+            np.testing.assert_array_equal(obs, exp)
+            np.testing.assert_array_equal(obs[values == 0], 0)
+            np.testing.assert_array_equal(
+                obs.sum(axis=1), np.where(values.any(axis=1), 1000, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
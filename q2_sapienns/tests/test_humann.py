@@ -6,12 +6,30 @@
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
 
+import os
+import tracemalloc
+from unittest import mock
+
+import biom
+import numpy as np
 import pandas as pd
+from pandas.testing import assert_frame_equal
 
+from qiime2 import Artifact, Metadata
 from qiime2.plugin.testing import TestPluginBase
 
-from q2_sapienns import HumannGeneFamilyFormat, HumannPathAbundanceFormat
-from q2_sapienns._humann import humann_genefamily, humann_pathway
+from q2_sapienns import (HumannGeneFamilyFormat, HumannPathAbundanceFormat,
+                         HumannGeneFamilyArrowDirectoryFormat,
+                         HumannPathAbundanceArrowDirectoryFormat,
+                         TableChunks)
+from q2_sapienns._humann import (humann_genefamily, humann_pathway,
+                                 humann_genefamily_strata,
+                                 humann_pathway_strata)
+from q2_sapienns._reader import (FLOAT32_RELATIVE_ERROR, humann_table_chunks,
+                                 iter_table_chunks, pyarrow)
+from q2_sapienns.plugin_setup import plugin
+from q2_sapienns.tests import table_to_dataframe
+from q2_sapienns.tests.benchmarks import scale_humann_table
 
 
 class HumannTests(TestPluginBase):
@@ -21,11 +39,12 @@ class HumannTests(TestPluginBase):
 class HumannGeneFamilyTests(HumannTests):
 
     def test_humann_genefamilies(self):
-        _, input_table_df = self.transform_format(
-            HumannGeneFamilyFormat, pd.DataFrame, 'humann-genefamilies-1.tsv'
+        _, input_table = self.transform_format(
+            HumannGeneFamilyFormat, TableChunks, 'humann-genefamilies-1.tsv'
         )
 
-        obs_table, obs_tax = humann_genefamily(input_table_df)
+        obs_table, obs_tax = humann_genefamily(input_table)
+        obs_table = table_to_dataframe(obs_table)
 
         # Assess resulting tables
         self.assertEqual(obs_table.index.name, 'sample-id')
@@ -73,12 +92,13 @@ class HumannGeneFamilyTests(HumannTests):
              'UniRef50_O83668: Fructose-bisphosphate aldolase; g__Bacteroides; s__Bacteroides_stercoris'])  # noqa: E501
 
     def test_humann_genefamilies_unchanged_sample_ids(self):
-        _, input_table_df = self.transform_format(
-            HumannGeneFamilyFormat, pd.DataFrame, 'humann-genefamilies-1.tsv'
+        _, input_table = self.transform_format(
+            HumannGeneFamilyFormat, TableChunks, 'humann-genefamilies-1.tsv'
         )
 
         obs_table, obs_tax = humann_genefamily(
-            input_table_df, strip_units_from_sample_ids=False)
+            input_table, strip_units_from_sample_ids=False)
+        obs_table = table_to_dataframe(obs_table)
 
         # Assess resulting tables
         self.assertEqual(obs_table.index.name, 'sample-id')
@@ -126,11 +146,12 @@ class HumannGeneFamilyTests(HumannTests):
              'UniRef50_O83668: Fructose-bisphosphate aldolase; g__Bacteroides; s__Bacteroides_stercoris'])  # noqa: E501
 
     def test_humann_genefamilies_multi_sample(self):
-        _, input_table_df = self.transform_format(
-            HumannGeneFamilyFormat, pd.DataFrame, 'humann-genefamilies-2.tsv'
+        _, input_table = self.transform_format(
+            HumannGeneFamilyFormat, TableChunks, 'humann-genefamilies-2.tsv'
         )
 
-        obs_table, obs_tax = humann_genefamily(input_table_df)
+        obs_table, obs_tax = humann_genefamily(input_table)
+        obs_table = table_to_dataframe(obs_table)
 
         # Assess resulting tables
         self.assertEqual(obs_table.index.name, 'sample-id')
@@ -188,13 +209,14 @@ class HumannGeneFamilyTests(HumannTests):
              'UniRef50_O83668: Fructose-bisphosphate aldolase; unclassified'])
 
     def test_humann_genefamilies_multi_sample_unchanged_sample_ids(self):
-        _, input_table_df = self.transform_format(
-            HumannGeneFamilyFormat, pd.DataFrame, 'humann-genefamilies-2.tsv'
+        _, input_table = self.transform_format(
+            HumannGeneFamilyFormat, TableChunks, 'humann-genefamilies-2.tsv'
         )
 
         obs_table, obs_tax = humann_genefamily(
-            input_table_df, strip_units_from_sample_ids=False
+            input_table, strip_units_from_sample_ids=False
         )
+        obs_table = table_to_dataframe(obs_table)
 
         # Assess resulting tables
         self.assertEqual(obs_table.index.name, 'sample-id')
@@ -253,11 +275,12 @@ class HumannGeneFamilyTests(HumannTests):
              'UniRef50_O83668: Fructose-bisphosphate aldolase; unclassified'])
 
     def test_humann_genefamilies_multi_sample_destratify(self):
-        _, input_table_df = self.transform_format(
-            HumannGeneFamilyFormat, pd.DataFrame, 'humann-genefamilies-2.tsv'
+        _, input_table = self.transform_format(
+            HumannGeneFamilyFormat, TableChunks, 'humann-genefamilies-2.tsv'
         )
 
-        obs_table, obs_tax = humann_genefamily(input_table_df, destratify=True)
+        obs_table, obs_tax = humann_genefamily(input_table, destratify=True)
+        obs_table = table_to_dataframe(obs_table)
 
         # Assess resulting tables
         self.assertEqual(obs_table.index.name, 'sample-id')
@@ -296,12 +319,13 @@ class HumannGeneFamilyTests(HumannTests):
 
 class HumannPathwayTests(HumannTests):
     def test_humann_pathway(self):
-        _, input_table_df = self.transform_format(
-            HumannPathAbundanceFormat, pd.DataFrame,
+        _, input_table = self.transform_format(
+            HumannPathAbundanceFormat, TableChunks,
             'humann-pathabundance-1.tsv'
         )
 
-        obs_table, obs_tax = humann_pathway(input_table_df)
+        obs_table, obs_tax = humann_pathway(input_table)
+        obs_table = table_to_dataframe(obs_table)
 
         # Assess resulting tables
         self.assertEqual(obs_table.index.name, 'sample-id')
@@ -352,13 +376,14 @@ class HumannPathwayTests(HumannTests):
              'PWY-5484: glycolysis II (from fructose-6P); unclassified'])
 
     def test_humann_pathway_unchanged_sample_ids(self):
-        _, input_table_df = self.transform_format(
-            HumannPathAbundanceFormat, pd.DataFrame,
+        _, input_table = self.transform_format(
+            HumannPathAbundanceFormat, TableChunks,
             'humann-pathabundance-1.tsv'
         )
 
         obs_table, obs_tax = humann_pathway(
-            input_table_df, strip_units_from_sample_ids=False)
+            input_table, strip_units_from_sample_ids=False)
+        obs_table = table_to_dataframe(obs_table)
 
         # Assess resulting tables
         self.assertEqual(obs_table.index.name, 'sample-id')
@@ -409,12 +434,13 @@ class HumannPathwayTests(HumannTests):
              'PWY-5484: glycolysis II (from fructose-6P); unclassified'])
 
     def test_humann_pathway_multisample(self):
-        _, input_table_df = self.transform_format(
-            HumannPathAbundanceFormat, pd.DataFrame,
+        _, input_table = self.transform_format(
+            HumannPathAbundanceFormat, TableChunks,
             'humann-pathabundance-2.tsv'
         )
 
-        obs_table, obs_tax = humann_pathway(input_table_df)
+        obs_table, obs_tax = humann_pathway(input_table)
+        obs_table = table_to_dataframe(obs_table)
 
         # Assess resulting tables
         self.assertEqual(obs_table.index.name, 'sample-id')
@@ -471,12 +497,13 @@ class HumannPathwayTests(HumannTests):
              'PWY-5484: glycolysis II (from fructose-6P); unclassified'])
 
     def test_humann_pathway_multisample_destratify(self):
-        _, input_table_df = self.transform_format(
-            HumannPathAbundanceFormat, pd.DataFrame,
+        _, input_table = self.transform_format(
+            HumannPathAbundanceFormat, TableChunks,
             'humann-pathabundance-2.tsv'
         )
 
-        obs_table, obs_tax = humann_pathway(input_table_df, destratify=True)
+        obs_table, obs_tax = humann_pathway(input_table, destratify=True)
+        obs_table = table_to_dataframe(obs_table)
 
         # Assess resulting tables
         self.assertEqual(obs_table.index.name, 'sample-id')
@@ -511,3 +538,343 @@ class HumannPathwayTests(HumannTests):
              'UNINTEGRATED',
              'PWY0-1301: melibiose degradation',
              'PWY-5484: glycolysis II (from fructose-6P)'])
+
+
+class HumannPrecisionTests(HumannTests):
+
+    def test_humann_format_input(self):
+        filepath = self.get_data_path('humann-pathabundance-2.tsv')
+        _, input_table = self.transform_format(
+            HumannPathAbundanceFormat, TableChunks,
+            'humann-pathabundance-2.tsv')
+
+        exp_table, exp_tax = humann_pathway(input_table)
+
+        # the chunks of the Arrow directory format that artifacts are
+        # stored in
+        dir_fmt = self.get_transformer(
+            HumannPathAbundanceFormat,
+            HumannPathAbundanceArrowDirectoryFormat)(
+                HumannPathAbundanceFormat(filepath, mode='r'))
+        chunks = self.get_transformer(
+            HumannPathAbundanceArrowDirectoryFormat, TableChunks)(dir_fmt)
+        obs_table, obs_tax = humann_pathway(chunks)
+
+        self.assertEqual(obs_table, exp_table)
+        assert_frame_equal(obs_tax, exp_tax)
+
+    def test_humann_float32_precision(self):
+        # Abundances loaded with float32 precision are the float64
+        # abundances rounded to the nearest float32, so they differ by a
+        # relative error of at most FLOAT32_RELATIVE_ERROR (about 6e-8).
+        # biom tables always hold float64 values, so float32 precision
+        # rounds the values rather than changing their type.
+        rng = np.random.default_rng(0)
+        for action, fmt, header, unit in [
+                (humann_pathway, HumannPathAbundanceFormat, '# Pathway',
+                 'Abundance'),
+                (humann_genefamily, HumannGeneFamilyFormat, '# Gene Family',
+                 'Abundance-RPKs')]:
+            filepath = os.path.join(self.temp_dir.name, 'table.tsv')
+            with open(filepath, 'w') as fh:
+                fh.write('%s\ts1_%s\ts2_%s\n' % (header, unit, unit))
+                values = rng.lognormal(3, 3, size=(1000, 2))
+                for i, (a, b) in enumerate(values):
+                    fh.write('F%d|s__S%d\t%.17g\t%.17g\n' % (i, i, a, b))
+            input_table = humann_table_chunks(fmt(filepath, mode='r'))
+
+            exp_table, exp_tax = action(input_table)
+            obs_table, obs_tax = action(input_table, precision='float32')
+
+            exp_values = exp_table.matrix_data.toarray()
+            obs_values = obs_table.matrix_data.toarray()
+            np.testing.assert_allclose(obs_values, exp_values,
+                                       rtol=FLOAT32_RELATIVE_ERROR, atol=0)
+            np.testing.assert_array_equal(
+                obs_values, exp_values.astype(np.float32))
+            assert_frame_equal(obs_tax, exp_tax)
+
+    def test_humann_invalid_precision(self):
+        _, input_table = self.transform_format(
+            HumannGeneFamilyFormat, TableChunks, 'humann-genefamilies-1.tsv')
+
+        with self.assertRaisesRegex(ValueError, 'Precision.*float16'):
+            humann_genefamily(input_table, precision='float16')
+
+    def test_humann_table_chunks_peak_memory(self):
+        # the selected rows are built into the output as the table is read,
+        # so the memory used beyond the outputs is that of the chunks and
+        # blocks being read, which is less than that of the dense table
+        rng = np.random.default_rng(0)
+        values = rng.random((100000, 20))
+        values[values < 0.9] = 0
+        table_df = pd.DataFrame(
+            values,
+            index=pd.Index(['F%d' % (i // 2) if i % 2 == 0 else
+                            'F%d|g__Genus.s__Species' % (i // 2)
+                            for i in range(100000)], name='# Gene Family'),
+            columns=['s%d_Abundance-RPKs' % i for i in range(20)])
+        filepath = os.path.join(self.temp_dir.name, 'table.tsv')
+        table_df.to_csv(filepath, sep='\t')
+        input_table = humann_table_chunks(
+            HumannGeneFamilyFormat(filepath, mode='r'))
+
+        for destratify in [False, True]:
+            tracemalloc.start()
+            try:
+                table, taxonomy = humann_genefamily(input_table,
+                                                    destratify=destratify)
+                outputs, peak = tracemalloc.get_traced_memory()
+            finally:
+                tracemalloc.stop()
+            self.assertEqual(table.shape, (50000, 20))
+            self.assertLess(peak - outputs, values.nbytes)
+
+
+class HumannSampleSelectionTests(HumannTests):
+
+    def _inputs(self, filename):
+        filepath = self.get_data_path(filename)
+        ff = HumannPathAbundanceFormat(filepath, mode='r')
+        dir_fmt = self.get_transformer(
+            HumannPathAbundanceFormat,
+            HumannPathAbundanceArrowDirectoryFormat)(ff)
+        return [humann_table_chunks(ff), humann_table_chunks(dir_fmt)]
+
+    def test_humann_sample_ids(self):
+        exp_table, exp_tax = humann_pathway(
+            self._inputs('humann-pathabundance-2.tsv')[0])
+        exp_table = exp_table.filter(['sample_2'], axis='sample',
+                                     inplace=False)
+
+        for input_table in self._inputs('humann-pathabundance-2.tsv'):
+            # sample ids can be provided with or without their units
+            for sample_ids in [['sample_2'], ['sample_2_Abundance']]:
+                obs_table, obs_tax = humann_pathway(input_table,
+                                                    sample_ids=sample_ids)
+                self.assertEqual(obs_table, exp_table)
+                assert_frame_equal(obs_tax, exp_tax)
+
+        obs_table, _ = humann_pathway(
+            self._inputs('humann-pathabundance-2.tsv')[0],
+            strip_units_from_sample_ids=False,
+            sample_ids=['sample_2_Abundance'])
+        self.assertEqual(list(obs_table.ids()), ['sample_2_Abundance'])
+
+    def test_humann_sample_metadata(self):
+        metadata = Metadata.load(self.get_data_path('sample-metadata.tsv'))
+        for input_table in self._inputs('humann-pathabundance-2.tsv'):
+            exp_table, exp_tax = humann_pathway(input_table)
+            obs_table, obs_tax = humann_pathway(input_table,
+                                                sample_metadata=metadata)
+            self.assertEqual(obs_table, exp_table)
+            assert_frame_equal(obs_tax, exp_tax)
+
+    def test_humann_sample_ids_missing(self):
+        for input_table in self._inputs('humann-pathabundance-2.tsv'):
+            with self.assertRaisesRegex(ValueError,
+                                        'not found.*: sample3$'):
+                humann_pathway(input_table,
+                               sample_ids=['sample1', 'sample3'])
+
+            # units are only removed if strip_units_from_sample_ids
+            with self.assertRaisesRegex(ValueError,
+                                        'not found.*: sample1$'):
+                humann_pathway(input_table,
+                               strip_units_from_sample_ids=False,
+                               sample_ids=['sample1'])
+
+
+class HumannStratificationTests(HumannTests):
+
+    def test_humann_scaled_fixtures(self):
+        # the features are split as they were row by row, on the fixtures
+        # with their rows repeated
+        readers = ['pandas'] if pyarrow is None else ['pandas', 'pyarrow']
+        for i in range(1, 5):
+            filepath = os.path.join(self.temp_dir.name, 'table-%d.tsv' % i)
+            scale_humann_table(
+                self.get_data_path('humann-genefamilies-%d.tsv' % i),
+                filepath, 500)
+            df = pd.read_csv(filepath, sep='\t', index_col=0)
+            unstratified = df.reset_index().apply(
+                lambda x: '|' not in x[df.index.name], axis=1).to_numpy()
+
+            for destratify, mask in [(True, unstratified),
+                                     (False, ~unstratified)]:
+                exp = df[mask]
+                for reader in readers:
+                    with mock.patch.dict(os.environ,
+                                         {'Q2_SAPIENNS_READER': reader}):
+                        obs_table, obs_tax = humann_genefamily(
+                            humann_table_chunks(
+                                HumannGeneFamilyFormat(filepath, mode='r')),
+                            strip_units_from_sample_ids=False,
+                            destratify=destratify)
+                    self.assertEqual(list(obs_table.ids(axis='observation')),
+                                     list(exp.index))
+                    self.assertEqual(list(obs_table.ids()),
+                                     list(exp.columns))
+                    np.testing.assert_array_equal(
+                        obs_table.matrix_data.toarray(), exp.to_numpy())
+                    self.assertEqual(list(obs_tax.index), list(exp.index))
+
+    def test_humann_other_stratum_not_parsed(self):
+        # the values of the features of the other stratum are never parsed
+        filepath = os.path.join(self.temp_dir.name, 'table.tsv')
+        with open(filepath, 'w') as fh:
+            fh.write('# Pathway\ts1_Abundance\n'
+                     'PWY-1\t1.5\n'
+                     'PWY-1|g__Genus.s__Species\tnot-parsed\n'
+                     'PWY-2\t2.5\n')
+        input_table = humann_table_chunks(
+            HumannPathAbundanceFormat(filepath, mode='r'))
+
+        readers = ['pandas'] if pyarrow is None else ['pandas', 'pyarrow']
+        for reader in readers:
+            with mock.patch.dict(os.environ, {'Q2_SAPIENNS_READER': reader}):
+                table, _ = humann_pathway(input_table, destratify=True)
+            self.assertEqual(list(table.ids(axis='observation')),
+                             ['PWY-1', 'PWY-2'])
+
+
+class HumannStrataTests(HumannTests):
+
+    ARROW_FORMATS = {
+        HumannPathAbundanceFormat: HumannPathAbundanceArrowDirectoryFormat,
+        HumannGeneFamilyFormat: HumannGeneFamilyArrowDirectoryFormat}
+
+    def _inputs(self, fmt, filename):
+        _, chunks = self.transform_format(fmt, TableChunks, filename)
+        dir_fmt = self.get_transformer(fmt, self.ARROW_FORMATS[fmt])(
+            fmt(self.get_data_path(filename), mode='r'))
+        return [chunks, humann_table_chunks(dir_fmt)]
+
+    def _assert_outputs_equal(self, obs, exp):
+        self.assertEqual(len(obs), len(exp))
+        for obs_output, exp_output in zip(obs, exp):
+            if isinstance(exp_output, biom.Table):
+                self.assertEqual(obs_output, exp_output)
+            else:
+                assert_frame_equal(obs_output, exp_output)
+
+    def test_humann_strata(self):
+        for action, strata_action, fmt, filename in [
+                (humann_pathway, humann_pathway_strata,
+                 HumannPathAbundanceFormat, 'humann-pathabundance-2.tsv'),
+                (humann_genefamily, humann_genefamily_strata,
+                 HumannGeneFamilyFormat, 'humann-genefamilies-2.tsv'),
+                (humann_genefamily, humann_genefamily_strata,
+                 HumannGeneFamilyFormat, 'humann-genefamilies-3.tsv')]:
+            for strip_units in [True, False]:
+                for input_table in self._inputs(fmt, filename):
+                    exp = (action(input_table, strip_units, destratify=False)
+                           + action(input_table, strip_units,
+                                    destratify=True))
+                    obs = strata_action(input_table, strip_units)
+                    self._assert_outputs_equal(obs, exp)
+
+    def _write_one_stratum_table(self, stratified):
+        filepath = os.path.join(self.temp_dir.name, 'table.tsv')
+        feature = 'PWY-%d|g__G.s__S' if stratified else 'PWY-%d'
+        with open(filepath, 'w') as fh:
+            fh.write('# Pathway\ts1_Abundance\ts2_Abundance\n')
+            fh.write((feature + '\t1.5\t0.0\n') % 1)
+            fh.write((feature + '\t2.5\t1.0\n') % 2)
+        return filepath
+
+    def test_humann_strata_one_stratum(self):
+        # a stratum without features is reported, as its empty taxonomy
+        # couldn't be saved
+        for stratified, stratum in [(False, 'No stratified features'),
+                                    (True, 'No un-stratified features')]:
+            ff = HumannPathAbundanceFormat(
+                self._write_one_stratum_table(stratified), mode='r')
+            with self.assertRaisesRegex(ValueError,
+                                        stratum + '.*humann-pathway'):
+                humann_pathway_strata(humann_table_chunks(ff))
+
+    def test_humann_strata_action(self):
+        # the outputs of the registered action can be saved
+        action = plugin.actions['humann_pathway_strata']
+        input_table = Artifact.import_data(
+            'HumannPathAbundanceTable',
+            self.get_data_path('humann-pathabundance-2.tsv'))
+        results = action(pathway_table=input_table)
+        exp = humann_pathway_strata(humann_table_chunks(
+            HumannPathAbundanceFormat(
+                self.get_data_path('humann-pathabundance-2.tsv'), mode='r')))
+        self.assertEqual(results.stratified_table.view(biom.Table), exp[0])
+        assert_frame_equal(results.stratified_taxonomy.view(pd.DataFrame),
+                           exp[1])
+        self.assertEqual(results.unstratified_table.view(biom.Table), exp[2])
+        assert_frame_equal(
+            results.unstratified_taxonomy.view(pd.DataFrame), exp[3])
+
+        input_table = Artifact.import_data(
+            'HumannPathAbundanceTable', self._write_one_stratum_table(False))
+        with self.assertRaisesRegex(ValueError, 'No stratified features'):
+            action(pathway_table=input_table)
+
+    def test_humann_strata_reads_table_once(self):
+        input_table = humann_table_chunks(HumannGeneFamilyFormat(
+            self.get_data_path('humann-genefamilies-2.tsv'), mode='r'))
+        exp = humann_genefamily_strata(input_table)
+        with mock.patch('q2_sapienns._reader.iter_table_chunks',
+                        wraps=iter_table_chunks) as wrapped:
+            obs = humann_genefamily_strata(input_table)
+        self.assertEqual(wrapped.call_count, 1)
+        self._assert_outputs_equal(obs, exp)
+
+    def test_humann_strata_sample_ids(self):
+        for input_table in self._inputs(HumannPathAbundanceFormat,
+                                        'humann-pathabundance-2.tsv'):
+            exp = (humann_pathway(input_table, sample_ids=['sample_2']) +
+                   humann_pathway(input_table, destratify=True,
+                                  sample_ids=['sample_2']))
+            obs = humann_pathway_strata(input_table,
+                                        sample_ids=['sample_2'])
+            self._assert_outputs_equal(obs, exp)
+
+
+class HumannStripUnitsTests(HumannTests):
+
+    def _write_table(self, sample_ids):
+        filepath = os.path.join(self.temp_dir.name, 'table.tsv')
+        with open(filepath, 'w') as fh:
+            fh.write('# Pathway\t%s\n' % '\t'.join(sample_ids))
+            fh.write('PWY-1\t%s\n' % '\t'.join(['1.0'] * len(sample_ids)))
+            fh.write('PWY-1|g__G.s__S\t%s\n' %
+                     '\t'.join(['1.0'] * len(sample_ids)))
+        return humann_table_chunks(
+            HumannPathAbundanceFormat(filepath, mode='r'))
+
+    def test_duplicate_sample_ids(self):
+        input_table = self._write_table(
+            ['s1_Abundance', 's2_Abundance', 's1_Abundance-RPKs'])
+        for action in [humann_pathway, humann_pathway_strata]:
+            with mock.patch('q2_sapienns._reader.iter_table_chunks') as read:
+                with self.assertRaisesRegex(
+                        ValueError, r'duplicate sample ids: s1 \(from '
+                                    r's1_Abundance, s1_Abundance-RPKs\)'):
+                    action(input_table)
+            # the duplicates are found before the table is read
+            read.assert_not_called()
+
+            # the ids are unique if their units are kept, or if one of the
+            # duplicates isn't selected
+            table, _ = action(input_table,
+                              strip_units_from_sample_ids=False)[:2]
+            self.assertEqual(list(table.ids()),
+                             ['s1_Abundance', 's2_Abundance',
+                              's1_Abundance-RPKs'])
+            table, _ = action(input_table,
+                              sample_ids=['s1_Abundance', 's2'])[:2]
+            self.assertEqual(list(table.ids()), ['s1', 's2'])
+
+    def test_many_sample_ids(self):
+        sample_ids = ['sample_%d_Abundance' % i for i in range(5000)]
+        input_table = self._write_table(sample_ids)
+        table, _ = humann_pathway(input_table)
+        self.assertEqual(list(table.ids()),
+                         ['sample_%d' % i for i in range(5000)])
@@ -6,32 +6,49 @@
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
 
+import os
+import tracemalloc
+from unittest import mock
+
+import biom
+import numpy as np
 import pandas as pd
+import scipy.sparse
+from pandas.testing import assert_frame_equal
 
+from qiime2 import Artifact
 from qiime2.plugin.testing import TestPluginBase
 
-from q2_sapienns import MetaphlanMergedAbundanceFormat
-from q2_sapienns._metaphlan import metaphlan_taxon, frequency
+from q2_sapienns import (MetaphlanMergedAbundanceFormat,
+                         MetaphlanMergedAbundanceArrowDirectoryFormat,
+                         TableChunks)
+from q2_sapienns._metaphlan import (SPLIT_LEVELS, metaphlan_taxon,
+                                    metaphlan_levels, frequency)
+from q2_sapienns._reader import (FLOAT32_RELATIVE_ERROR, iter_table_chunks,
+                                 metaphlan_table_chunks)
+from q2_sapienns.plugin_setup import plugin
+from q2_sapienns.tests import table_to_dataframe
 
 
 class MetaphlanTaxonTests(TestPluginBase):
     package = 'q2_sapienns.tests'
 
     def test_metaphlan_taxon_bad_level(self):
-        _, input_table_df = self.transform_format(
-            MetaphlanMergedAbundanceFormat, pd.DataFrame,
+        _, input_table = self.transform_format(
+            MetaphlanMergedAbundanceFormat, TableChunks,
             'metaphlan-merged-abundance-1.tsv'
         )
 
         with self.assertRaisesRegex(ValueError, 'exactly 42 taxonomic levels'):
-            metaphlan_taxon(input_table_df, level=42)
+            metaphlan_taxon(input_table, level=42)
 
     def test_metaphlan_taxon_level_1(self):
-        _, input_table_df = self.transform_format(
-            MetaphlanMergedAbundanceFormat, pd.DataFrame,
+        _, input_table = self.transform_format(
+            MetaphlanMergedAbundanceFormat, TableChunks,
             'metaphlan-merged-abundance-1.tsv')
 
-        obs_table, obs_tax = metaphlan_taxon(input_table_df, level=1)
+        obs_table, obs_tax = metaphlan_taxon(input_table, level=1)
+        obs_table = table_to_dataframe(obs_table)
 
         # Assess resulting tables
         self.assertEqual(obs_table.index.name, 'sample-id')
@@ -64,11 +81,12 @@ class MetaphlanTaxonTests(TestPluginBase):
              'k__Bacteria'])
 
     def test_metaphlan_taxon_level_7(self):
-        _, input_table_df = self.transform_format(
-            MetaphlanMergedAbundanceFormat, pd.DataFrame,
+        _, input_table = self.transform_format(
+            MetaphlanMergedAbundanceFormat, TableChunks,
             'metaphlan-merged-abundance-1.tsv')
 
-        obs_table, obs_tax = metaphlan_taxon(input_table_df, level=7)
+        obs_table, obs_tax = metaphlan_taxon(input_table, level=7)
+        obs_table = table_to_dataframe(obs_table)
 
         # Assess resulting tables
         self.assertEqual(obs_table.index.name, 'sample-id')
@@ -116,11 +134,12 @@ class MetaphlanTaxonTests(TestPluginBase):
              'k__Bacteria; p__Actinobacteria; c__Actinobacteria; o__Actinomycetales; f__Actinomycetaceae; g__Actinomyces; s__Actinomyces_sp_HMSC035G02'])  # noqa: E501
 
     def test_metaphlan_taxon_level_7_no_tax_id(self):
-        _, input_table_df = self.transform_format(
-            MetaphlanMergedAbundanceFormat, pd.DataFrame,
+        _, input_table = self.transform_format(
+            MetaphlanMergedAbundanceFormat, TableChunks,
             'metaphlan-merged-abundance-6.tsv')
 
-        obs_table, obs_tax = metaphlan_taxon(input_table_df, level=7)
+        obs_table, obs_tax = metaphlan_taxon(input_table, level=7)
+        obs_table = table_to_dataframe(obs_table)
 
         # Assess resulting tables
         self.assertEqual(obs_table.index.name, 'sample-id')
@@ -167,13 +186,108 @@ class MetaphlanTaxonTests(TestPluginBase):
              'k__Bacteria; p__Actinobacteria; c__Actinobacteria; o__Actinomycetales; f__Actinomycetaceae; g__Actinomyces; s__Actinomyces_oris',  # noqa: E501
              'k__Bacteria; p__Actinobacteria; c__Actinobacteria; o__Actinomycetales; f__Actinomycetaceae; g__Actinomyces; s__Actinomyces_sp_HMSC035G02'])  # noqa: E501
 
+    def test_metaphlan_taxon_format_input(self):
+        filepath = self.get_data_path('metaphlan-merged-abundance-1.tsv')
+        _, input_table = self.transform_format(
+            MetaphlanMergedAbundanceFormat, TableChunks,
+            'metaphlan-merged-abundance-1.tsv')
+
+        exp_table, exp_tax = metaphlan_taxon(input_table, level=7)
+
+        # the chunks of the Arrow directory format that artifacts are
+        # stored in
+        dir_fmt = self.get_transformer(
+            MetaphlanMergedAbundanceFormat,
+            MetaphlanMergedAbundanceArrowDirectoryFormat)(
+                MetaphlanMergedAbundanceFormat(filepath, mode='r'))
+        chunks = self.get_transformer(
+            MetaphlanMergedAbundanceArrowDirectoryFormat, TableChunks)(
+                dir_fmt)
+        obs_table, obs_tax = metaphlan_taxon(chunks, level=7)
+
+        self.assertEqual(obs_table, exp_table)
+        assert_frame_equal(obs_tax, exp_tax)
+
+        obs_table, _ = metaphlan_taxon(chunks, level=7,
+                                       sample_ids=['sample_2'])
+        self.assertEqual(list(obs_table.ids()), ['sample_2'])
+
+    def test_metaphlan_taxon_float32_precision(self):
+        # float32 abundances are within a relative error of
+        # FLOAT32_RELATIVE_ERROR of the float64 abundances.
+        for filename in ['metaphlan-merged-abundance-1.tsv',
+                         'metaphlan-merged-abundance-6.tsv']:
+            input_table = metaphlan_table_chunks(
+                MetaphlanMergedAbundanceFormat(self.get_data_path(filename),
+                                               mode='r'))
+
+            exp_table, exp_tax = metaphlan_taxon(input_table, level=7)
+            obs_table, obs_tax = metaphlan_taxon(input_table, level=7,
+                                                 precision='float32')
+
+            exp_values = exp_table.matrix_data.toarray()
+            obs_values = obs_table.matrix_data.toarray()
+            np.testing.assert_allclose(obs_values, exp_values,
+                                       rtol=FLOAT32_RELATIVE_ERROR, atol=0)
+            np.testing.assert_array_equal(
+                obs_values, exp_values.astype(np.float32))
+            assert_frame_equal(obs_tax, exp_tax)
+
+    def test_metaphlan_taxon_sample_ids(self):
+        input_table = metaphlan_table_chunks(MetaphlanMergedAbundanceFormat(
+            self.get_data_path('metaphlan-merged-abundance-1.tsv'),
+            mode='r'))
+        exp_table, exp_tax = metaphlan_taxon(input_table, level=7)
+        exp_table = exp_table.filter(['sample_2'], axis='sample',
+                                     inplace=False)
+
+        obs_table, obs_tax = metaphlan_taxon(input_table, level=7,
+                                             sample_ids=['sample_2'])
+
+        self.assertEqual(obs_table, exp_table)
+        assert_frame_equal(obs_tax, exp_tax)
+
+        with self.assertRaisesRegex(ValueError, 'not found.*: sample3$'):
+            metaphlan_taxon(input_table, level=7,
+                            sample_ids=['sample1', 'sample3'])
+
+    def test_metaphlan_taxon_table_chunks_peak_memory(self):
+        # the selected rows are built into the output as the table is read,
+        # so the memory used beyond the outputs is that of the chunks and
+        # blocks being read, which is less than that of the dense table
+        rng = np.random.default_rng(0)
+        values = rng.random((105000, 20))
+        values[values < 0.9] = 0
+        table_df = pd.DataFrame(
+            values,
+            index=pd.Index(['|'.join('k__K%d' % j for j in range(i % 7 + 1))
+                            + str(i) for i in range(105000)],
+                           name='clade_name'),
+            columns=['sample%d' % i for i in range(20)])
+        table_df.insert(0, 'NCBI_tax_id', [str(i) for i in range(105000)])
+        filepath = os.path.join(self.temp_dir.name, 'table.tsv')
+        with open(filepath, 'w') as fh:
+            fh.write('#mpa_v30_CHOCOPhlAn_201901\n')
+            table_df.to_csv(fh, sep='\t')
+        input_table = metaphlan_table_chunks(
+            MetaphlanMergedAbundanceFormat(filepath, mode='r'))
+
+        tracemalloc.start()
+        try:
+            table, taxonomy = metaphlan_taxon(input_table, level=7)
+            outputs, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        self.assertEqual(table.shape, (15000, 20))
+        self.assertLess(peak - outputs, values.nbytes)
+
     def test_frequency_100000(self):
-        _, input_table_df = self.transform_format(
-            MetaphlanMergedAbundanceFormat, pd.DataFrame,
+        _, input_table = self.transform_format(
+            MetaphlanMergedAbundanceFormat, TableChunks,
             'metaphlan-merged-abundance-1.tsv')
 
-        obs_rf_table, _ = metaphlan_taxon(input_table_df, level=7)
-        obs_f_table = frequency(obs_rf_table)
+        obs_rf_table, _ = metaphlan_taxon(input_table, level=7)
+        obs_f_table = table_to_dataframe(frequency(obs_rf_table))
 
         # Assess resulting tables
         self.assertEqual(obs_f_table.index.name, 'sample-id')
@@ -197,12 +311,12 @@ class MetaphlanTaxonTests(TestPluginBase):
                          [24, 10976, 0, 0, 0, 9000, 80000])
 
     def test_frequency_1(self):
-        _, input_table_df = self.transform_format(
-            MetaphlanMergedAbundanceFormat, pd.DataFrame,
+        _, input_table = self.transform_format(
+            MetaphlanMergedAbundanceFormat, TableChunks,
             'metaphlan-merged-abundance-1.tsv')
 
-        obs_rf_table, _ = metaphlan_taxon(input_table_df, level=7)
-        obs_f_table = frequency(obs_rf_table, 1)
+        obs_rf_table, _ = metaphlan_taxon(input_table, level=7)
+        obs_f_table = table_to_dataframe(frequency(obs_rf_table, 1))
 
         # Assess resulting tables
         self.assertEqual(obs_f_table.index.name, 'sample-id')
@@ -224,3 +338,208 @@ class MetaphlanTaxonTests(TestPluginBase):
 
         self.assertEqual(list(obs_f_table.T['sample_2']),
                          [0, 0, 0, 0, 0, 0, 1])
+
+    def test_frequency_largest_remainder(self):
+        _, input_table = self.transform_format(
+            MetaphlanMergedAbundanceFormat, TableChunks,
+            'metaphlan-merged-abundance-1.tsv')
+
+        obs_rf_table, _ = metaphlan_taxon(input_table, level=7)
+
+        obs_f_table = frequency(obs_rf_table, rounding='largest-remainder')
+        self.assertEqual(obs_f_table, frequency(obs_rf_table))
+
+        obs_f_table = table_to_dataframe(
+            frequency(obs_rf_table, 1, 'largest-remainder'))
+        self.assertEqual(obs_f_table.index.name, 'sample-id')
+        self.assertEqual(list(obs_f_table.columns),
+                         list(obs_rf_table.ids(axis='observation')))
+        self.assertEqual(list(obs_f_table.T['sample1']),
+                         [0, 1, 0, 0, 0, 0, 0])
+        self.assertEqual(list(obs_f_table.T['sample_2']),
+                         [0, 0, 0, 0, 0, 0, 1])
+
+        # the totals are exactly target_freq, unlike with round
+        obs_f_table = frequency(obs_rf_table, 7, 'largest-remainder')
+        self.assertEqual(list(obs_f_table.sum(axis='sample')), [7, 7])
+        self.assertEqual(
+            list(frequency(obs_rf_table, 7).sum(axis='sample')), [7, 8])
+
+    def test_frequency_peak_memory(self):
+        matrix = scipy.sparse.random(500, 20000, density=0.01,
+                                     format='csr', random_state=0) * 100
+        table = biom.Table(matrix, ['f%d' % i for i in range(500)],
+                           ['s%d' % i for i in range(20000)])
+        dense_size = 500 * 20000 * 8
+
+        for rounding in ['round', 'largest-remainder', 'multinomial']:
+            tracemalloc.start()
+            try:
+                obs_f_table = frequency(table, rounding=rounding)
+                _, peak = tracemalloc.get_traced_memory()
+            finally:
+                tracemalloc.stop()
+            # only the stored values are converted, so the table is never
+            # held as a dense table
+            self.assertGreater(obs_f_table.matrix_data.nnz, 0)
+            self.assertLess(peak, dense_size / 4)
+
+    def test_frequency_sparse(self):
+        _, input_table = self.transform_format(
+            MetaphlanMergedAbundanceFormat, TableChunks,
+            'metaphlan-merged-abundance-1.tsv')
+        obs_rf_table, _ = metaphlan_taxon(input_table, level=7)
+        exp_rf_table = obs_rf_table.copy()
+        values = table_to_dataframe(obs_rf_table).values
+
+        for target_freq in [1, 7, 100000]:
+            for rounding in ['round', 'largest-remainder']:
+                obs_f_table = frequency(obs_rf_table, target_freq, rounding)
+                self.assertIsInstance(obs_f_table, biom.Table)
+                obs_values = table_to_dataframe(obs_f_table).values
+                if rounding == 'round':
+                    np.testing.assert_array_equal(
+                        obs_values, np.rint(values * (target_freq / 100)))
+                else:
+                    np.testing.assert_array_equal(obs_values.sum(axis=1),
+                                                  target_freq)
+                # entries that are rounded to zero are dropped
+                self.assertEqual(obs_f_table.matrix_data.nnz,
+                                 np.count_nonzero(obs_values))
+
+        # the input table isn't changed
+        self.assertEqual(obs_rf_table, exp_rf_table)
+
+    def test_frequency_multinomial(self):
+        _, input_table = self.transform_format(
+            MetaphlanMergedAbundanceFormat, TableChunks,
+            'metaphlan-merged-abundance-1.tsv')
+        obs_rf_table, _ = metaphlan_taxon(input_table, level=7)
+
+        obs_f_table = frequency(obs_rf_table, rounding='multinomial',
+                                seed=42)
+        self.assertEqual(list(obs_f_table.sum(axis='sample')),
+                         [100000, 100000])
+        # features without relative frequencies aren't drawn
+        obs_f_table = table_to_dataframe(obs_f_table)
+        self.assertEqual(list(obs_f_table.T['sample_2'] == 0),
+                         [False, False, True, True, True, False, False])
+
+        assert_frame_equal(
+            table_to_dataframe(frequency(obs_rf_table,
+                                         rounding='multinomial', seed=42,
+                                         n_threads=2)),
+            obs_f_table)
+
+    def test_frequency_invalid_rounding(self):
+        table = biom.Table(np.array([[50.0], [50.0]]), ['f1', 'f2'], ['s1'])
+        with self.assertRaisesRegex(ValueError, 'Rounding must be one of'):
+            frequency(table, rounding='floor')
+
+
+class MetaphlanLevelsTests(TestPluginBase):
+    package = 'q2_sapienns.tests'
+
+    def _inputs(self, filename):
+        fmt = MetaphlanMergedAbundanceFormat
+        ff = fmt(self.get_data_path(filename), mode='r')
+        dir_fmt = self.get_transformer(
+            fmt, MetaphlanMergedAbundanceArrowDirectoryFormat)(ff)
+        return [self.get_transformer(fmt, TableChunks)(ff),
+                metaphlan_table_chunks(dir_fmt)]
+
+    def test_metaphlan_levels(self):
+        for filename in ['metaphlan-merged-abundance-1.tsv',
+                         'metaphlan-merged-abundance-6.tsv']:
+            for input_table in self._inputs(filename):
+                obs = metaphlan_levels(input_table)
+                self.assertEqual(len(obs), 2 * len(SPLIT_LEVELS))
+                for level in range(1, 8):
+                    exp_table, exp_tax = metaphlan_taxon(
+                        metaphlan_table_chunks(
+                            MetaphlanMergedAbundanceFormat(
+                                self.get_data_path(filename), mode='r')),
+                        level=level)
+                    obs_table, obs_tax = obs[2 * level - 2:2 * level]
+                    self.assertEqual(obs_table, exp_table)
+                    assert_frame_equal(obs_tax, exp_tax)
+
+    def _write_genus_table(self):
+        # a table without species
+        filepath = os.path.join(self.temp_dir.name, 'table.tsv')
+        with open(self.get_data_path('metaphlan-merged-abundance-1.tsv')) \
+                as fh, open(filepath, 'w') as out:
+            for line in fh:
+                if '|s__' not in line:
+                    out.write(line)
+        return filepath
+
+    def test_metaphlan_levels_empty_level(self):
+        filepath = self._write_genus_table()
+        input_table = metaphlan_table_chunks(
+            MetaphlanMergedAbundanceFormat(filepath, mode='r'))
+        with self.assertRaisesRegex(ValueError,
+                                    'at the species level.*metaphlan-taxon'):
+            metaphlan_levels(input_table)
+
+    def test_metaphlan_levels_action(self):
+        # the outputs of the registered action can be saved
+        action = plugin.actions['metaphlan_levels']
+        input_table = Artifact.import_data(
+            'MetaphlanMergedAbundanceTable',
+            self.get_data_path('metaphlan-merged-abundance-1.tsv'))
+        results = action(stratified_table=input_table)
+        self.assertEqual(len(results), 2 * len(SPLIT_LEVELS))
+        exp_table, exp_tax = metaphlan_taxon(
+            metaphlan_table_chunks(MetaphlanMergedAbundanceFormat(
+                self.get_data_path('metaphlan-merged-abundance-1.tsv'),
+                mode='r')),
+            level=7)
+        self.assertEqual(results.species_table.view(biom.Table), exp_table)
+        assert_frame_equal(results.species_taxonomy.view(pd.DataFrame),
+                           exp_tax)
+
+        input_table = Artifact.import_data('MetaphlanMergedAbundanceTable',
+                                           self._write_genus_table())
+        with self.assertRaisesRegex(ValueError, 'at the species level'):
+            action(stratified_table=input_table)
+
+    def test_metaphlan_levels_reads_table_once(self):
+        input_table = metaphlan_table_chunks(MetaphlanMergedAbundanceFormat(
+            self.get_data_path('metaphlan-merged-abundance-1.tsv'),
+            mode='r'))
+        exp = metaphlan_levels(input_table)
+        with mock.patch('q2_sapienns._reader.iter_table_chunks',
+                        wraps=iter_table_chunks) as wrapped:
+            obs = metaphlan_levels(input_table)
+        self.assertEqual(wrapped.call_count, 1)
+        for obs_output, exp_output in zip(obs, exp):
+            if isinstance(exp_output, biom.Table):
+                self.assertEqual(obs_output, exp_output)
+            else:
+                assert_frame_equal(obs_output, exp_output)
+
+    def test_metaphlan_levels_sample_ids(self):
+        for input_table in self._inputs('metaphlan-merged-abundance-1.tsv'):
+            exp = metaphlan_levels(input_table)
+            obs = metaphlan_levels(input_table, sample_ids=['sample_2'])
+            for obs_table, exp_table in zip(obs[0::2], exp[0::2]):
+                self.assertEqual(
+                    obs_table,
+                    exp_table.filter(['sample_2'], axis='sample',
+                                     inplace=False))
+            for obs_tax, exp_tax in zip(obs[1::2], exp[1::2]):
+                assert_frame_equal(obs_tax, exp_tax)
+
+            with self.assertRaisesRegex(ValueError, 'not found.*: sample3$'):
+                metaphlan_levels(input_table, sample_ids=['sample3'])
+
+    def test_metaphlan_levels_precision(self):
+        input_table = metaphlan_table_chunks(MetaphlanMergedAbundanceFormat(
+            self.get_data_path('metaphlan-merged-abundance-6.tsv'), mode='r'))
+        exp = metaphlan_levels(input_table)
+        obs = metaphlan_levels(input_table, precision='float32')
+        for obs_table, exp_table in zip(obs[0::2], exp[0::2]):
+            np.testing.assert_array_equal(
+                obs_table.matrix_data.toarray(),
+                exp_table.matrix_data.toarray().astype(np.float32))
@@ -0,0 +1,81 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2022, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import unittest
+
+import pandas as pd
+from qiime2 import Metadata
+
+from q2_sapienns._samples import (requested_samples, resolve_samples,
+                                  strip_units, strip_units_from_ids)
+
+
+class SamplesTests(unittest.TestCase):
+
+    def test_strip_units(self):
+        self.assertEqual(strip_units('sample1_Abundance-RPKs'), 'sample1')
+        self.assertEqual(strip_units('sample_2_Abundance'), 'sample_2')
+
+    def test_strip_units_from_ids(self):
+        self.assertEqual(
+            strip_units_from_ids(['sample1_Abundance-RPKs',
+                                  'sample_2_Abundance', 'sample3']),
+            {'sample1_Abundance-RPKs': 'sample1',
+             'sample_2_Abundance': 'sample_2',
+             'sample3': 'sample3'})
+        self.assertEqual(strip_units_from_ids([]), {})
+
+    def test_strip_units_from_ids_duplicates(self):
+        with self.assertRaisesRegex(
+                ValueError, r'duplicate sample ids: s1 \(from s1_Abundance, '
+                            r's1_Abundance-RPKs\); s2 \(from s2_Abundance, '
+                            r's2_CPM\)$'):
+            strip_units_from_ids(['s2_Abundance', 's1_Abundance', 's3_CPM',
+                                  's1_Abundance-RPKs', 's2_CPM'])
+
+    def test_requested_samples(self):
+        self.assertIsNone(requested_samples())
+        self.assertEqual(requested_samples(sample_ids=['s2', 's1']),
+                         ['s2', 's1'])
+        metadata = Metadata(pd.DataFrame(
+            {'group': ['1', '2']},
+            index=pd.Index(['s1', 's2'], name='sample-id')))
+        self.assertEqual(requested_samples(sample_metadata=metadata),
+                         ['s1', 's2'])
+
+    def test_requested_samples_invalid(self):
+        metadata = Metadata(pd.DataFrame(
+            {'group': ['1']}, index=pd.Index(['s1'], name='sample-id')))
+        with self.assertRaisesRegex(ValueError, 'Only one of'):
+            requested_samples(['s1'], metadata)
+        with self.assertRaisesRegex(ValueError, 'No sample ids'):
+            requested_samples([])
+
+    def test_resolve_samples(self):
+        sample_ids = ['s1_Abundance', 's2_Abundance', 's3_Abundance']
+        self.assertIsNone(resolve_samples(None, sample_ids))
+        # in the order of the table
+        self.assertEqual(
+            resolve_samples(['s3_Abundance', 's1_Abundance'], sample_ids),
+            ['s1_Abundance', 's3_Abundance'])
+        self.assertEqual(
+            resolve_samples(['s3', 's2_Abundance'], sample_ids,
+                            strip_units_from_sample_ids=True),
+            ['s2_Abundance', 's3_Abundance'])
+
+    def test_resolve_samples_missing(self):
+        sample_ids = ['s1_Abundance', 's2_Abundance']
+        with self.assertRaisesRegex(ValueError, 'not found.*: s1, s4$'):
+            resolve_samples(['s1', 's4', 's2_Abundance'], sample_ids)
+        with self.assertRaisesRegex(ValueError, 'not found.*: s4$'):
+            resolve_samples(['s1', 's4'], sample_ids,
+                            strip_units_from_sample_ids=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2022, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import unittest
+
+import numpy as np
+
+from q2_sapienns._sparse import CSRBuilder
+
+
+class CSRBuilderTests(unittest.TestCase):
+
+    def test_add_rows(self):
+        rng = np.random.default_rng(0)
+        blocks = []
+        builder = CSRBuilder(7, capacity=2)
+        for n_rows in [0, 5, 3, 40, 1]:
+            values = rng.random((n_rows, 7))
+            values[values < 0.7] = 0
+            blocks.append(values)
+            builder.add_rows(values)
+
+        obs = builder.to_csr()
+
+        np.testing.assert_array_equal(obs.toarray(), np.vstack(blocks))
+        self.assertEqual(obs.nnz, np.count_nonzero(np.vstack(blocks)))
+        self.assertEqual(obs.indices.dtype, np.int32)
+        self.assertEqual(obs.indptr.dtype, np.int32)
+
+    def test_dtype(self):
+        builder = CSRBuilder(2, dtype=np.float32)
+        builder.add_rows(np.array([[0.0, 1.5], [2.5, 0.0]]))
+        obs = builder.to_csr()
+        self.assertEqual(obs.dtype, np.float32)
+        np.testing.assert_array_equal(obs.toarray(), [[0.0, 1.5], [2.5, 0.0]])
+
+    def test_no_rows(self):
+        obs = CSRBuilder(3).to_csr()
+        self.assertEqual(obs.shape, (0, 3))
+        self.assertEqual(obs.nnz, 0)
+
+    def test_wrong_number_of_columns(self):
+        builder = CSRBuilder(3)
+        with self.assertRaisesRegex(ValueError, 'Expected 3 columns'):
+            builder.add_rows(np.ones((2, 4)))
+
+
+if __name__ == '__main__':
+    unittest.main()
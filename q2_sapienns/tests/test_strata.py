@@ -0,0 +1,128 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2022, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import io
+import unittest
+
+import numpy as np
+import pandas as pd
+from pandas.testing import assert_frame_equal
+
+from q2_sapienns._strata import (STRATIFIED, filter_lines, level_counts,
+                                 level_mask, open_level, select_levels,
+                                 taxonomy)
+
+TABLE = (b'#mpa_v30_CHOCOPhlAn_201901\n'
+         b'clade_name\tNCBI_tax_id\ts1\n'
+         b'k__Archaea\t2157\t1.5\n'
+         b'k__Archaea|p__Euryarchaeota\t2157|28890\t1.5\n'
+         b'k__Bacteria\t2\t98.5\n'
+         b'k__Bacteria|p__Firmicutes\t2|1239\t98.5\n'
+         b'k__Bacteria|p__Firmicutes|c__Bacilli\t2|1239|91061\t98.5\n')
+
+
+class StrataTests(unittest.TestCase):
+
+    def test_level_counts(self):
+        feature_ids = ['a', 'a|b', '', 'a|b|c', 'ä|ö', '|', 'b|c']
+        exp = [1, 2, 1, 3, 2, 2, 2]
+        for ids in [feature_ids, np.array(feature_ids, dtype=object),
+                    pd.Index(feature_ids)]:
+            obs = level_counts(ids)
+            np.testing.assert_array_equal(obs, exp)
+
+        # an empty last feature id
+        np.testing.assert_array_equal(level_counts(['a|b', '']), [2, 1])
+        self.assertEqual(level_counts([]).shape, (0,))
+
+    def test_level_mask(self):
+        obs = level_mask(['a', 'a|b', 'a|b|c', 'b|c'], 2)
+        np.testing.assert_array_equal(obs, [False, True, False, True])
+        obs = level_mask(pd.Index(['a', 'a|b']), 1)
+        np.testing.assert_array_equal(obs, [True, False])
+
+    def test_select_levels(self):
+        n_levels = np.array([1, 2, 3, 1])
+        np.testing.assert_array_equal(select_levels(n_levels, 1),
+                                      [True, False, False, True])
+        np.testing.assert_array_equal(select_levels(n_levels, STRATIFIED),
+                                      [False, True, True, False])
+        np.testing.assert_array_equal(
+            level_mask(['a', 'a|b', 'a|b|c'], STRATIFIED),
+            [False, True, True])
+
+    def test_taxonomy(self):
+        obs = taxonomy(['k__A', 'k__A|p__B', 'k__A|p__B|c__C'])
+        exp = pd.DataFrame(
+            {'Taxon': ['k__A', 'k__A; p__B', 'k__A; p__B; c__C']},
+            index=pd.Index(['k__A', 'k__A|p__B', 'k__A|p__B|c__C'],
+                           name='Feature ID', dtype=object))
+        assert_frame_equal(obs, exp)
+
+        obs = taxonomy(np.array(['PWY-1|g__G.s__S'], dtype=object),
+                       delimiters=('|', '.'))
+        self.assertEqual(list(obs['Taxon']), ['PWY-1; g__G; s__S'])
+
+        obs = taxonomy([])
+        self.assertEqual(obs.shape, (0, 1))
+        self.assertEqual(obs.index.name, 'Feature ID')
+
+    def test_filter_lines(self):
+        block = (b'a\t1\n'
+                 b'a|b\t1|2\n'
+                 b'a|b|c\t1|2|3\n'
+                 b'\n'
+                 b'b|c\n')
+        self.assertEqual(filter_lines(block, 1), b'a\t1\n\n')
+        self.assertEqual(filter_lines(block, 2), b'a|b\t1|2\nb|c\n')
+        self.assertEqual(filter_lines(block, 3), b'a|b|c\t1|2|3\n')
+        self.assertEqual(filter_lines(block, 4), b'')
+        self.assertEqual(filter_lines(block, STRATIFIED),
+                         b'a|b\t1|2\na|b|c\t1|2|3\nb|c\n')
+
+    def test_open_level(self):
+        header = b'#mpa_v30_CHOCOPhlAn_201901\nclade_name\tNCBI_tax_id\ts1\n'
+        for block_size in [1, 7, 1024]:
+            with open_level(io.BytesIO(TABLE), 2) as fh:
+                fh.raw._block_size = block_size
+                self.assertEqual(
+                    fh.read(),
+                    header +
+                    b'k__Archaea|p__Euryarchaeota\t2157|28890\t1.5\n'
+                    b'k__Bacteria|p__Firmicutes\t2|1239\t98.5\n')
+
+        # a last line without a newline is included
+        with open_level(io.BytesIO(TABLE.rstrip(b'\n')), 3) as fh:
+            self.assertEqual(
+                fh.read(),
+                header +
+                b'k__Bacteria|p__Firmicutes|c__Bacilli\t2|1239|91061\t98.5\n')
+
+        with open_level(io.BytesIO(TABLE), 7) as fh:
+            self.assertEqual(fh.read(), header)
+
+    def test_open_level_humann(self):
+        # the header of HUMAnN tables starts with '#', but isn't followed by
+        # another header line
+        table = (b'# Gene Family\ts1_Abundance-RPKs\n'
+                 b'UniRef90_A\t1.5\n'
+                 b'UniRef90_A|g__G.s__S\t1.5\n'
+                 b'UniRef90_B\t2.5\n')
+        with open_level(io.BytesIO(table), 1, comment=None) as fh:
+            self.assertEqual(fh.read(),
+                             b'# Gene Family\ts1_Abundance-RPKs\n'
+                             b'UniRef90_A\t1.5\n'
+                             b'UniRef90_B\t2.5\n')
+        with open_level(io.BytesIO(table), STRATIFIED, comment=None) as fh:
+            self.assertEqual(fh.read(),
+                             b'# Gene Family\ts1_Abundance-RPKs\n'
+                             b'UniRef90_A|g__G.s__S\t1.5\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -6,6 +6,12 @@
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
 
+import os
+import tracemalloc
+import unittest
+from unittest import mock
+
+import biom
 import pandas as pd
 from pandas.testing import assert_frame_equal
 
@@ -13,7 +19,20 @@ from qiime2.plugin.testing import TestPluginBase
 
 from q2_sapienns import (
     HumannGeneFamilyFormat, HumannPathAbundanceFormat,
-    MetaphlanMergedAbundanceFormat)
+    MetaphlanMergedAbundanceFormat, CompressedHumannGeneFamilyFormat,
+    CompressedHumannPathAbundanceFormat,
+    CompressedMetaphlanMergedAbundanceFormat,
+    HumannGeneFamilyDirectoryFormat, HumannPathAbundanceDirectoryFormat,
+    MetaphlanMergedAbundanceDirectoryFormat,
+    HumannGeneFamilyArrowDirectoryFormat,
+    HumannPathAbundanceArrowDirectoryFormat,
+    MetaphlanMergedAbundanceArrowDirectoryFormat, TableChunks)
+from q2_sapienns._reader import (pyarrow, default_chunk_size,
+                                 read_humann_table,
+                                 read_metaphlan_table,
+                                 read_sparse_humann_table,
+                                 read_sparse_metaphlan_table)
+from q2_sapienns.tests.benchmarks import write_genefamily_table
 
 
 class TestHumannFormatTransformers(TestPluginBase):
@@ -101,6 +120,19 @@ class TestHumannFormatTransformers(TestPluginBase):
 
         assert_frame_equal(obs, exp)
 
+    def test_formats_to_dataframe_float32(self):
+        for fmt, filename in [
+                (HumannGeneFamilyFormat, 'humann-genefamilies-2.tsv'),
+                (HumannPathAbundanceFormat, 'humann-pathabundance-2.tsv')]:
+            _, exp = self.transform_format(fmt, pd.DataFrame,
+                                           filename=filename)
+            with mock.patch.dict(os.environ,
+                                 {'Q2_SAPIENNS_PRECISION': 'float32'}):
+                _, obs = self.transform_format(fmt, pd.DataFrame,
+                                               filename=filename)
+
+            assert_frame_equal(obs, exp.astype('float32'))
+
 
 class TestMetaphlanFormatTransformers(TestPluginBase):
     package = 'q2_sapienns.tests'
@@ -156,3 +188,601 @@ class TestMetaphlanFormatTransformers(TestPluginBase):
             filename='metaphlan-merged-abundance-1.tsv')
 
         assert_frame_equal(obs, exp)
+
+    def test_metaphlan_format_to_dataframe_after_validation(self):
+        for filename in ['metaphlan-merged-abundance-1.tsv',
+                         'metaphlan-merged-abundance-6.tsv']:
+            _, exp = self.transform_format(
+                MetaphlanMergedAbundanceFormat, pd.DataFrame,
+                filename=filename)
+
+            ff = MetaphlanMergedAbundanceFormat(
+                self.get_data_path(filename), mode='r')
+            ff.validate(level='max')
+            transformer = self.get_transformer(MetaphlanMergedAbundanceFormat,
+                                               pd.DataFrame)
+            with mock.patch('pandas.read_csv', side_effect=AssertionError):
+                obs = transformer(ff)
+            assert_frame_equal(obs, exp)
+
+
+class TestCompressedFormatTransformers(TestPluginBase):
+    package = 'q2_sapienns.tests'
+
+    def test_compressed_formats_to_dataframe(self):
+        for fmt, compressed_fmt, filename, suffix in [
+                (HumannGeneFamilyFormat, CompressedHumannGeneFamilyFormat,
+                 'humann-genefamilies-2.tsv', '.gz'),
+                (HumannPathAbundanceFormat,
+                 CompressedHumannPathAbundanceFormat,
+                 'humann-pathabundance-2.tsv', '.bz2'),
+                (MetaphlanMergedAbundanceFormat,
+                 CompressedMetaphlanMergedAbundanceFormat,
+                 'metaphlan-merged-abundance-1.tsv', '.xz')]:
+            _, exp = self.transform_format(fmt, pd.DataFrame,
+                                           filename=filename)
+            _, obs = self.transform_format(compressed_fmt, pd.DataFrame,
+                                           filename=filename + suffix)
+            assert_frame_equal(obs, exp)
+
+    def test_compressed_formats_to_directory_formats(self):
+        for compressed_fmt, dir_fmt, filename, suffix in [
+                (CompressedHumannGeneFamilyFormat,
+                 HumannGeneFamilyDirectoryFormat,
+                 'humann-genefamilies-2.tsv', '.gz'),
+                (CompressedHumannPathAbundanceFormat,
+                 HumannPathAbundanceDirectoryFormat,
+                 'humann-pathabundance-2.tsv', '.bz2'),
+                (CompressedMetaphlanMergedAbundanceFormat,
+                 MetaphlanMergedAbundanceDirectoryFormat,
+                 'metaphlan-merged-abundance-1.tsv', '.xz')]:
+            _, obs = self.transform_format(compressed_fmt, dir_fmt,
+                                           filename=filename + suffix)
+            obs.validate()
+            with open(os.path.join(str(obs), 'table.tsv')) as fh:
+                obs_contents = fh.read()
+            with open(self.get_data_path(filename)) as fh:
+                exp_contents = fh.read()
+            self.assertEqual(obs_contents, exp_contents)
+
+
+@unittest.skipIf(pyarrow is None, 'pyarrow is not installed')
+class TestPyarrowReader(TestPluginBase):
+    package = 'q2_sapienns.tests'
+
+    def _transform(self, fmt, filename, reader, **env):
+        env['Q2_SAPIENNS_READER'] = reader
+        with mock.patch.dict(os.environ, env):
+            _, obs = self.transform_format(fmt, pd.DataFrame,
+                                           filename=filename)
+        return obs
+
+    def test_pyarrow_reader_matches_pandas_reader(self):
+        for fmt, filename in [
+                (HumannGeneFamilyFormat, 'humann-genefamilies-1.tsv'),
+                (HumannGeneFamilyFormat, 'humann-genefamilies-2.tsv'),
+                (HumannPathAbundanceFormat, 'humann-pathabundance-2.tsv'),
+                (MetaphlanMergedAbundanceFormat,
+                 'metaphlan-merged-abundance-1.tsv'),
+                (MetaphlanMergedAbundanceFormat,
+                 'metaphlan-merged-abundance-6.tsv'),
+                (CompressedHumannGeneFamilyFormat,
+                 'humann-genefamilies-2.tsv.gz'),
+                (CompressedMetaphlanMergedAbundanceFormat,
+                 'metaphlan-merged-abundance-1.tsv.xz')]:
+            for precision in ['float64', 'float32']:
+                exp = self._transform(fmt, filename, 'pandas',
+                                      Q2_SAPIENNS_PRECISION=precision)
+                obs = self._transform(fmt, filename, 'pyarrow',
+                                      Q2_SAPIENNS_PRECISION=precision)
+                assert_frame_equal(obs, exp, check_exact=True)
+
+    def test_pyarrow_reader_rounding(self):
+        # pyarrow rounds values correctly, like the 'round_trip' parser of
+        # pd.read_csv.
+        filepath = os.path.join(self.temp_dir.name, 'table.tsv')
+        write_genefamily_table(filepath, 1000, 5)
+        exp = pd.read_csv(filepath, sep='\t', header=0, index_col=0,
+                          float_precision='round_trip')
+        exp.index.name = 'feature-id'
+
+        with mock.patch.dict(os.environ, {'Q2_SAPIENNS_READER': 'pyarrow'}):
+            obs = self.get_transformer(HumannGeneFamilyFormat, pd.DataFrame)(
+                HumannGeneFamilyFormat(filepath, mode='r'))
+
+        assert_frame_equal(obs, exp, check_exact=True)
+
+    def test_pyarrow_reader_long_rows(self):
+        # a row longer than pyarrow's default block size (1 MiB), following
+        # rows that fit in a much smaller block, is read
+        filepath = os.path.join(self.temp_dir.name, 'table.tsv')
+        write_genefamily_table(filepath, 1000, 5)
+        long_id = 'UniRef90_' + 'A' * (2 * 1024 ** 2)
+        with open(filepath, 'a') as fh:
+            fh.write('\t'.join([long_id] + ['1.0'] * 5) + '\n')
+        exp = pd.read_csv(filepath, sep='\t', header=0, index_col=0,
+                          float_precision='round_trip')
+        exp.index.name = 'feature-id'
+
+        with mock.patch.dict(os.environ, {'Q2_SAPIENNS_READER': 'pyarrow'}):
+            obs = self.get_transformer(HumannGeneFamilyFormat, pd.DataFrame)(
+                HumannGeneFamilyFormat(filepath, mode='r'))
+
+        self.assertEqual(obs.index[-1], long_id)
+        assert_frame_equal(obs, exp, check_exact=True)
+
+    def test_invalid_reader(self):
+        with mock.patch.dict(os.environ, {'Q2_SAPIENNS_READER': 'polars'}):
+            with self.assertRaisesRegex(ValueError, 'READER.*polars'):
+                self.transform_format(HumannGeneFamilyFormat, pd.DataFrame,
+                                      filename='humann-genefamilies-1.tsv')
+
+
+class TestSparseTransformers(TestPluginBase):
+    package = 'q2_sapienns.tests'
+
+    def _readers(self):
+        return ['pandas'] if pyarrow is None else ['pandas', 'pyarrow']
+
+    def test_gene_family_format_to_biom(self):
+        for filename in ['humann-genefamilies-1.tsv',
+                         'humann-genefamilies-2.tsv']:
+            _, df = self.transform_format(HumannGeneFamilyFormat,
+                                          pd.DataFrame, filename=filename)
+            exp = biom.Table(df.values, df.index, df.columns)
+
+            for reader in self._readers():
+                with mock.patch.dict(os.environ,
+                                     {'Q2_SAPIENNS_READER': reader}):
+                    _, obs = self.transform_format(
+                        HumannGeneFamilyFormat, biom.Table,
+                        filename=filename)
+                self.assertEqual(obs, exp)
+
+            # the table parsed during validation is reused
+            ff = HumannGeneFamilyFormat(self.get_data_path(filename),
+                                        mode='r')
+            ff.validate(level='max')
+            transformer = self.get_transformer(HumannGeneFamilyFormat,
+                                               biom.Table)
+            with mock.patch('pandas.read_csv', side_effect=AssertionError):
+                obs = transformer(ff)
+            self.assertEqual(obs, exp)
+
+    def test_metaphlan_format_to_biom(self):
+        for filename in ['metaphlan-merged-abundance-1.tsv',
+                         'metaphlan-merged-abundance-6.tsv']:
+            _, df = self.transform_format(MetaphlanMergedAbundanceFormat,
+                                          pd.DataFrame, filename=filename)
+            df = df.drop(columns='NCBI_tax_id', errors='ignore')
+            exp = biom.Table(df.values, df.index, df.columns)
+
+            ff = MetaphlanMergedAbundanceFormat(
+                self.get_data_path(filename), mode='r')
+            for reader in self._readers():
+                with mock.patch.dict(os.environ,
+                                     {'Q2_SAPIENNS_READER': reader}):
+                    obs = read_sparse_metaphlan_table(ff, chunk_size=3)
+                self.assertEqual(obs, exp)
+
+            # only the selected features are kept
+            obs = read_sparse_metaphlan_table(
+                ff, select=lambda ids: ids.str.startswith('k__Archaea'))
+            self.assertEqual(
+                obs, exp.filter(lambda v, i, m: i.startswith('k__Archaea'),
+                                axis='observation', inplace=False))
+
+    def test_read_sparse_humann_table_in_chunks(self):
+        filepath = os.path.join(self.temp_dir.name, 'table.tsv')
+        write_genefamily_table(filepath, 100, 20)
+        ff = HumannGeneFamilyFormat(filepath, mode='r')
+
+        for reader in self._readers():
+            with mock.patch.dict(os.environ, {'Q2_SAPIENNS_READER': reader}):
+                _, df = self.transform_format(
+                    HumannGeneFamilyFormat, pd.DataFrame, filename=filepath)
+                obs = read_sparse_humann_table(ff, chunk_size=7)
+            exp = biom.Table(df.values, df.index, df.columns)
+            self.assertEqual(obs, exp)
+            self.assertLess(obs.matrix_data.nnz, 0.3 * 100 * 20)
+
+    def test_read_sparse_humann_table_no_features(self):
+        filepath = os.path.join(self.temp_dir.name, 'table.tsv')
+        with open(filepath, 'w') as fh:
+            fh.write('# Gene Family\ts1_Abundance-RPKs\ts2_Abundance-RPKs\n')
+        ff = HumannGeneFamilyFormat(filepath, mode='r')
+
+        for reader in self._readers():
+            with mock.patch.dict(os.environ, {'Q2_SAPIENNS_READER': reader}):
+                obs = read_sparse_humann_table(ff)
+            self.assertEqual(obs.shape, (0, 2))
+            self.assertEqual(list(obs.ids()),
+                             ['s1_Abundance-RPKs', 's2_Abundance-RPKs'])
+
+
+class TestArrowDirectoryFormatTransformers(TestPluginBase):
+    package = 'q2_sapienns.tests'
+
+    formats = [
+        (HumannGeneFamilyFormat, CompressedHumannGeneFamilyFormat,
+         HumannGeneFamilyArrowDirectoryFormat,
+         'humann-genefamilies-2.tsv', '.gz'),
+        (HumannPathAbundanceFormat, CompressedHumannPathAbundanceFormat,
+         HumannPathAbundanceArrowDirectoryFormat,
+         'humann-pathabundance-2.tsv', '.bz2'),
+        (MetaphlanMergedAbundanceFormat,
+         CompressedMetaphlanMergedAbundanceFormat,
+         MetaphlanMergedAbundanceArrowDirectoryFormat,
+         'metaphlan-merged-abundance-1.tsv', '.xz')]
+
+    def _assert_table_copied(self, dir_fmt, filename):
+        dir_fmt.validate()
+        with open(os.path.join(str(dir_fmt), 'table.tsv')) as fh:
+            obs_contents = fh.read()
+        with open(self.get_data_path(filename)) as fh:
+            exp_contents = fh.read()
+        self.assertEqual(obs_contents, exp_contents)
+        self.assertEqual(dir_fmt.sidecar_path() is not None,
+                         pyarrow is not None)
+
+    def test_formats_to_arrow_directory_formats(self):
+        for fmt, compressed_fmt, dir_fmt, filename, suffix in self.formats:
+            _, obs = self.transform_format(fmt, dir_fmt, filename=filename)
+            self._assert_table_copied(obs, filename)
+
+            _, obs = self.transform_format(compressed_fmt, dir_fmt,
+                                           filename=filename + suffix)
+            self._assert_table_copied(obs, filename)
+
+    def test_arrow_directory_formats_to_dataframe(self):
+        for fmt, _, dir_fmt, filename, _ in self.formats:
+            for precision in ['float64', 'float32']:
+                with mock.patch.dict(os.environ, {
+                        'Q2_SAPIENNS_READER': 'pyarrow' if pyarrow else
+                        'pandas', 'Q2_SAPIENNS_PRECISION': precision}):
+                    _, exp = self.transform_format(fmt, pd.DataFrame,
+                                                   filename=filename)
+                    _, df = self.transform_format(fmt, dir_fmt,
+                                                  filename=filename)
+                    obs = self.get_transformer(dir_fmt, pd.DataFrame)(df)
+                assert_frame_equal(obs, exp, check_exact=True)
+
+    def test_arrow_directory_formats_to_biom(self):
+        for fmt, _, dir_fmt, filename, _ in self.formats:
+            _, exp = self.transform_format(fmt, biom.Table,
+                                           filename=filename)
+            _, df = self.transform_format(fmt, dir_fmt, filename=filename)
+            obs = self.get_transformer(dir_fmt, biom.Table)(df)
+            self.assertEqual(obs, exp)
+
+    @unittest.skipIf(pyarrow is None, 'pyarrow is not installed')
+    def test_arrow_directory_formats_read_sidecar(self):
+        # the table isn't parsed again once the sidecar has been written
+        for fmt, _, dir_fmt, filename, _ in self.formats:
+            _, df = self.transform_format(fmt, dir_fmt, filename=filename)
+            with mock.patch('pandas.read_csv', side_effect=AssertionError), \
+                    mock.patch('pyarrow.csv.read_csv',
+                               side_effect=AssertionError), \
+                    mock.patch('pyarrow.csv.open_csv',
+                               side_effect=AssertionError):
+                self.get_transformer(dir_fmt, pd.DataFrame)(df)
+                self.get_transformer(dir_fmt, biom.Table)(df)
+
+    def test_arrow_directory_formats_without_sidecar(self):
+        for fmt, _, dir_fmt, filename, _ in self.formats:
+            _, exp = self.transform_format(fmt, pd.DataFrame,
+                                           filename=filename)
+            _, df = self.transform_format(fmt, dir_fmt, filename=filename)
+            if df.sidecar_path() is not None:
+                os.remove(df.sidecar_path())
+            df.validate()
+            obs = self.get_transformer(dir_fmt, pd.DataFrame)(df)
+            assert_frame_equal(obs, exp)
+
+    @unittest.skipIf(pyarrow is None, 'pyarrow is not installed')
+    def test_arrow_directory_formats_stale_sidecar(self):
+        # a sidecar written from a table of another size is ignored
+        for fmt, _, dir_fmt, filename, _ in self.formats:
+            _, df = self.transform_format(fmt, dir_fmt, filename=filename)
+            with open(self.get_data_path(filename)) as fh:
+                lines = fh.readlines()
+            with open(os.path.join(str(df), 'table.tsv'), 'w') as fh:
+                fh.writelines(lines[:-1])
+            exp = self.get_transformer(fmt, pd.DataFrame)(
+                df.table_format())
+
+            self.assertIsNone(df.current_sidecar_path())
+            obs = self.get_transformer(dir_fmt, pd.DataFrame)(df)
+            assert_frame_equal(obs, exp)
+            obs = self.get_transformer(dir_fmt, biom.Table)(df)
+            self.assertEqual(obs.shape[0], len(exp))
+
+    def test_directory_formats_to_arrow_directory_formats(self):
+        for fmt, dir_fmt, arrow_dir_fmt, filename in [
+                (HumannGeneFamilyFormat, HumannGeneFamilyDirectoryFormat,
+                 HumannGeneFamilyArrowDirectoryFormat,
+                 'humann-genefamilies-1.tsv'),
+                (MetaphlanMergedAbundanceFormat,
+                 MetaphlanMergedAbundanceDirectoryFormat,
+                 MetaphlanMergedAbundanceArrowDirectoryFormat,
+                 'metaphlan-merged-abundance-6.tsv')]:
+            _, df = self.transform_format(fmt, dir_fmt, filename=filename)
+            obs = self.get_transformer(dir_fmt, arrow_dir_fmt)(df)
+            self._assert_table_copied(obs, filename)
+
+
+class TestMetaphlanLevelReaders(TestPluginBase):
+    package = 'q2_sapienns.tests'
+
+    def _readers(self):
+        return ['pandas'] if pyarrow is None else ['pandas', 'pyarrow']
+
+    def test_read_metaphlan_table_level(self):
+        for fmt, filename in [
+                (MetaphlanMergedAbundanceFormat,
+                 'metaphlan-merged-abundance-1.tsv'),
+                (MetaphlanMergedAbundanceFormat,
+                 'metaphlan-merged-abundance-6.tsv'),
+                (CompressedMetaphlanMergedAbundanceFormat,
+                 'metaphlan-merged-abundance-1.tsv.xz')]:
+            for reader in self._readers():
+                with mock.patch.dict(os.environ,
+                                     {'Q2_SAPIENNS_READER': reader}):
+                    ff, df = self.transform_format(fmt, pd.DataFrame,
+                                                   filename=filename)
+                    for level in range(1, 9):
+                        n_levels = df.index.str.count(r'\|') + 1
+                        exp = df[n_levels == level]
+                        obs = read_metaphlan_table(ff, level=level)
+                        # NCBI_tax_id is parsed as integers if those of
+                        # the selected features all are
+                        if 'NCBI_tax_id' in exp.columns:
+                            self.assertEqual(
+                                list(obs.pop('NCBI_tax_id').astype(str)),
+                                list(exp['NCBI_tax_id'].astype(str)))
+                            exp = exp.drop(columns='NCBI_tax_id')
+                        assert_frame_equal(obs, exp,
+                                           check_index_type=len(exp) > 0)
+
+                        exp = biom.Table(exp.values, exp.index, exp.columns)
+                        obs = read_sparse_metaphlan_table(ff, level=level,
+                                                          chunk_size=2)
+                        self.assertEqual(obs, exp)
+
+    def test_read_metaphlan_table_level_after_validation(self):
+        filepath = self.get_data_path('metaphlan-merged-abundance-1.tsv')
+        _, df = self.transform_format(
+            MetaphlanMergedAbundanceFormat, pd.DataFrame,
+            filename='metaphlan-merged-abundance-1.tsv')
+        exp = df[df.index.str.count(r'\|') == 6]
+
+        ff = MetaphlanMergedAbundanceFormat(filepath, mode='r')
+        ff.validate(level='max')
+        with mock.patch('pandas.read_csv', side_effect=AssertionError):
+            obs = read_metaphlan_table(ff, level=7)
+        assert_frame_equal(obs, exp)
+
+    def test_read_metaphlan_table_level_from_sidecar(self):
+        ff, df = self.transform_format(
+            MetaphlanMergedAbundanceFormat, pd.DataFrame,
+            filename='metaphlan-merged-abundance-1.tsv')
+        dir_fmt = self.get_transformer(
+            MetaphlanMergedAbundanceFormat,
+            MetaphlanMergedAbundanceArrowDirectoryFormat)(ff)
+
+        exp = df[df.index.str.count(r'\|') == 6]
+        obs = read_metaphlan_table(dir_fmt, level=7)
+        assert_frame_equal(obs, exp)
+
+        exp = exp.drop(columns='NCBI_tax_id')
+        exp = biom.Table(exp.values, exp.index, exp.columns)
+        obs = read_sparse_metaphlan_table(dir_fmt, level=7)
+        self.assertEqual(obs, exp)
+
+    def test_read_metaphlan_table_level_skips_other_levels(self):
+        # the values of features at other levels are never parsed
+        filepath = os.path.join(self.temp_dir.name, 'table.tsv')
+        with open(filepath, 'w') as fh:
+            fh.write('#mpa_v30_CHOCOPhlAn_201901\n'
+                     'clade_name\tNCBI_tax_id\ts1\ts2\n'
+                     'k__Bacteria\t2\t100.0\t100.0\n'
+                     'k__Bacteria|p__Firmicutes\t2|1239\tnot\tparsed\n')
+        ff = MetaphlanMergedAbundanceFormat(filepath, mode='r')
+
+        for reader in self._readers():
+            with mock.patch.dict(os.environ, {'Q2_SAPIENNS_READER': reader}):
+                obs = read_metaphlan_table(ff, level=1)
+            self.assertEqual(list(obs.index), ['k__Bacteria'])
+            self.assertEqual(list(obs['s1']), [100.0])
+
+
+class TestSampleSelectionReaders(TestPluginBase):
+    package = 'q2_sapienns.tests'
+
+    def _readers(self):
+        return ['pandas'] if pyarrow is None else ['pandas', 'pyarrow']
+
+    def _inputs(self, fmt, dir_fmt, filename):
+        # the table format, the format after validation (which retains the
+        # parsed table) and the Arrow directory format
+        ff = fmt(self.get_data_path(filename), mode='r')
+        validated = fmt(self.get_data_path(filename), mode='r')
+        validated.validate(level='max')
+        return [ff, validated, self.get_transformer(fmt, dir_fmt)(ff)]
+
+    def test_read_table_samples(self):
+        for fmt, dir_fmt, filename, read, read_sparse, samples in [
+                (HumannPathAbundanceFormat,
+                 HumannPathAbundanceArrowDirectoryFormat,
+                 'humann-pathabundance-2.tsv', read_humann_table,
+                 read_sparse_humann_table, ['sample_2_Abundance']),
+                (MetaphlanMergedAbundanceFormat,
+                 MetaphlanMergedAbundanceArrowDirectoryFormat,
+                 'metaphlan-merged-abundance-1.tsv', read_metaphlan_table,
+                 read_sparse_metaphlan_table, ['sample_2']),
+                (MetaphlanMergedAbundanceFormat,
+                 MetaphlanMergedAbundanceArrowDirectoryFormat,
+                 'metaphlan-merged-abundance-6.tsv', read_metaphlan_table,
+                 read_sparse_metaphlan_table, ['sample1'])]:
+            for reader in self._readers():
+                with mock.patch.dict(os.environ,
+                                     {'Q2_SAPIENNS_READER': reader}):
+                    _, df = self.transform_format(fmt, pd.DataFrame,
+                                                  filename=filename)
+                    exp = df[[column for column in df.columns
+                              if column in samples or
+                              column == 'NCBI_tax_id']]
+                    exp_sparse = exp.drop(columns='NCBI_tax_id',
+                                          errors='ignore')
+                    exp_sparse = biom.Table(exp_sparse.values,
+                                            exp_sparse.index,
+                                            exp_sparse.columns)
+
+                    for ff in self._inputs(fmt, dir_fmt, filename):
+                        obs = read(ff, samples=samples)
+                        assert_frame_equal(obs, exp)
+                    for ff in self._inputs(fmt, dir_fmt, filename):
+                        obs = read_sparse(ff, chunk_size=3, samples=samples)
+                        self.assertEqual(obs, exp_sparse)
+
+    def test_read_table_samples_skips_other_samples(self):
+        # the values of other samples are never parsed
+        filepath = os.path.join(self.temp_dir.name, 'table.tsv')
+        with open(filepath, 'w') as fh:
+            fh.write('# Pathway\ts1_Abundance\ts2_Abundance\n'
+                     'PWY-1\t1.5\tnot\n'
+                     'PWY-1|g__Genus.s__Species\t1.5\tparsed\n')
+        ff = HumannPathAbundanceFormat(filepath, mode='r')
+
+        for reader in self._readers():
+            with mock.patch.dict(os.environ, {'Q2_SAPIENNS_READER': reader}):
+                obs = read_humann_table(ff, samples=['s1_Abundance'])
+                self.assertEqual(list(obs.columns), ['s1_Abundance'])
+                self.assertEqual(list(obs['s1_Abundance']), [1.5, 1.5])
+
+                obs = read_sparse_humann_table(ff, samples=['s1_Abundance'])
+                self.assertEqual(list(obs.ids()), ['s1_Abundance'])
+
+    def test_read_sparse_table_samples_no_features(self):
+        filepath = os.path.join(self.temp_dir.name, 'table.tsv')
+        with open(filepath, 'w') as fh:
+            fh.write('# Gene Family\ts1_Abundance-RPKs\ts2_Abundance-RPKs\n')
+        ff = HumannGeneFamilyFormat(filepath, mode='r')
+
+        for reader in self._readers():
+            with mock.patch.dict(os.environ, {'Q2_SAPIENNS_READER': reader}):
+                obs = read_sparse_humann_table(
+                    ff, samples=['s2_Abundance-RPKs'])
+            self.assertEqual(obs.shape, (0, 1))
+            self.assertEqual(list(obs.ids()), ['s2_Abundance-RPKs'])
+
+
+class TestTableChunksTransformers(TestPluginBase):
+    package = 'q2_sapienns.tests'
+
+    formats = TestArrowDirectoryFormatTransformers.formats
+
+    def _readers(self):
+        return ['pandas'] if pyarrow is None else ['pandas', 'pyarrow']
+
+    def _inputs(self, fmt, compressed_fmt, dir_fmt, filename, suffix):
+        ff = fmt(self.get_data_path(filename), mode='r')
+        compressed_ff = compressed_fmt(self.get_data_path(filename + suffix),
+                                       mode='r')
+        return [(fmt, ff), (compressed_fmt, compressed_ff),
+                (dir_fmt, self.get_transformer(fmt, dir_fmt)(ff))]
+
+    def test_formats_to_table_chunks(self):
+        for fmt, compressed_fmt, dir_fmt, filename, suffix in self.formats:
+            for reader in self._readers():
+                with mock.patch.dict(os.environ, {
+                        'Q2_SAPIENNS_READER': reader,
+                        'Q2_SAPIENNS_CHUNK_SIZE': '2'}):
+                    _, exp = self.transform_format(fmt, pd.DataFrame,
+                                                   filename=filename)
+                    for input_fmt, ff in self._inputs(
+                            fmt, compressed_fmt, dir_fmt, filename, suffix):
+                        obs = self.get_transformer(input_fmt,
+                                                   TableChunks)(ff)
+                        self.assertEqual(obs.chunk_size, 2)
+                        self.assertEqual(obs.sample_ids(),
+                                         list(exp.columns.drop(
+                                             'NCBI_tax_id', errors='ignore')))
+                        # it can be iterated over more than once
+                        for _ in range(2):
+                            chunks = list(obs)
+                            assert_frame_equal(pd.concat(chunks), exp)
+                        self.assertGreater(len(chunks), 1)
+                        for chunk in chunks:
+                            self.assertLessEqual(len(chunk), 2)
+
+    @unittest.skipIf(pyarrow is None, 'pyarrow is not installed')
+    def test_table_chunks_wide_and_long_rows(self):
+        # the chunks of a wide table have chunk_size rows, and rows longer
+        # than the blocks estimated from the first rows are read
+        filepath = os.path.join(self.temp_dir.name, 'table.tsv')
+        write_genefamily_table(filepath, 2000, 200)
+        with open(filepath, 'a') as fh:
+            fh.write('\t'.join(['UniRef90_' + 'A' * 100000] +
+                               ['1.0'] * 200) + '\n')
+        ff = HumannGeneFamilyFormat(filepath, mode='r')
+        exp = read_humann_table(ff)
+
+        for env in [{'Q2_SAPIENNS_CHUNK_SIZE': '5'},
+                    {'Q2_SAPIENNS_CHUNK_SIZE': '1000'}]:
+            env['Q2_SAPIENNS_READER'] = 'pyarrow'
+            with mock.patch.dict(os.environ, env), \
+                    mock.patch('q2_sapienns._reader.MIN_ARROW_BLOCK_SIZE',
+                               1024):
+                chunks = list(self.get_transformer(HumannGeneFamilyFormat,
+                                                   TableChunks)(ff))
+            chunk_size = int(env['Q2_SAPIENNS_CHUNK_SIZE'])
+            self.assertTrue(all(len(chunk) <= chunk_size
+                                for chunk in chunks))
+            self.assertGreaterEqual(len(chunks), 2001 // chunk_size)
+            assert_frame_equal(pd.concat(chunks), exp, check_exact=True)
+
+    def test_table_chunks_precision(self):
+        for fmt, _, _, filename, _ in self.formats:
+            with mock.patch.dict(os.environ,
+                                 {'Q2_SAPIENNS_PRECISION': 'float32'}):
+                _, obs = self.transform_format(fmt, TableChunks,
+                                               filename=filename)
+            for chunk in obs:
+                self.assertTrue(
+                    (chunk.dtypes.drop('NCBI_tax_id', errors='ignore') ==
+                     'float32').all())
+
+    def test_default_chunk_size(self):
+        with mock.patch.dict(os.environ, {'Q2_SAPIENNS_CHUNK_SIZE': ''}):
+            self.assertEqual(default_chunk_size(), 10000)
+        with mock.patch.dict(os.environ, {'Q2_SAPIENNS_CHUNK_SIZE': '500'}):
+            self.assertEqual(default_chunk_size(), 500)
+
+        with mock.patch.dict(os.environ, {'Q2_SAPIENNS_CHUNK_SIZE': 'ten'}):
+            with self.assertRaisesRegex(ValueError, 'integer.*ten'):
+                default_chunk_size()
+        with mock.patch.dict(os.environ, {'Q2_SAPIENNS_CHUNK_SIZE': '0'}):
+            with self.assertRaisesRegex(ValueError, 'at least 1.*0'):
+                default_chunk_size()
+
+    def test_table_chunks_peak_memory(self):
+        # the memory needed to iterate over a table depends on the chunk
+        # size rather than on the size of the table
+        filepath = os.path.join(self.temp_dir.name, 'table.tsv')
+        write_genefamily_table(filepath, 50000, 20)
+        table_size = 50000 * 20 * 8
+        ff = HumannGeneFamilyFormat(filepath, mode='r')
+
+        with mock.patch.dict(os.environ, {'Q2_SAPIENNS_READER': 'pandas',
+                                          'Q2_SAPIENNS_CHUNK_SIZE': '500'}):
+            chunks = self.get_transformer(HumannGeneFamilyFormat,
+                                          TableChunks)(ff)
+            tracemalloc.start()
+            try:
+                n_features = sum(len(chunk) for chunk in chunks)
+                _, peak = tracemalloc.get_traced_memory()
+            finally:
+                tracemalloc.stop()
+        self.assertEqual(n_features, 50000)
+        self.assertLess(peak, table_size / 4)
@@ -8,9 +8,9 @@
 
 from q2_sapienns import (
     MetaphlanMergedAbundanceTable, HumannPathAbundanceTable,
-    HumannGeneFamilyTable, HumannGeneFamilyDirectoryFormat,
-    HumannPathAbundanceDirectoryFormat,
-    MetaphlanMergedAbundanceDirectoryFormat
+    HumannGeneFamilyTable, HumannGeneFamilyArrowDirectoryFormat,
+    HumannPathAbundanceArrowDirectoryFormat,
+    MetaphlanMergedAbundanceArrowDirectoryFormat
 )
 
 from qiime2.plugin.testing import TestPluginBase
@@ -23,15 +23,15 @@ class TestTypes(TestPluginBase):
         self.assertRegisteredSemanticType(MetaphlanMergedAbundanceTable)
         self.assertSemanticTypeRegisteredToFormat(
             MetaphlanMergedAbundanceTable,
-            MetaphlanMergedAbundanceDirectoryFormat)
+            MetaphlanMergedAbundanceArrowDirectoryFormat)
 
     def test_humann_semantic_types_registration(self):
         self.assertRegisteredSemanticType(HumannGeneFamilyTable)
         self.assertSemanticTypeRegisteredToFormat(
             HumannGeneFamilyTable,
-            HumannGeneFamilyDirectoryFormat)
+            HumannGeneFamilyArrowDirectoryFormat)
 
         self.assertRegisteredSemanticType(HumannPathAbundanceTable)
         self.assertSemanticTypeRegisteredToFormat(
             HumannPathAbundanceTable,
-            HumannPathAbundanceDirectoryFormat)
+            HumannPathAbundanceArrowDirectoryFormat)
@@ -0,0 +1,275 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2022, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import io
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from qiime2.plugin import ValidationError
+
+from q2_sapienns._validation import (
+    abundance_checker, column_count_checker,
+    validate_sample, validation_sample_size, SAMPLE_SIZE_ENV_VAR,
+    validate_abundances, validate_column_counts,
+    validate_column_counts_bytes, validate_column_counts_parallel,
+    use_parallel_validation, validation_mode, validation_workers,
+    MODE_ENV_VAR, WORKERS_ENV_VAR)
+
+
+def _abundance_rows(n_rows, n_samples=3):
+    return ''.join(
+        'clade%d\t%d\t%s\n' % (i, i, '\t'.join(['1.5'] * n_samples))
+        for i in range(n_rows))
+
+
+class ValidateAbundancesTests(unittest.TestCase):
+
+    def test_valid(self):
+        for chunk_size in 1, 2, 7, 1000:
+            fh = io.StringIO(_abundance_rows(20))
+            validate_abundances(fh, 3, 5, None, chunk_size=chunk_size)
+
+    def test_n_lines_limits_validation(self):
+        fh = io.StringIO(_abundance_rows(5) + 'clade\t1\t1.0\t-1.0\t2.0\n')
+        validate_abundances(fh, 3, 5, 5, chunk_size=2)
+
+        fh = io.StringIO(_abundance_rows(5) + 'clade\t1\t1.0\t-1.0\t2.0\n')
+        with self.assertRaisesRegex(ValidationError, r'-1\.0+ \(line 8\)'):
+            validate_abundances(fh, 3, 5, 6, chunk_size=2)
+
+    def test_first_error_reported_across_chunks(self):
+        data = (_abundance_rows(9) +
+                'clade\t1\t1.0\tabc\t200.0\n' +
+                'clade\t1\t1.0\n' +
+                _abundance_rows(3))
+        for chunk_size in 1, 2, 4, 10, 1000:
+            fh = io.StringIO(data)
+            with self.assertRaisesRegex(ValidationError,
+                                        r'float-able. Found: abc \(line 12'):
+                validate_abundances(fh, 3, 5, None, chunk_size=chunk_size)
+
+    def test_inconsistent_number_of_columns(self):
+        data = _abundance_rows(4) + 'clade\t1\t1.0\n' + _abundance_rows(4)
+        for chunk_size in 1, 3, 1000:
+            fh = io.StringIO(data)
+            with self.assertRaisesRegex(ValidationError, 'line 7 is incon'):
+                validate_abundances(fh, 3, 5, None, chunk_size=chunk_size)
+
+    def test_out_of_range(self):
+        data = _abundance_rows(4) + 'clade\t1\t100.5\t1.0\t1.0\n'
+        fh = io.StringIO(data)
+        with self.assertRaisesRegex(ValidationError,
+                                    r'range \[0, 100\]. Found: 100.5'):
+            validate_abundances(fh, 3, 5, None, chunk_size=3)
+
+    def test_nan_accepted(self):
+        # float('nan') is neither greater than 100 nor less than 0
+        fh = io.StringIO('clade\t1\tnan\t1.0\t1.0\n')
+        validate_abundances(fh, 3, 5, None)
+
+    def test_value_columns_offset(self):
+        fh = io.StringIO('clade\tabc\t1.0\t1.0\n')
+        validate_abundances(fh, 3, 4, None, first_value_field=2)
+        fh = io.StringIO('clade\tabc\t1.0\t1.0\n')
+        with self.assertRaisesRegex(ValidationError, 'Found: abc'):
+            validate_abundances(fh, 3, 4, None, first_value_field=1)
+
+
+def _humann_rows(n_rows, n_samples=2):
+    return ''.join(
+        'feature%d\t%s\n' % (i, '\t'.join(['1.0'] * n_samples))
+        for i in range(n_rows))
+
+
+class ValidateColumnCountsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory(
+            prefix='q2-sapienns-test-temp-')
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def _write(self, data):
+        filepath = os.path.join(self.temp_dir.name, 'table.tsv')
+        with open(filepath, 'w') as fh:
+            fh.write(data)
+        return filepath
+
+    def test_valid(self):
+        data = _humann_rows(25)
+        for chunk_size in 1, 4, 1000:
+            validate_column_counts(io.StringIO(data), 2, 3, None,
+                                   chunk_size=chunk_size)
+
+    def test_invalid(self):
+        data = _humann_rows(10) + 'feature\t1.0\n' + _humann_rows(3)
+        for chunk_size in 1, 4, 1000:
+            with self.assertRaisesRegex(ValidationError, 'line 12 is incon'):
+                validate_column_counts(io.StringIO(data), 2, 3, None,
+                                       chunk_size=chunk_size)
+        validate_column_counts(io.StringIO(data), 2, 3, 10)
+
+    def test_bytes_valid(self):
+        data = '# Gene Family\ts1\ts2\n' + _humann_rows(50)
+        for window_bytes in 1, 17, 100, 10 ** 6:
+            validate_column_counts_bytes(self._write(data), 1, 3,
+                                         window_bytes=window_bytes)
+            validate_column_counts_bytes(self._write(data.rstrip('\n')),
+                                         1, 3, window_bytes=window_bytes)
+
+    def test_bytes_header_only(self):
+        validate_column_counts_bytes(
+            self._write('# Gene Family\ts1\ts2\n'), 1, 3)
+        validate_column_counts_bytes(
+            self._write('# Gene Family\ts1\ts2'), 1, 3)
+
+    def test_bytes_reports_first_invalid_line(self):
+        for bad_line in 'feature\t1.0\n', '\n', 'feature\t1.0\t1.0\t\n':
+            data = ('# Gene Family\ts1\ts2\n' + _humann_rows(30) +
+                    bad_line + _humann_rows(30) + 'feature\n')
+            filepath = self._write(data)
+            for window_bytes in 1, 17, 100, 10 ** 6:
+                with self.assertRaisesRegex(ValidationError,
+                                            'line 32 is incon'):
+                    validate_column_counts_bytes(filepath, 1, 3,
+                                                 window_bytes=window_bytes)
+
+    def test_bytes_last_line_invalid(self):
+        filepath = self._write('# Gene Family\ts1\ts2\n' +
+                               _humann_rows(5) + 'feature\t1.0')
+        with self.assertRaisesRegex(ValidationError, 'line 7 is incon'):
+            validate_column_counts_bytes(filepath, 1, 3)
+
+    def test_validation_mode(self):
+        with mock.patch.dict(os.environ, clear=True):
+            self.assertEqual(validation_mode(), 'parse')
+        with mock.patch.dict(os.environ, {MODE_ENV_VAR: 'bytes'}):
+            self.assertEqual(validation_mode(), 'bytes')
+        with mock.patch.dict(os.environ, {MODE_ENV_VAR: 'fast'}):
+            with self.assertRaisesRegex(ValueError, 'bytes.*fast'):
+                validation_mode()
+
+    def test_parallel_valid(self):
+        filepath = self._write('# Gene Family\ts1\ts2\n' + _humann_rows(50))
+        for range_size in 1, 17, 100, 10 ** 6:
+            validate_column_counts_parallel(filepath, 1, 3, 2,
+                                            range_size=range_size)
+
+    def test_parallel_valid_no_trailing_newline(self):
+        filepath = self._write('# Gene Family\ts1\ts2\n' +
+                               _humann_rows(50).rstrip('\n'))
+        validate_column_counts_parallel(filepath, 1, 3, 2, range_size=64)
+
+    def test_parallel_reports_first_invalid_line(self):
+        data = ('# Gene Family\ts1\ts2\n' + _humann_rows(30) +
+                'feature\t1.0\n' + _humann_rows(30) + 'feature\n')
+        filepath = self._write(data)
+        for range_size in 1, 17, 100, 10 ** 6:
+            with self.assertRaisesRegex(ValidationError, 'line 32 is incon'):
+                validate_column_counts_parallel(filepath, 1, 3, 2,
+                                                range_size=range_size)
+
+    def test_validation_workers(self):
+        with mock.patch.dict(os.environ, {WORKERS_ENV_VAR: '4'}):
+            self.assertEqual(validation_workers(), 4)
+        with mock.patch.dict(os.environ, {WORKERS_ENV_VAR: '0'}):
+            self.assertEqual(validation_workers(), os.cpu_count())
+        with mock.patch.dict(os.environ, {WORKERS_ENV_VAR: 'many'}):
+            with self.assertRaisesRegex(ValueError, 'integer.*many'):
+                validation_workers()
+        with mock.patch.dict(os.environ, clear=True):
+            self.assertEqual(validation_workers(), 1)
+
+    def test_small_files_validated_serially(self):
+        filepath = self._write('# Gene Family\ts1\ts2\n' + _humann_rows(5))
+        self.assertFalse(use_parallel_validation(filepath, None, 4))
+        with mock.patch('q2_sapienns._validation.PARALLEL_MIN_BYTES', 0):
+            self.assertTrue(use_parallel_validation(filepath, None, 4))
+            self.assertFalse(use_parallel_validation(filepath, None, 1))
+            self.assertFalse(use_parallel_validation(filepath, 5, 4))
+
+
+class ValidateSampleTests(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory(
+            prefix='q2-sapienns-test-temp-')
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def _write(self, data):
+        filepath = os.path.join(self.temp_dir.name, 'table.tsv')
+        with open(filepath, 'w') as fh:
+            fh.write(data)
+        return filepath
+
+    def test_valid(self):
+        filepath = self._write('# Gene Family\ts1\ts2\n' +
+                               _humann_rows(1000))
+        obs = validate_sample(filepath, 1, 300, column_count_checker(3))
+        self.assertLessEqual(obs.n_rows, 300)
+        self.assertGreater(obs.n_rows, 250)
+        self.assertEqual(obs.tolerance, 0.01)
+        self.assertAlmostEqual(obs.confidence,
+                               1 - 0.99 ** obs.n_rows)
+
+    def test_reproducible(self):
+        data = '# Gene Family\ts1\ts2\n' + _humann_rows(1000)
+        filepath = self._write(data)
+        checked = []
+
+        def check_rows(rows, locations):
+            checked.append((rows, locations))
+
+        validate_sample(filepath, 1, 10, check_rows)
+        validate_sample(filepath, 1, 10, check_rows)
+        self.assertEqual(checked[0], checked[1])
+        # sampled rows are whole lines
+        for row in checked[0][0]:
+            self.assertIn(row, data)
+            self.assertRegex(row, r'^feature\d+\t1\.0\t1\.0\n$')
+
+    def test_header_only(self):
+        filepath = self._write('# Gene Family\ts1\ts2\n')
+        obs = validate_sample(filepath, 1, 10, column_count_checker(3))
+        self.assertEqual(obs.n_rows, 0)
+        self.assertEqual(obs.confidence, 0.0)
+
+    def test_tail_checked(self):
+        filepath = self._write('# Gene Family\ts1\ts2\n' +
+                               _humann_rows(1000) + 'feature\t1.0')
+        with self.assertRaisesRegex(ValidationError,
+                                    r'line starting at byte \d+ is incon'):
+            validate_sample(filepath, 1, 1, column_count_checker(3))
+
+    def test_invalid_rows_found(self):
+        # every other row is invalid
+        data = ''.join('clade\t1\t1.0\t1.0\nclade\t1\t1.0\t200.0\n'
+                       for _ in range(500))
+        filepath = self._write('#comment\nclade\tid\ts1\ts2\n' + data +
+                               _abundance_rows(10, n_samples=2))
+        with self.assertRaisesRegex(ValidationError,
+                                    r'200\.0+ \(the line starting at byte'):
+            validate_sample(filepath, 2, 20, abundance_checker(4))
+
+    def test_validation_sample_size(self):
+        with mock.patch.dict(os.environ, clear=True):
+            self.assertEqual(validation_sample_size(), 0)
+        with mock.patch.dict(os.environ, {SAMPLE_SIZE_ENV_VAR: '100'}):
+            self.assertEqual(validation_sample_size(), 100)
+        with mock.patch.dict(os.environ, {SAMPLE_SIZE_ENV_VAR: '-1'}):
+            with self.assertRaisesRegex(ValueError, 'negative'):
+                validation_sample_size()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -32,5 +32,12 @@ setup(
         'q2_sapienns.tests': ['data/*', 'data/*/*'],
         'q2_sapienns.types.tests': ['data/*']
     },
+    # zstandard is needed to import zstd-compressed tables, and pyarrow to
+    # parse tables with pyarrow (see Q2_SAPIENNS_READER) and to store the
+    # Arrow sidecar of imported tables.
+    extras_require={
+        'zstd': ['zstandard'],
+        'arrow': ['pyarrow'],
+    },
     zip_safe=False,
 )